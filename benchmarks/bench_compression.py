@@ -0,0 +1,57 @@
+"""Compare CPU time and output size of archive compression policies.
+
+``deflate`` compresses every member, as minecart always used to.
+``auto`` uses the default :class:`minecart.archive.CompressionPolicy`.
+Run from the repository root against a directory of PDFs::
+
+    python -m benchmarks.bench_compression path/to/pdfs
+
+"""
+import glob
+import os.path
+import tempfile
+import time
+
+import click
+
+from minecart.archive import CompressionPolicy, Zip
+
+
+POLICIES = {
+    'deflate': None,
+    'auto': CompressionPolicy(),
+}
+
+
+def run(pdfs, policy, workers):
+    with tempfile.TemporaryFile() as fp:
+        start = time.process_time()
+        wall = time.perf_counter()
+        arx = Zip(fp, policy=policy, workers=workers)
+        for i, pdf in enumerate(pdfs):
+            with open(pdf, 'rb') as f:
+                arx.write_stream(f, '{}-{}'.format(i, os.path.basename(pdf)),
+                                 mimetype='application/pdf')
+        arx.close()
+        elapsed = time.process_time() - start
+        return elapsed, time.perf_counter() - wall, fp.tell()
+
+
+@click.command()
+@click.argument('corpus', default='tests/fixtures')
+@click.option('--repeat', default=1,
+              help='Number of times to archive each PDF.')
+@click.option('--workers', default=1,
+              help='Number of threads compressing each member.')
+def main(corpus, repeat, workers):
+    pdfs = sorted(glob.glob(os.path.join(corpus, '*.pdf'))) * repeat
+    size = sum(os.path.getsize(pdf) for pdf in pdfs)
+    click.echo('{} PDFs, {} bytes'.format(len(pdfs), size))
+    for name, policy in sorted(POLICIES.items()):
+        elapsed, wall, archived = run(pdfs, policy, workers)
+        click.echo('{:<8} cpu={:.3f}s wall={:.3f}s size={} ratio={:.3f}'
+                   .format(name, elapsed, wall, archived, archived / size))
+
+
+if __name__ == '__main__':
+    main()
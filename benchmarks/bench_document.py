@@ -0,0 +1,61 @@
+"""Compare the fast PCDM extractor with a full rdflib parse.
+
+Each path runs in a fresh process so its peak RSS can be reported.
+Run from the repository root::
+
+    python -m benchmarks.bench_document --files 2000 --items 20
+
+"""
+import multiprocessing
+import resource
+import time
+
+import click
+
+from minecart.packager import Document, EBU, PCDM, PCDMFile
+from minecart.pcdm import extract_files
+from tests.standins import thesis_n3
+
+
+def rdflib_path(data):
+    doc = Document('item', data)
+    g = doc.g
+    return [PCDMFile(str(o), str(g.value(o, EBU.hasMimeType)))
+            for o in g.objects(None, PCDM.hasFile)]
+
+
+PATHS = {
+    'rdflib': rdflib_path,
+    'extract': extract_files,
+}
+
+
+def measure(name, items, results):
+    start = time.perf_counter()
+    count = sum(len(PATHS[name](data)) for data in items)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((count, elapsed, rss))
+
+
+@click.command()
+@click.option('--files', default=2000, help='Files per item.')
+@click.option('--items', default=20, help='Number of items to parse.')
+def main(files, items):
+    data = [thesis_n3('http://example.com/item{}'.format(i), [
+        ('http://example.com/item{}/file{}'.format(i, j), 'application/pdf')
+        for j in range(files)]) for i in range(items)]
+    click.echo('{} items of {} bytes'.format(items, len(data[0])))
+    ctx = multiprocessing.get_context('spawn')
+    for name in sorted(PATHS):
+        results = ctx.Queue()
+        proc = ctx.Process(target=measure, args=(name, data, results))
+        proc.start()
+        count, elapsed, rss = results.get()
+        proc.join()
+        click.echo('{:<8} files={} time={:.3f}s peak_rss={} KiB'.format(
+            name, count, elapsed, rss))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Compare serial and concurrent metadata fetching in ``document_set``.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_document_set --members 200 --latency 0.02
+
+"""
+import time
+
+import click
+import requests
+
+from minecart.packager import document_set
+from tests.standins import synthetic_fedora
+
+
+def run(fedora, workers):
+    session = requests.Session()
+    start = time.perf_counter()
+    count = sum(1 for _ in document_set(fedora.docset_url(1), session,
+                                        fedora.fedora, workers=workers))
+    return count, time.perf_counter() - start
+
+
+@click.command()
+@click.option('--members', default=200)
+@click.option('--latency', default=0.02,
+              help='Seconds of latency added to every Fedora request.')
+@click.option('--workers', '-w', multiple=True, type=int,
+              default=[1, 2, 4, 8, 16])
+def main(members, latency, workers):
+    with synthetic_fedora(members, latency=latency) as fedora:
+        baseline = None
+        for n in workers:
+            count, elapsed = run(fedora, n)
+            baseline = baseline or elapsed
+            click.echo('workers={:<3} documents={} time={:.3f}s '
+                       'speedup={:.1f}x'.format(n, count, elapsed,
+                                                baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Benchmark whole package jobs against local service stand-ins.
+
+A synthetic docset is served by Fedora and GCS stand-ins with the given
+latency, bandwidth and error rate, and each scenario runs in a fresh
+process so that its CPU time and peak RSS are its own. Results are
+written as JSON, and compared with an earlier run if one is given.
+Run from the repository root::
+
+    python -m benchmarks.bench_end_to_end --members 10 --members 1000 \\
+        --output results.json --baseline previous.json
+
+"""
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import tempfile
+import threading
+import time
+
+import click
+
+from minecart.metrics import registry
+from minecart.packager import ApiListener, create_package
+from minecart.upload import Client
+from tests.standins import GCS, synthetic_fedora
+
+
+class Connection:
+    """Records the messages a listener sends in place of a broker."""
+    def __init__(self):
+        self.sent = []
+
+    def send(self, queue, body):
+        self.sent.append(body)
+
+    def ack(self, *args):
+        pass
+
+
+class DiskSampler(threading.Thread):
+    """Tracks the peak total size of the files in a directory."""
+    def __init__(self, path, interval=0.05):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        size = 0
+        for name in os.listdir(self.path):
+            try:
+                size += os.path.getsize(os.path.join(self.path, name))
+            except OSError:
+                pass
+        self.peak = max(self.peak, size)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.sample()
+
+
+def run_create_package(config, fedora_url, docset_url, gcs_url):
+    arxv = create_package(docset_url, fedora=fedora_url,
+                          workers=config['workers'],
+                          compress_workers=config['compress_workers'])
+    size = os.path.getsize(arxv)
+    os.remove(arxv)
+    return size
+
+
+def run_listener(config, fedora_url, docset_url, gcs_url):
+    bucket = Client(url=gcs_url, upload_url=gcs_url, backoff=0.1).get('b')
+    conn = Connection()
+    listener = ApiListener(fedora=fedora_url, bucket=bucket, conn=conn,
+                           stream=config['stream'])
+    listener.on_message(None, docset_url)
+    complete = conn.sent[-1]
+    if not complete.startswith('Complete:'):
+        raise RuntimeError('Job failed')
+    return int(complete.rsplit('Size: ', 1)[1])
+
+
+SCENARIOS = {
+    'create_package': run_create_package,
+    'on_message': run_listener,
+}
+
+
+def measure(name, config, urls, results):
+    tempfile.tempdir = tempfile.mkdtemp()
+    disk = DiskSampler(tempfile.tempdir)
+    disk.start()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    try:
+        size = SCENARIOS[name](config, *urls)
+    except Exception as e:
+        results.put({'error': str(e)})
+        return
+    finally:
+        disk.stop()
+        shutil.rmtree(tempfile.tempdir)
+    wall = time.perf_counter() - start
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    results.put({
+        'wall_seconds': wall,
+        'cpu_seconds': end.ru_utime - usage.ru_utime +
+        end.ru_stime - usage.ru_stime,
+        'peak_rss_kib': end.ru_maxrss,
+        'peak_disk_bytes': disk.peak,
+        'package_bytes': size,
+        'throughput_bytes_per_second': size / wall,
+        'metrics': registry.snapshot(),
+    })
+
+
+def run_scenario(ctx, name, config, urls):
+    results = ctx.Queue()
+    proc = ctx.Process(target=measure, args=(name, config, urls, results))
+    proc.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not proc.is_alive():
+                result = {'error': 'Exited with code {}'.format(
+                    proc.exitcode)}
+                break
+    proc.join()
+    return result
+
+
+def compare(results, baseline):
+    previous = {_key(r): r for r in baseline['results']}
+    for r in results:
+        old = previous.get(_key(r))
+        if old is None or 'wall_seconds' not in old or \
+                'wall_seconds' not in r:
+            continue
+        click.echo('{:<16} members={:<7} wall={:.2f}x cpu={:.2f}x '
+                   'rss={:.2f}x'.format(
+                       r['scenario'], r['config']['members'],
+                       r['wall_seconds'] / old['wall_seconds'],
+                       r['cpu_seconds'] / max(old['cpu_seconds'], 1e-6),
+                       r['peak_rss_kib'] / old['peak_rss_kib']))
+
+
+def _key(result):
+    return result['scenario'], json.dumps(result['config'], sort_keys=True)
+
+
+@click.command()
+@click.option('--members', '-m', multiple=True, type=int,
+              default=[10, 100, 1000],
+              help='Docset sizes to run. May be repeated.')
+@click.option('--scenario', '-s', multiple=True,
+              type=click.Choice(sorted(SCENARIOS)),
+              default=sorted(SCENARIOS))
+@click.option('--pdf-size', default=64 * 1024,
+              help='Bytes in each synthetic PDF.')
+@click.option('--latency', default=0.0,
+              help='Seconds of latency added to every request.')
+@click.option('--bandwidth', default=None, type=int,
+              help='Bytes per second each stand-in connection may send.')
+@click.option('--error-rate', default=0.0,
+              help='Fraction of upload requests that fail with a 503.')
+@click.option('--workers', default=4,
+              help='Threads opening PDF downloads ahead.')
+@click.option('--compress-workers', default=1)
+@click.option('--stream/--no-stream', default=False)
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='File to write JSON results to.')
+@click.option('--baseline', type=click.File(),
+              help='Earlier JSON results to compare with.')
+def main(members, scenario, pdf_size, latency, bandwidth, error_rate,
+         workers, compress_workers, stream, output, baseline):
+    ctx = multiprocessing.get_context('spawn')
+    pdf = b'%PDF-1.4\n' + os.urandom(pdf_size)
+    results = []
+    for n in members:
+        config = {'members': n, 'pdf_size': pdf_size, 'latency': latency,
+                  'bandwidth': bandwidth, 'error_rate': error_rate,
+                  'workers': workers, 'compress_workers': compress_workers,
+                  'stream': stream}
+        with synthetic_fedora(n, pdf, latency=latency,
+                              bandwidth=bandwidth) as fedora, \
+                GCS(latency=latency, bandwidth=bandwidth,
+                    error_rate=error_rate, seed=0) as gcs:
+            urls = (fedora.fedora, fedora.docset_url(1), gcs.url)
+            for name in scenario:
+                errors = gcs.errors
+                result = run_scenario(ctx, name, config, urls)
+                result.update(scenario=name, config=config,
+                              upload_errors=gcs.errors - errors)
+                results.append(result)
+                click.echo('{:<16} members={:<7} {}'.format(
+                    name, n, result.get('error') or
+                    'wall={wall_seconds:.3f}s cpu={cpu_seconds:.3f}s '
+                    'rss={peak_rss_kib} KiB disk={peak_disk_bytes} '
+                    'rate={throughput_bytes_per_second:.0f} B/s'
+                    .format(**result)), err=True)
+    json.dump({
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+    if baseline is not None:
+        compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Compare the thread and asyncio engines on a high-latency Fedora.
+
+Each engine builds the same synthetic docset with ``create_package``.
+The thread engine fetches metadata and PDFs with ``--workers`` threads,
+and the async engine with ``--concurrency`` and ``--downloads``
+coroutines. Run from the repository root::
+
+    python -m benchmarks.bench_engines --members 1000 --latency 0.05
+
+"""
+import os
+import resource
+import time
+
+import click
+
+from minecart.aio import AsyncEngine
+from minecart.packager import create_package
+from tests.standins import synthetic_fedora
+
+
+def run(fedora, **kwargs):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    arxv = create_package(fedora.docset_url(1), fedora=fedora.fedora,
+                          **kwargs)
+    wall = time.perf_counter() - start
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    size = os.path.getsize(arxv)
+    os.remove(arxv)
+    return size, wall, end.ru_utime - usage.ru_utime + \
+        end.ru_stime - usage.ru_stime
+
+
+@click.command()
+@click.option('--members', default=1000)
+@click.option('--pdf-size', default=16 * 1024)
+@click.option('--latency', default=0.05,
+              help='Seconds of latency added to every request.')
+@click.option('--workers', default=8,
+              help='Threads used by the thread engine.')
+@click.option('--concurrency', default=100,
+              help='Metadata requests in flight with the async engine.')
+@click.option('--downloads', default=8,
+              help='PDF downloads in flight with the async engine.')
+def main(members, pdf_size, latency, workers, concurrency, downloads):
+    pdf = b'%PDF-1.4\n' + os.urandom(pdf_size)
+    engine = AsyncEngine(concurrency, downloads)
+    try:
+        with synthetic_fedora(members, pdf, latency=latency) as fedora:
+            for name, kwargs in [('threads', {'workers': workers}),
+                                 ('async', {'engine': engine})]:
+                size, wall, cpu = run(fedora, **kwargs)
+                click.echo('{:<8} size={} time={:.3f}s cpu={:.3f}s'.format(
+                    name, size, wall, cpu))
+    finally:
+        engine.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Compare per-item Fedora requests with batched SPARQL queries.
+
+Run from the repository root::
+
+    python -m benchmarks.bench_metadata --members 500 --latency 0.02
+
+"""
+import time
+
+import click
+import requests
+
+from minecart.packager import document_set, FedoraMetadata, SparqlMetadata
+from tests.standins import Sparql, synthetic_fedora
+
+
+def run(fedora, backend):
+    session = requests.Session()
+    start = time.perf_counter()
+    count = sum(1 for _ in document_set(fedora.docset_url(1), session,
+                                        backend=backend))
+    return count, time.perf_counter() - start
+
+
+@click.command()
+@click.option('--members', default=500)
+@click.option('--latency', default=0.02,
+              help='Seconds of latency added to every request.')
+@click.option('--workers', default=8,
+              help='Threads used by the concurrent Fedora backend.')
+@click.option('--batch-size', default=100)
+def main(members, latency, workers, batch_size):
+    with synthetic_fedora(members, latency=latency) as fedora, \
+            Sparql.mirror(fedora, latency=latency) as sparql:
+        backends = [
+            ('fedora', FedoraMetadata(fedora.fedora)),
+            ('fedora-{}'.format(workers),
+             FedoraMetadata(fedora.fedora, workers)),
+            ('sparql-{}'.format(batch_size),
+             SparqlMetadata(sparql.url, fedora.fedora, batch_size)),
+        ]
+        for name, backend in backends:
+            count, elapsed = run(fedora, backend)
+            click.echo('{:<12} documents={} time={:.3f}s'.format(
+                name, count, elapsed))
+
+
+if __name__ == '__main__':
+    main()
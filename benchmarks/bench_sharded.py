@@ -0,0 +1,91 @@
+"""Compare building a docset in one process with sharded builds.
+
+Worker processes subscribe to the shard queue of a local broker
+stand-in, and a coordinator in this process splits the docset among
+them. With ``--shards 1`` the coordinator builds the whole package
+itself. Run from the repository root::
+
+    python -m benchmarks.bench_sharded --members 400 --processes 4 \\
+        --shards 1 --shards 4
+
+"""
+import multiprocessing
+import os
+import time
+
+import click
+import stomp
+
+from minecart.packager import ApiListener
+from minecart.shard import ShardCoordinator
+from minecart.upload import Client
+from tests.standins import Broker, GCS, synthetic_fedora
+
+
+def connect(broker, listener, queue, ack):
+    conn = stomp.Connection([broker])
+    listener.conn = conn
+    conn.set_listener('archiver', listener)
+    conn.start()
+    conn.connect(wait=True)
+    conn.subscribe(queue, 1, ack=ack, headers={'activemq.prefetchSize': 1})
+    return conn
+
+
+def worker(broker, fedora, gcs, stop):
+    bucket = Client(url=gcs, upload_url=gcs).get('bench')
+    listener = ApiListener(fedora=fedora, bucket=bucket, conn=None,
+                           ack=True, shards=ShardCoordinator())
+    conn = connect(broker, listener, '/queue/shards', 'client-individual')
+    stop.wait()
+    conn.disconnect()
+
+
+def build(broker, fedora, gcs, shards):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('bench')
+    listener = ApiListener(fedora=fedora.fedora, bucket=bucket, conn=None,
+                           workers=2, shards=ShardCoordinator(shards))
+    conn = connect(broker, listener, listener.shards.result_queue, 'auto')
+    start = time.perf_counter()
+    listener.on_message(None, fedora.docset_url(1))
+    listener.close()
+    elapsed = time.perf_counter() - start
+    conn.disconnect()
+    return elapsed
+
+
+@click.command()
+@click.option('--members', default=400)
+@click.option('--pdf-size', default=256 * 1024)
+@click.option('--latency', default=0.005,
+              help='Seconds of latency added to every request.')
+@click.option('--processes', default=4,
+              help='Number of worker processes building shards.')
+@click.option('--shards', '-s', multiple=True, type=int, default=[1, 4])
+def main(members, pdf_size, latency, processes, shards):
+    ctx = multiprocessing.get_context('spawn')
+    pdf = b'%PDF-1.4\n' + os.urandom(pdf_size)
+    with synthetic_fedora(members, pdf, latency=latency) as fedora, \
+            GCS(latency=latency) as gcs, Broker() as broker:
+        stop = ctx.Event()
+        procs = [ctx.Process(target=worker,
+                             args=(broker.host_and_port, fedora.fedora,
+                                   gcs.url, stop))
+                 for _ in range(processes)]
+        for proc in procs:
+            proc.start()
+        time.sleep(1)
+        try:
+            for n in shards:
+                elapsed = build(broker.host_and_port, fedora, gcs, n)
+                (_, name), data = gcs.objects.popitem()
+                click.echo('shards={:<3} time={:.3f}s size={}'.format(
+                    n, elapsed, len(data)))
+        finally:
+            stop.set()
+            for proc in procs:
+                proc.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""An asyncio engine for the requests made while building packages.
+
+Fedora metadata and PDF downloads are made by coroutines on an event
+loop in a background thread, so a job can have hundreds of requests in
+flight without a thread for each. The rest of the pipeline is
+unchanged: documents are parsed and PDFs zipped on the job's own thread,
+which reads the results in docset order.
+
+This needs ``aiohttp``, which is installed with the ``async`` extra.
+"""
+import asyncio
+from collections import deque
+import threading
+
+import aiohttp
+
+from minecart.packager import Document, item_headers
+
+
+class AsyncEngine:
+    """An event loop and HTTP client shared by every job in a process.
+
+    Up to ``concurrency`` metadata requests, and ``downloads`` PDF
+    downloads, are in flight for each job. Connections are kept alive
+    and shared by every job.
+
+    A request fails if connecting takes more than ``connect_timeout``
+    seconds, or if the server sends nothing for ``read_timeout`` seconds
+    while the response is being read. There is no limit on a request as
+    a whole, as a PDF response may wait in the download window for as
+    long as the PDFs ahead of it take to write.
+    """
+    def __init__(self, concurrency=100, downloads=8, connect_timeout=60,
+                 read_timeout=300):
+        self.concurrency = concurrency
+        self.downloads = downloads
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever,
+                                        name='async-engine', daemon=True)
+        self._thread.start()
+        self._session = self.call(self._open_session())
+
+    def call(self, coro):
+        """Run ``coro`` on the loop and return its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def map(self, func, iterable, window, release=None):
+        """Call coroutine function ``func`` on each item of ``iterable``.
+
+        Results are yielded in order, with up to ``window`` calls running
+        at once. The iterable is consumed lazily. If the generator is
+        closed early, or a call raises, the calls still running are
+        cancelled, and ``release`` is called with the result of each call
+        that had already finished.
+        """
+        pending = deque()
+        try:
+            for item in iterable:
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+                pending.append(asyncio.run_coroutine_threadsafe(
+                    func(item), self._loop))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                if not future.cancel() and release is not None and \
+                        future.exception() is None:
+                    release(future.result())
+
+    def metadata(self, fedora, cache=None):
+        """Return an :class:`AsyncMetadata` backend for ``fedora``."""
+        return AsyncMetadata(self, fedora, cache)
+
+    def open_pdfs(self, pdfs):
+        """Start streaming PDFs, yielding their names, files and responses.
+
+        ``pdfs`` are ``(name, file, member)`` tuples, as for
+        :func:`~minecart.packager.write_package`. A PDF with a member to
+        copy from an earlier package is passed through with the member
+        in place of a response.
+        """
+        return self.map(self._open_pdf, pdfs, self.downloads,
+                        _close_response)
+
+    def close(self):
+        self.call(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _open_session(self):
+        timeout = aiohttp.ClientTimeout(total=None,
+                                        sock_connect=self.connect_timeout,
+                                        sock_read=self.read_timeout)
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0), timeout=timeout)
+
+    async def _open_pdf(self, pdf):
+        name, f, member = pdf
+        if member is not None:
+            return name, f, member
+        resp = await self._session.get(f.uri)
+        try:
+            resp.raise_for_status()
+        except BaseException:
+            resp.release()
+            raise
+        return name, f, _Response(self, resp)
+
+    async def _read(self, resp, size):
+        return await resp.content.read(size)
+
+
+class AsyncMetadata:
+    """Metadata backend that fetches members' N3 from Fedora on an
+    :class:`AsyncEngine`.
+
+    Up to the engine's ``concurrency`` items are fetched at once. See
+    :func:`~minecart.packager.get_item_meta` for ``cache``.
+    """
+    def __init__(self, engine, fedora, cache=None):
+        self.engine = engine
+        self.fedora = fedora
+        self.cache = cache
+
+    def documents(self, refs, session):
+        """Generate a :class:`~minecart.packager.Document` for each ref, in
+        order.
+        """
+        for ref, n3 in self.engine.map(self._fetch, refs,
+                                       self.engine.concurrency):
+            yield Document(ref, n3)
+
+    async def _fetch(self, ref):
+        """Fetch an item's N3, revalidating any cached copy.
+
+        The cache is read and written on the loop's default executor, so
+        SQLite does not hold up the other requests on the loop.
+        """
+        loop = asyncio.get_running_loop()
+        url = self.fedora + ref
+        cached = None
+        if self.cache is not None:
+            cached = await loop.run_in_executor(None, self.cache.get, url)
+        async with self.engine._session.get(
+                url, headers=item_headers(cached)) as resp:
+            if resp.status == 304 and cached is not None:
+                return ref, cached[2]
+            resp.raise_for_status()
+            text = await resp.text()
+        etag = resp.headers.get('ETag')
+        modified = resp.headers.get('Last-Modified')
+        if self.cache is not None and (etag or modified):
+            await loop.run_in_executor(None, self.cache.put, url, etag,
+                                       modified, text)
+        return ref, text
+
+
+class _Response:
+    """The parts of a ``requests`` response used to write a PDF, for an
+    ``aiohttp`` response read from another thread.
+    """
+    def __init__(self, engine, resp):
+        self.engine = engine
+        self.headers = resp.headers
+        self._resp = resp
+
+    def iter_content(self, chunk_size):
+        while True:
+            chunk = self.engine.call(
+                self.engine._read(self._resp, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        self.engine._loop.call_soon_threadsafe(self._resp.release)
+
+
+def _close_response(pdf):
+    _, _, r = pdf
+    if isinstance(r, _Response):
+        r.close()
@@ -1,12 +1,49 @@
 from contextlib import contextmanager
+from functools import partial
+from itertools import chain
 import os
+import struct
+import time
 import zipfile
+import zlib
+
+from minecart.concurrency import ordered_map
+from minecart.metrics import registry
+
+
+CHUNK_SIZE = 1024 * 1024
+#: Size of the blocks members are split into for parallel compression.
+BLOCK_SIZE = 1024 * 1024
+#: Amount of each block used to prime the compressor for the next.
+DICT_SIZE = 32 * 1024
+
+#: Mimetypes whose content is compressed already and is always stored.
+COMPRESSED_MIMETYPES = frozenset([
+    'application/gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/zip',
+    'audio/mpeg',
+    'image/gif',
+    'image/jp2',
+    'image/jpeg',
+    'image/png',
+    'video/mp4',
+])
+
+
+#: Attributes of a member's ZipInfo needed to list it in a central
+#: directory.
+ENTRY_FIELDS = ('filename', 'date_time', 'compress_type', 'flag_bits',
+                'CRC', 'compress_size', 'file_size', 'header_offset',
+                'external_attr', 'internal_attr', 'create_system',
+                'create_version', 'extract_version')
 
 
 @contextmanager
-def archive(filename):
+def archive(filename, **kwargs):
     try:
-        arx = Zip(filename)
+        arx = Zip(filename, **kwargs)
         yield arx
     except:
         if os.path.isfile(filename):
@@ -16,13 +53,280 @@ def archive(filename):
         arx.close()
 
 
+class CompressionPolicy:
+    """Chooses whether each archive member is stored or compressed.
+
+    Members with a mimetype in ``stored`` are always stored. Anything
+    else is probed by compressing its first ``probe_size`` bytes at the
+    fastest level: if that saves less than ``min_saving`` of the sample,
+    the member is stored, otherwise it is deflated at ``level``. PDFs
+    are probed, since most are compressed internally but some are not.
+    """
+    def __init__(self, stored=COMPRESSED_MIMETYPES, probe_size=64 * 1024,
+                 min_saving=0.1, level=6):
+        self.stored = stored
+        self.probe_size = probe_size
+        self.min_saving = min_saving
+        self.level = level
+
+    def choose(self, mimetype=None, sample=b''):
+        """Return a ``(compress_type, compresslevel)`` tuple."""
+        if mimetype in self.stored:
+            return zipfile.ZIP_STORED, None
+        sample = sample[:self.probe_size]
+        if sample:
+            saved = 1 - len(zlib.compress(sample, 1)) / len(sample)
+            if saved < self.min_saving:
+                return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, self.level
+
+
 class Zip:
-    def __init__(self, filename, compression=zipfile.ZIP_DEFLATED):
+    """A zip archive being written.
+
+    Each member is compressed according to ``policy``, a
+    :class:`CompressionPolicy`. If ``policy`` is ``None``, every member
+    is compressed with ``compression`` instead.
+
+    With ``workers`` greater than 1, deflated members are split into
+    blocks that are compressed by a pool of threads (zlib releases the
+    GIL while compressing) and joined into a single deflate stream, as
+    pigz does. Each block is primed with the end of the one before, so
+    the output is close in size to compressing serially.
+    """
+    def __init__(self, filename, compression=zipfile.ZIP_DEFLATED,
+                 policy=CompressionPolicy(), workers=1):
         self.archive = zipfile.ZipFile(filename, mode='w',
                                        compression=compression)
+        self.policy = policy
+        self.workers = workers
+
+    @classmethod
+    def reopen(cls, filename, entries, offset, **kwargs):
+        """Reopen a partly written zip to add more members to it.
+
+        ``entries`` are the :func:`entry` dicts of the members written so
+        far, the last of which ends at ``offset``. Anything after that,
+        such as a member cut short, is discarded.
+        """
+        fp = open(filename, 'r+b')
+        try:
+            fp.truncate(offset)
+            fp.seek(offset)
+            arxv = cls(fp, **kwargs)
+        except BaseException:
+            fp.close()
+            raise
+        zf = arxv.archive
+        # Close the file along with the zip, as if it had been opened by
+        # name.
+        zf._filePassed = False
+        for zinfo in map(zipinfo, entries):
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+        return arxv
+
+    def write(self, filename, membername=None, mimetype=None):
+        if self.workers > 1:
+            with open(filename, 'rb') as fp:
+                self.write_stream(fp, membername or filename,
+                                  os.path.getsize(filename), mimetype)
+            return
+        compress_type, level = self._choose(mimetype, filename)
+        with registry.timer('archive'):
+            self.archive.write(filename, membername, compress_type, level)
+        self._count(self.archive.filelist[-1])
+
+    def write_stream(self, data, membername, size=None, mimetype=None):
+        """Write a member from an iterable of bytes or a file-like object.
+
+        Data is compressed into the archive as it is read, without being
+        staged on disk first. Pass ``size`` if it is known so that ZIP64
+        extensions are used for very large members. The new member's
+        ``ZipInfo`` is returned.
+        """
+        if hasattr(data, 'read'):
+            data = iter(partial(data.read, CHUNK_SIZE), b'')
+        chunks = iter(data)
+        first = next(chunks, b'')
+        zinfo = zipfile.ZipInfo(membername, time.localtime()[:6])
+        zinfo.compress_type, zinfo._compresslevel = \
+            self._choose(mimetype, sample=first)
+        zinfo.external_attr = 0o644 << 16
+        if size is not None:
+            zinfo.file_size = size
+        waited = [0.0]
+        chunks = _waiting(chain([first], chunks), waited)
+        start = time.perf_counter()
+        if self.workers > 1 and zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            self._write_blocks(zinfo, chunks, zip64=size is None or
+                               size * 1.05 > zipfile.ZIP64_LIMIT)
+        else:
+            with self.archive.open(zinfo, mode='w') as member:
+                for chunk in chunks:
+                    member.write(chunk)
+        registry.observe('archive', time.perf_counter() - start - waited[0])
+        self._count(zinfo)
+        return zinfo
+
+    def _count(self, zinfo):
+        registry.count('archive_members')
+        registry.count('archive_bytes_in', zinfo.file_size)
+        registry.count('archive_bytes_out', zinfo.compress_size)
 
-    def write(self, filename, membername=None):
-        self.archive.write(filename, membername)
+    def _write_blocks(self, zinfo, chunks, zip64):
+        """Append a member, deflating its blocks in parallel.
+
+        The local header is written with a data descriptor flag, and the
+        CRC and sizes follow the data in the descriptor, so this works on
+        unseekable files as well. ZIP64 fields are used if ``zip64`` is
+        true, and are required for members over 4 GiB.
+        """
+        zf = self.archive
+        deflate = partial(_deflate_block, level=zinfo._compresslevel or
+                          zlib.Z_DEFAULT_COMPRESSION)
+        blocks = ordered_map(deflate, _blocks(chunks, BLOCK_SIZE),
+                             self.workers)
+        with zf._lock:
+            zf._writecheck(zinfo)
+            zf._didModify = True
+            zinfo.flag_bits |= 0x08
+            zinfo.header_offset = zf.fp.tell()
+            zf.fp.write(zinfo.FileHeader(zip64))
+            crc = file_size = compress_size = 0
+            for data, compressed in blocks:
+                crc = zlib.crc32(data, crc)
+                file_size += len(data)
+                compress_size += len(compressed)
+                zf.fp.write(compressed)
+            if not zip64 and max(file_size, compress_size) > \
+                    zipfile.ZIP64_LIMIT:
+                raise RuntimeError('Member {} is too large for a zip '
+                                   'without ZIP64'.format(zinfo.filename))
+            zinfo.CRC = crc
+            zinfo.file_size = file_size
+            zinfo.compress_size = compress_size
+            fmt = '<LLQQ' if zip64 else '<LLLL'
+            zf.fp.write(struct.pack(fmt, 0x08074b50, crc, compress_size,
+                                    file_size))
+            zf.start_dir = zf.fp.tell()
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+
+    def write_raw(self, entries, chunks):
+        """Append members copied verbatim from another zip.
+
+        ``entries`` are the :func:`entry` dicts of members stored one
+        after another in the other zip, and ``chunks`` an iterable of the
+        bytes of their local records, from the header of the first to
+        the end of the last. Nothing is decompressed or recompressed.
+        The new members are returned as ``ZipInfo`` objects.
+        """
+        zf = self.archive
+        base = entries[0]['header_offset']
+        infos = [zipinfo(e) for e in entries]
+        with zf._lock:
+            for zinfo in infos:
+                zf._writecheck(zinfo)
+            zf._didModify = True
+            start = zf.fp.tell()
+            for chunk in chunks:
+                zf.fp.write(chunk)
+            for zinfo in infos:
+                zinfo.header_offset += start - base
+                zf.filelist.append(zinfo)
+                zf.NameToInfo[zinfo.filename] = zinfo
+            zf.start_dir = zf.fp.tell()
+        for zinfo in infos:
+            self._count(zinfo)
+        return infos
+
+    def _choose(self, mimetype, filename=None, sample=b''):
+        if self.policy is None:
+            return self.archive.compression, None
+        if filename is not None and mimetype not in self.policy.stored:
+            with open(filename, 'rb') as fp:
+                sample = fp.read(self.policy.probe_size)
+        return self.policy.choose(mimetype, sample)
+
+    def sync(self):
+        """Flush the members written so far through to disk."""
+        with self.archive._lock:
+            self.archive.fp.flush()
+            os.fsync(self.archive.fp.fileno())
 
     def close(self):
         self.archive.close()
+
+
+def entry(zinfo):
+    """Return a member's directory entry as a JSON serializable dict."""
+    return {field: getattr(zinfo, field) for field in ENTRY_FIELDS}
+
+
+def zipinfo(entry):
+    """Return a ``ZipInfo`` for a directory entry made by :func:`entry`."""
+    zinfo = zipfile.ZipInfo(entry['filename'], tuple(entry['date_time']))
+    for field in ENTRY_FIELDS[2:]:
+        setattr(zinfo, field, entry[field])
+    return zinfo
+
+
+def _waiting(chunks, waited):
+    """Yield from ``chunks``, adding the time spent waiting to ``waited[0]``.
+
+    This keeps the time spent reading a member out of its archive timing.
+    """
+    chunks = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        chunk = next(chunks, None)
+        waited[0] += time.perf_counter() - start
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _blocks(chunks, size):
+    """Regroup ``chunks`` into blocks for :func:`_deflate_block`.
+
+    Yields ``(data, zdict, last)`` tuples, where ``zdict`` is the end of
+    the previous block and ``last`` marks the final block. At least one
+    block is always yielded.
+    """
+    buf = bytearray()
+    zdict = b''
+    pending = None
+    for chunk in chunks:
+        buf.extend(chunk)
+        while len(buf) >= size:
+            if pending is not None:
+                yield pending
+            data = bytes(buf[:size])
+            del buf[:size]
+            pending = (data, zdict, False)
+            zdict = data[-DICT_SIZE:]
+    if buf or pending is None:
+        if pending is not None:
+            yield pending
+        yield bytes(buf), zdict, True
+    else:
+        yield pending[:2] + (True,)
+
+
+def _deflate_block(block, level):
+    """Deflate one block of a member, returning it and its compressed form.
+
+    Blocks other than the last end with a sync flush so that the output
+    of every block can be concatenated into one raw deflate stream.
+    """
+    data, zdict, last = block
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15,
+                                      zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data)
+    compressed += compressor.flush(zlib.Z_FINISH if last else
+                                   zlib.Z_SYNC_FLUSH)
+    return data, compressed
@@ -0,0 +1,205 @@
+import json
+import sqlite3
+import threading
+import time
+
+from minecart.manifest import Manifest
+
+
+class PackageCache:
+    """Index of uploaded packages, keyed by a digest of their contents.
+
+    The index is kept in an SQLite database at ``path``. Entries older
+    than ``ttl`` seconds are dropped, and once the packages in the index
+    add up to more than ``max_size`` bytes the least recently used are
+    dropped. Dropping an entry only removes it from the index; the
+    uploaded package itself is left alone.
+    """
+    def __init__(self, path, max_size=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS packages ('
+                'digest TEXT PRIMARY KEY, url TEXT, size INTEGER, '
+                'created REAL, accessed REAL)')
+
+    def get(self, digest):
+        """Return the ``(url, size)`` of a cached package, or ``None``."""
+        with self._lock, self._db:
+            self._expire()
+            row = self._db.execute(
+                'SELECT url, size FROM packages WHERE digest = ?',
+                (digest,)).fetchone()
+            if row is not None:
+                self._db.execute(
+                    'UPDATE packages SET accessed = ? WHERE digest = ?',
+                    (time.time(), digest))
+            return row
+
+    def put(self, digest, url, size):
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?)',
+                (digest, url, size, now, now))
+            self._expire()
+            self._evict()
+
+    def close(self):
+        self._db.close()
+
+    def _expire(self):
+        if self.ttl is not None:
+            self._db.execute('DELETE FROM packages WHERE created < ?',
+                             (time.time() - self.ttl,))
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        total, = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM packages').fetchone()
+        rows = self._db.execute(
+            'SELECT digest, size FROM packages ORDER BY accessed').fetchall()
+        for digest, size in rows:
+            if total <= self.max_size:
+                break
+            self._db.execute('DELETE FROM packages WHERE digest = ?',
+                             (digest,))
+            total -= size
+
+
+class MetadataCache:
+    """Store of Fedora item representations for conditional requests.
+
+    Each entry keeps the body of an item along with the ETag and
+    Last-Modified it was served with, in an SQLite database at ``path``.
+    Once the stored bodies add up to more than ``max_size`` bytes the
+    least recently used entries are dropped.
+    """
+    def __init__(self, path, max_size=None):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS items ('
+                'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                'body TEXT, size INTEGER, accessed REAL)')
+
+    def get(self, url):
+        """Return an item's ``(etag, last_modified, body)``, or ``None``."""
+        with self._lock, self._db:
+            row = self._db.execute(
+                'SELECT etag, last_modified, body FROM items WHERE url = ?',
+                (url,)).fetchone()
+            if row is not None:
+                self._db.execute(
+                    'UPDATE items SET accessed = ? WHERE url = ?',
+                    (time.time(), url))
+            return row
+
+    def put(self, url, etag, last_modified, body):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?)',
+                (url, etag, last_modified, body, len(body.encode('utf-8')),
+                 time.time()))
+            self._evict()
+
+    def close(self):
+        self._db.close()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        total, = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM items').fetchone()
+        rows = self._db.execute(
+            'SELECT url, size FROM items ORDER BY accessed').fetchall()
+        for url, size in rows:
+            if total <= self.max_size:
+                break
+            self._db.execute('DELETE FROM items WHERE url = ?', (url,))
+            total -= size
+
+
+class ManifestStore:
+    """Store of the :class:`~minecart.manifest.Manifest` of the last
+    package built for each docset, in an SQLite database at ``path``.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS manifests ('
+                'docset TEXT PRIMARY KEY, manifest TEXT, created REAL)')
+
+    def get(self, docset):
+        """Return the manifest for ``docset``, or ``None``."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT manifest FROM manifests WHERE docset = ?',
+                (docset,)).fetchone()
+        return Manifest.loads(row[0]) if row is not None else None
+
+    def put(self, docset, manifest):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO manifests VALUES (?, ?, ?)',
+                (docset, manifest.dumps(), time.time()))
+
+    def delete(self, docset):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM manifests WHERE docset = ?',
+                             (docset,))
+
+    def close(self):
+        self._db.close()
+
+
+class CheckpointStore:
+    """Durable checkpoints of package jobs, so they survive a restart.
+
+    Each docset's checkpoint is a JSON serializable dict, kept in an
+    SQLite database at ``path``. Every :meth:`put` is committed before
+    it returns.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints ('
+                'docset TEXT PRIMARY KEY, state TEXT, updated REAL)')
+
+    def get(self, docset):
+        """Return the checkpoint for ``docset``, or ``None``."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT state FROM checkpoints WHERE docset = ?',
+                (docset,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, docset, state):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)',
+                (docset, json.dumps(state), time.time()))
+
+    def delete(self, docset):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM checkpoints WHERE docset = ?',
+                             (docset,))
+
+    def filenames(self):
+        """Return the set of package files the checkpoints refer to."""
+        with self._lock:
+            rows = self._db.execute('SELECT state FROM checkpoints')
+            return {json.loads(state)['filename'] for state, in rows}
+
+    def close(self):
+        self._db.close()
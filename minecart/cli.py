@@ -3,7 +3,20 @@ import signal
 import click
 import stomp
 
-from minecart.packager import ApiListener
+from minecart.cache import (CheckpointStore, ManifestStore, MetadataCache,
+                            PackageCache)
+from minecart.connections import ConnectionPools
+from minecart.metrics import serve
+from minecart.oauth2 import JWTAuth, OAuth2Session
+from minecart.packager import ApiListener, FedoraMetadata, SparqlMetadata
+from minecart.scheduler import Scheduler
+from minecart.scratch import ScratchSpace
+from minecart.shard import ShardCoordinator
+from minecart.upload import Client
+
+
+GOOGLE_TOKEN_URL = 'https://www.googleapis.com/oauth2/v4/token'
+GCS_SCOPE = 'https://www.googleapis.com/auth/devstorage.read_write'
 
 
 @click.group()
@@ -19,13 +32,193 @@ def main():
 @click.option('--repo-host', default='locahost')
 @click.option('--repo-port', default=8080)
 @click.option('--queue', default='/queue/api')
+@click.option('--bucket', default='minecart',
+              help='Storage bucket packages are uploaded to.')
+@click.option('--gcs-email', envvar='GCS_EMAIL',
+              help='Service account email used to authorize uploads.')
+@click.option('--gcs-key', envvar='GCS_KEY', type=click.File(),
+              help='Service account private key file.')
+@click.option('--composite-threshold', default=None, type=int,
+              help='Upload packages of at least this many bytes as '
+                   'parallel parts composed into one object.')
+@click.option('--composite-parts', default=8,
+              help='Number of parts to upload large packages in.')
+@click.option('--stream/--no-stream', default=False,
+              help='Zip packages straight into the upload.')
+@click.option('--workers', default=1,
+              help='Number of packages to build at once.')
+@click.option('--download-workers', default=1,
+              help='Number of PDFs each job downloads at once.')
+@click.option('--meta-workers', default=1,
+              help='Number of item metadata requests each job makes at '
+                   'once.')
+@click.option('--compress-workers', default=1,
+              help='Number of threads each job compresses members with.')
+@click.option('--prefetch', default=None, type=int,
+              help='Number of unacknowledged requests the broker may '
+                   'send. Defaults to the number of workers, or of fast '
+                   'and bulk workers.')
+@click.option('--cache-db', type=click.Path(dir_okay=False),
+              help='SQLite file indexing uploaded packages so unchanged '
+                   'docsets are not rebuilt.')
+@click.option('--cache-max-size', default=None, type=int,
+              help='Total bytes of packages to keep in the cache index.')
+@click.option('--cache-ttl', default=None, type=int,
+              help='Seconds a cached package may be reused for.')
+@click.option('--meta-cache-db', type=click.Path(dir_okay=False),
+              help='SQLite file caching Fedora item metadata.')
+@click.option('--meta-cache-max-size', default=None, type=int,
+              help='Total bytes of item metadata to cache.')
+@click.option('--sparql-endpoint',
+              help='Fetch member metadata in batches from this SPARQL '
+                   'endpoint instead of item by item from Fedora.')
+@click.option('--sparql-batch-size', default=100,
+              help='Number of members per SPARQL query.')
+@click.option('--scratch-dir', multiple=True,
+              type=click.Path(file_okay=False, exists=True),
+              help='Directory to build packages in, checking for space '
+                   'first. May be repeated to use the first with room.')
+@click.option('--scratch-headroom', default=0,
+              help='Bytes to leave free in each scratch directory.')
+@click.option('--scratch-timeout', default=None, type=int,
+              help='Seconds a job may wait for scratch space.')
+@click.option('--metrics-port', default=None, type=int,
+              help='Serve Prometheus metrics at /metrics on this port.')
+@click.option('--progress-interval', default=None, type=float,
+              help='Seconds between progress messages for each job.')
+@click.option('--fast-threshold', default=None, type=int,
+              help='Schedule docsets with at most this many members in a '
+                   'fast lane and larger ones in a bulk lane. Raise '
+                   '--prefetch so jobs can be reordered.')
+@click.option('--fast-workers', default=1,
+              help='Number of fast lane jobs to run at once.')
+@click.option('--bulk-workers', default=1,
+              help='Number of bulk lane jobs to run at once.')
+@click.option('--max-wait', default=3600,
+              help='Seconds after which a job runs ahead of cheaper ones.')
+@click.option('--fair/--no-fair', default=False,
+              help='Prefer jobs from users with fewer jobs running.')
+@click.option('--shards', default=1,
+              help='Split large docsets into this many shards built by '
+                   'any listener on the shard queue.')
+@click.option('--shard-threshold', default=1000,
+              help='Least number of members a docset must have to be '
+                   'split into shards.')
+@click.option('--shard-queue', default='/queue/shards')
+@click.option('--shard-workers', default=0,
+              help='Number of shards to build at once for any '
+                   'coordinator. 0 does not build shards.')
+@click.option('--manifest-db', type=click.Path(dir_okay=False),
+              help='SQLite file of the last package built for each '
+                   'docset, so unchanged PDFs are copied from it.')
+@click.option('--checkpoint-db', type=click.Path(dir_okay=False),
+              help='SQLite file of job checkpoints, so jobs cut short by a '
+                   'restart carry on where they stopped. Packages left in '
+                   'scratch directories are kept for them.')
+@click.option('--checkpoint-interval', default=30.0,
+              help='Seconds between checkpoints of a package being built.')
+@click.option('--engine', type=click.Choice(['threads', 'async']),
+              default='threads',
+              help='Fetch metadata and PDFs with thread pools, or with '
+                   'asyncio. The async engine needs aiohttp.')
+@click.option('--concurrency', default=100,
+              help='Metadata requests each job may have in flight with '
+                   'the async engine.')
+@click.option('--downloads', default=8,
+              help='PDFs each job may download at once with the async '
+                   'engine.')
 def run(broker_host, broker_port, api_host, api_port, repo_host, repo_port,
-        queue):
+        queue, bucket, gcs_email, gcs_key, composite_threshold,
+        composite_parts, stream, workers, download_workers, meta_workers,
+        compress_workers, prefetch, cache_db, cache_max_size, cache_ttl,
+        meta_cache_db, meta_cache_max_size, sparql_endpoint, sparql_batch_size,
+        scratch_dir, scratch_headroom, scratch_timeout, metrics_port,
+        progress_interval, fast_threshold, fast_workers, bulk_workers,
+        max_wait, fair, shards, shard_threshold, shard_queue, shard_workers,
+        manifest_db, checkpoint_db, checkpoint_interval, engine, concurrency,
+        downloads):
+    fedora = 'http://{}:{}/'.format(repo_host, repo_port)
+    jobs = (workers if fast_threshold is None
+            else fast_workers + bulk_workers) + shard_workers
+    # Each job may have as many metadata and PDF requests to Fedora in
+    # flight as it has threads for them, and as many uploads to storage
+    # as a package has parts.
+    uploads = composite_parts if composite_threshold is not None else 1
+    pools = ConnectionPools(jobs * uploads, {
+        fedora: jobs * (meta_workers + download_workers)})
+    session = pools.mount(OAuth2Session())
+    if gcs_key is not None:
+        session.auth = JWTAuth(GOOGLE_TOKEN_URL, gcs_email, gcs_key.read(),
+                               [GCS_SCOPE], GOOGLE_TOKEN_URL,
+                               background=True)
+    client = Client(session=session, composite_threshold=composite_threshold,
+                    composite_parts=composite_parts)
+    cache = None
+    if cache_db is not None:
+        cache = PackageCache(cache_db, cache_max_size, cache_ttl)
+    meta_cache = None
+    if meta_cache_db is not None:
+        meta_cache = MetadataCache(meta_cache_db, meta_cache_max_size)
+    manifests = None
+    if manifest_db is not None:
+        manifests = ManifestStore(manifest_db)
+    checkpoints = None
+    if checkpoint_db is not None:
+        checkpoints = CheckpointStore(checkpoint_db)
+    aio = None
+    if engine == 'async':
+        from minecart.aio import AsyncEngine
+        aio = AsyncEngine(concurrency, downloads)
+    backend = None
+    if sparql_endpoint is not None:
+        if aio is not None:
+            fallback = aio.metadata(fedora, meta_cache)
+        else:
+            fallback = FedoraMetadata(fedora, meta_workers, meta_cache)
+        backend = SparqlMetadata(sparql_endpoint, fedora, sparql_batch_size,
+                                 fallback)
+    scratch = None
+    if scratch_dir:
+        keep = checkpoints.filenames() if checkpoints is not None else ()
+        scratch = ScratchSpace(scratch_dir, scratch_headroom, scratch_timeout,
+                               keep=keep)
+    scheduler = None
+    if fast_threshold is not None:
+        scheduler = Scheduler(fast_threshold, fast_workers, bulk_workers,
+                              max_wait, fair)
+    coordinator = None
+    if shards > 1 or shard_workers:
+        coordinator = ShardCoordinator(shards, shard_threshold, shard_queue,
+                                       shard_workers)
+    if metrics_port is not None:
+        serve(port=metrics_port)
     conn = stomp.Connection([(broker_host, broker_port)])
-    conn.set_listener('archiver', ApiListener())
+    listener = ApiListener(fedora=fedora,
+                           bucket=client.get(bucket),
+                           conn=conn, stream=stream, workers=workers,
+                           ack=True, cache=cache, meta_cache=meta_cache,
+                           backend=backend, scratch=scratch,
+                           progress_interval=progress_interval,
+                           scheduler=scheduler, shards=coordinator,
+                           manifests=manifests, session=pools.session,
+                           checkpoints=checkpoints,
+                           checkpoint_interval=checkpoint_interval,
+                           engine=aio, download_workers=download_workers,
+                           meta_workers=meta_workers,
+                           compress_workers=compress_workers)
+    conn.set_listener('archiver', listener)
     conn.start()
     conn.connect(wait=True)
-    conn.subscribe(queue, 1)
+    if prefetch is None:
+        prefetch = workers if scheduler is None else \
+            fast_workers + bulk_workers
+    conn.subscribe(queue, 1, ack='client-individual',
+                   headers={'activemq.prefetchSize': prefetch})
+    if shards > 1:
+        conn.subscribe(coordinator.result_queue, 2, ack='auto')
+    if shard_workers:
+        conn.subscribe(shard_queue, 3, ack='client-individual',
+                       headers={'activemq.prefetchSize': shard_workers})
 
     while True:
         signal.pause()
@@ -0,0 +1,37 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(func, iterable, workers=1, release=None):
+    """Map ``func`` over ``iterable`` using a pool of threads.
+
+    Results are yielded in the same order as ``iterable``. No more than
+    ``workers`` calls are in flight at once and the iterable is consumed
+    lazily, so memory use does not grow with the length of the input.
+    With ``workers`` of 1 no threads are started.
+
+    If the generator is closed early, or a call raises, any calls that
+    have not started yet are cancelled, and ``release`` is called with
+    the result of each call that had started but was not yielded.
+    """
+    if workers < 2:
+        for item in iterable:
+            yield func(item)
+        return
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for item in iterable:
+                if len(pending) >= workers:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(func, item))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            if release is not None:
+                for future in pending:
+                    if not future.cancelled() and \
+                            future.exception() is None:
+                        release(future.result())
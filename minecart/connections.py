@@ -0,0 +1,110 @@
+"""Shared HTTP connection pools for every job in a process.
+
+A :class:`ConnectionPools` mounts adapters on ``requests`` sessions so
+that each host gets a pool sized for the number of requests that may be
+made to it at once, and connections are kept alive between jobs rather
+than opened afresh for each. New connections and requests are counted
+in :data:`minecart.metrics.registry`, so the difference between them is
+the number of requests that reused a connection.
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from minecart.metrics import registry
+
+
+class ConnectionPools:
+    """Connection pools sized per host, shared by the sessions mounted.
+
+    Hosts are pooled ``pool_size`` connections each, unless a different
+    size is given for the URL prefix of a host in ``sizes``, such as
+    ``{'http://fedora:8080/': 16}``. Connections beyond a pool's size
+    are still opened when needed, but are closed after use instead of
+    being kept alive.
+    """
+    def __init__(self, pool_size=10, sizes=None):
+        self.pool_size = pool_size
+        self.sizes = dict(sizes or {})
+        self._adapters = []
+        self._lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        """A session mounted on these pools, made on first use."""
+        with self._lock:
+            if self._session is None:
+                self._session = requests.Session()
+                self._mount(self._session)
+            return self._session
+
+    def mount(self, session):
+        """Mount these pools' adapters on ``session`` and return it."""
+        with self._lock:
+            self._mount(session)
+        return session
+
+    def _mount(self, session):
+        adapters = [(prefix, _CountingAdapter(pool_maxsize=size))
+                    for prefix, size in self.sizes.items()]
+        adapters += [(scheme, _CountingAdapter(pool_maxsize=self.pool_size))
+                     for scheme in ('http://', 'https://')]
+        for prefix, adapter in adapters:
+            session.mount(prefix, adapter)
+            self._adapters.append(adapter)
+
+    def stats(self):
+        """Return the connections opened and requests made by host.
+
+        The result maps ``scheme://host:port`` to a dict with the number
+        of ``connections`` opened and ``requests`` made, for the pools
+        currently held.
+        """
+        with self._lock:
+            adapters = list(self._adapters)
+        stats = {}
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = '{}://{}:{}'.format(key.key_scheme, key.key_host,
+                                           key.key_port)
+                totals = stats.setdefault(host, {'connections': 0,
+                                                 'requests': 0})
+                totals['connections'] += pool.num_connections
+                totals['requests'] += pool.num_requests
+        return stats
+
+
+class _Counting:
+    """Mixin for connection pools that counts into the registry."""
+    def _new_conn(self):
+        registry.count('http_connections')
+        return super()._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        registry.count('http_requests')
+        return super()._make_request(*args, **kwargs)
+
+
+class _CountingHTTPConnectionPool(_Counting, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_Counting, HTTPSConnectionPool):
+    pass
+
+
+class _CountingAdapter(HTTPAdapter):
+    """Adapter whose pools count connections opened and requests made."""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
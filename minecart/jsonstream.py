@@ -0,0 +1,108 @@
+"""Incremental parsing of large JSON documents.
+
+Only the elements of one array are held in memory at a time, so a
+response listing millions of members can be processed as it arrives.
+"""
+import codecs
+import json
+import re
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_array(chunks, key, fields=None):
+    """Yield the elements of the array ``key`` of a JSON object.
+
+    ``chunks`` is an iterable of the bytes of a UTF-8 document whose top
+    level is an object. The other members of the object are parsed as
+    they are reached and put in ``fields``, if it is given, so those
+    after the array are only there once the generator is exhausted.
+    A :class:`ValueError` is raised if the document is malformed.
+    """
+    buf = _Buffer(chunks)
+    fields = {} if fields is None else fields
+    buf.expect('{')
+    if buf.peek() == '}':
+        buf.take()
+        return
+    while True:
+        name = buf.value()
+        buf.expect(':')
+        if name == key and buf.peek() == '[':
+            buf.take()
+            if buf.peek() == ']':
+                buf.take()
+            else:
+                while True:
+                    yield buf.value()
+                    if buf.expect(',]') == ']':
+                        break
+        else:
+            fields[name] = buf.value()
+        if buf.expect(',}') == '}':
+            return
+
+
+class _Buffer:
+    """Text decoded from ``chunks``, read from the front."""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def more(self):
+        """Read another chunk, returning ``False`` at the end of input."""
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            text = self.decoder.decode(b'', final=True)
+        else:
+            text = self.decoder.decode(chunk)
+        self.text = self.text[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next character that is not whitespace."""
+        while True:
+            self.pos = _WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.more():
+                raise ValueError('Unexpected end of JSON document')
+
+    def take(self):
+        char = self.peek()
+        self.pos += 1
+        return char
+
+    def expect(self, chars):
+        char = self.take()
+        if char not in chars:
+            raise ValueError('Expected one of {!r} but found {!r}'
+                             .format(chars, char))
+        return char
+
+    def value(self):
+        """Decode the next JSON value.
+
+        A value that runs to the end of the text read so far may be cut
+        short, as with a number, so more is read and it is decoded again.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.more():
+                    raise
+                continue
+            if end < len(self.text) or not self.more():
+                self.pos = end
+                return value
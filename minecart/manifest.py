@@ -0,0 +1,79 @@
+"""Manifests of built packages, for building the next one incrementally.
+
+A :class:`Manifest` records, for every PDF in a package, the member it
+came from, its URI and validators, and where its local record lies in
+the zip. When the docset is built again, PDFs whose validators have not
+changed are copied from the old package without being downloaded or
+compressed again.
+"""
+import json
+
+
+class Manifest:
+    """The PDFs in the package stored as object ``name``.
+
+    ``members`` is a list of dicts with the ``name`` of the document,
+    the ``uri``, ``etag`` and ``last_modified`` of the PDF, the
+    :func:`~minecart.archive.entry` of its zip member and the ``length``
+    of its local record. An empty manifest, with no ``name``, is used
+    for a docset that has not been built before.
+    """
+    def __init__(self, name=None, members=()):
+        self.name = name
+        self.members = list(members)
+        self._index = {(m['name'], m['uri']): m for m in self.members}
+
+    def reusable(self, name, uri, etag, last_modified):
+        """Return the member for a PDF if it can be copied, or ``None``.
+
+        It can be copied if it is in this manifest with the same ETag and
+        Last-Modified, and at least one of them is known.
+        """
+        if self.name is None or (etag is None and last_modified is None):
+            return None
+        member = self._index.get((name, uri))
+        if member is None or member['etag'] != etag or \
+                member['last_modified'] != last_modified:
+            return None
+        return member
+
+    @classmethod
+    def build(cls, records, end, name=None):
+        """Build a manifest for a newly written zip.
+
+        ``records`` are dicts as in ``members`` but without ``length``,
+        which is worked out from where the next record starts, and
+        ``end``, the offset at which the last record ends.
+        """
+        members = [dict(r) for r in records]
+        starts = sorted(m['entry']['header_offset'] for m in members)
+        following = dict(zip(starts, starts[1:] + [end]))
+        for m in members:
+            offset = m['entry']['header_offset']
+            m['length'] = following[offset] - offset
+        return cls(name, members)
+
+    def dumps(self):
+        return json.dumps({'name': self.name, 'members': self.members})
+
+    @classmethod
+    def loads(cls, data):
+        data = json.loads(data)
+        return cls(data['name'], data['members'])
+
+
+def runs(members):
+    """Group members into runs that lie back to back in their zip.
+
+    Each run can be copied with a single ranged read. Yields lists of
+    members, keeping them in the order given.
+    """
+    run = []
+    for m in members:
+        if run and run[-1]['entry']['header_offset'] + run[-1]['length'] \
+                != m['entry']['header_offset']:
+            yield run
+            run = []
+        run.append(m)
+    if run:
+        yield run
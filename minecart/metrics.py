@@ -0,0 +1,172 @@
+"""Counters and timings of the stages of building packages.
+
+Stages record into the module's :data:`registry`, which can be served to
+Prometheus with :func:`serve` or dumped with :meth:`Metrics.snapshot`.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
+
+
+#: Prefix of every metric name.
+PREFIX = 'minecart_'
+
+
+class Metrics:
+    """Thread-safe registry of counters and timings.
+
+    Counters are totals, such as bytes downloaded. Timings are kept as a
+    total number of seconds along with a count of observations, like a
+    Prometheus summary without quantiles.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            total, count = self._timings.get(name, (0.0, 0))
+            self._timings[name] = (total + seconds, count + 1)
+
+    @contextmanager
+    def timer(self, name):
+        """Observe the time taken by a ``with`` block under ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, iterable, name, bytes_name=None):
+        """Yield from ``iterable``, observing the time spent waiting on it.
+
+        Each wait is added to a single observation under ``name``, made
+        when the iterable is exhausted or closed, and closing this closes
+        the iterable too. If ``bytes_name`` is given, the length of each
+        item is counted under it.
+        """
+        waited = 0.0
+        it = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+                finally:
+                    waited += time.perf_counter() - start
+                if bytes_name is not None:
+                    self.count(bytes_name, len(item))
+                yield item
+        finally:
+            self.observe(name, waited)
+            if hasattr(it, 'close'):
+                it.close()
+
+    def snapshot(self):
+        """Return a dict of every counter and timing by metric name."""
+        with self._lock:
+            stats = {PREFIX + name + '_total': value
+                     for name, value in self._counters.items()}
+            for name, (total, count) in self._timings.items():
+                stats[PREFIX + name + '_seconds_sum'] = total
+                stats[PREFIX + name + '_seconds_count'] = count
+        return stats
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timings = sorted(self._timings.items())
+        lines = []
+        for name, value in counters:
+            lines.append('# TYPE {}{}_total counter'.format(PREFIX, name))
+            lines.append('{}{}_total {}'.format(PREFIX, name, value))
+        for name, (total, count) in timings:
+            lines.append('# TYPE {}{}_seconds summary'.format(PREFIX, name))
+            lines.append('{}{}_seconds_sum {:.6f}'.format(PREFIX, name,
+                                                          total))
+            lines.append('{}{}_seconds_count {}'.format(PREFIX, name, count))
+        return '\n'.join(lines) + '\n'
+
+
+#: Registry the stages of building packages record into.
+registry = Metrics()
+
+
+class Progress:
+    """Throttled progress reports for one package job.
+
+    Call :meth:`update` with the number of bytes done as they are done.
+    At most once every ``interval`` seconds a message is passed to
+    ``send`` with the bytes done and rate so far, and, if the ``total``
+    number of bytes is known, the percent done and estimated seconds
+    left::
+
+        Progress: 42%
+        Bytes: 1234
+        Rate: 5678 B/s
+        ETA: 30s
+    """
+    def __init__(self, send, total=None, interval=5.0):
+        self.send = send
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last = self._start
+
+    def update(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            now = time.monotonic()
+            if now - self._last < self.interval:
+                return
+            self._last = now
+            message = self.message(now - self._start)
+        self.send(message)
+
+    def message(self, elapsed):
+        rate = self.done / max(elapsed, 1e-6)
+        if not self.total:
+            return 'Progress: ?\nBytes: {}\nRate: {:.0f} B/s'.format(
+                self.done, rate)
+        done = min(self.done, self.total)
+        eta = (self.total - done) / rate if rate else 0
+        return 'Progress: {:.0f}%\nBytes: {}\nRate: {:.0f} B/s\n' \
+               'ETA: {:.0f}s'.format(100 * done / self.total, self.done,
+                                     rate, eta)
+
+
+def serve(metrics=registry, port=9100, host=''):
+    """Serve ``metrics`` at ``/metrics`` from a daemon thread.
+
+    Returns the server, which can be stopped with ``shutdown()``.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
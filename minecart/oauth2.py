@@ -1,4 +1,6 @@
 import json
+import logging
+import threading
 import time
 
 import jwt
@@ -6,37 +8,112 @@ import requests
 
 
 class JWTAuth(requests.auth.AuthBase):
-    def __init__(self, auth_url, email, key, scopes, audience):
+    """Two-legged OAuth2 authorization with a signed JWT assertion.
+
+    Tokens are refreshed ``margin`` seconds before they expire, so a
+    request never has to be retried with a new token, and with
+    ``background`` set the refresh is done by a timer thread rather than
+    by the first request to notice. Only one thread refreshes at a time;
+    others wait for and share its token. The signed assertion is reused
+    until it too nears expiry, so RS256 signing is not done on every
+    refresh.
+    """
+    #: Lifetime in seconds of signed assertions.
+    assertion_lifetime = 3600
+
+    def __init__(self, auth_url, email, key, scopes, audience, margin=300,
+                 background=False):
         self.auth_url = auth_url
         self.key = key
         self.email = email
         self.scopes = scopes
         self.audience = audience
+        self.margin = margin
+        self.background = background
         self._token = None
+        self._expires = None
+        self._assertion = None
+        self._assertion_expires = 0
+        self._lock = threading.Lock()
+        self._timer = None
 
     def __call__(self, r):
-        if not self._token:
-            self.authorize()
-        r.headers['Authorization'] = 'Bearer {}'.format(self._token)
+        r.headers['Authorization'] = 'Bearer {}'.format(self.token)
         return r
 
-    def authorize(self):
-        now = int(time.time())
-        exp = now + 3600
-        claims = {
-            'iss': self.email,
-            'scope': ' '.join(self.scopes),
-            'aud': self.audience,
-            'iat': now,
-            'exp': exp,
-        }
-        msg = jwt.encode(claims, self.key, algorithm='RS256')
+    @property
+    def token(self):
+        """A current access token, refreshed if it is close to expiry."""
+        if self._stale(self._token):
+            with self._lock:
+                if self._stale(self._token):
+                    self._refresh()
+        return self._token
+
+    def authorize(self, rejected=None):
+        """Get a new access token.
+
+        If ``rejected`` is given, a new token is only fetched if it is
+        still the current one, so that threads which had the same token
+        rejected at once only cause one refresh.
+        """
+        with self._lock:
+            if rejected is None or rejected == self._token:
+                self._refresh()
+
+    def close(self):
+        """Stop any scheduled background refresh."""
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def _stale(self, token):
+        if token is None:
+            return True
+        return self._expires is not None and \
+            time.time() >= self._expires - self.margin
+
+    def _refresh(self):
         data = {'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
-                'assertion': msg}
+                'assertion': self._signed_assertion()}
         r = requests.post(self.auth_url, data=data)
         r.raise_for_status()
         resp = r.json()
         self._token = resp['access_token']
+        expires_in = resp.get('expires_in')
+        self._expires = time.time() + int(expires_in) if expires_in \
+            else None
+        if self.background and expires_in:
+            self._schedule(max(int(expires_in) - self.margin, 1))
+
+    def _signed_assertion(self):
+        now = int(time.time())
+        if self._assertion is None or \
+                now >= self._assertion_expires - self.margin:
+            exp = now + self.assertion_lifetime
+            claims = {
+                'iss': self.email,
+                'scope': ' '.join(self.scopes),
+                'aud': self.audience,
+                'iat': now,
+                'exp': exp,
+            }
+            self._assertion = jwt.encode(claims, self.key, algorithm='RS256')
+            self._assertion_expires = exp
+        return self._assertion
+
+    def _schedule(self, delay):
+        self.close()
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                self._refresh()
+        except Exception as e:
+            logging.getLogger(__name__).warning(
+                'Background token refresh failed: {}'.format(e))
 
 
 class OAuth2Session(requests.Session):
@@ -56,6 +133,7 @@ class OAuth2Session(requests.Session):
     def request(self, *args, **kwargs):
         resp = super(OAuth2Session, self).request(*args, **kwargs)
         if resp.status_code == 401:
-            self.auth.authorize()
+            header = resp.request.headers.get('Authorization', '')
+            self.auth.authorize(header[len('Bearer '):] or None)
             resp = super(OAuth2Session, self).request(*args, **kwargs)
         return resp
@@ -1,101 +1,1007 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from collections import namedtuple
+from functools import partial
+import hashlib
+from itertools import islice
 import logging
 import os.path
 import tempfile
+import threading
+import time
+from urllib.parse import urljoin
 import uuid
 
 import rdflib
 import requests
 import stomp
 
-from minecart.archive import archive
+from minecart.archive import archive, CHUNK_SIZE, entry, Zip
+from minecart.concurrency import ordered_map
+from minecart.jsonstream import iter_array
+from minecart.manifest import Manifest, runs
+from minecart.metrics import Progress, registry
+from minecart.pcdm import extract_files, PCDMFile
+from minecart.scratch import InsufficientSpace
+
+
+#: Most bytes of headers, descriptor and directory entry per zip member,
+#: not counting the member name.
+ZIP_MEMBER_SIZE = 200
+#: Most bytes of end of central directory records in a zip.
+ZIP_END_SIZE = 100
+
+
+PDFHead = namedtuple('PDFHead', ['name', 'uri', 'length', 'etag',
+                                 'last_modified'])
+
+
+class CheckpointMismatch(Exception):
+    """Raised when a docset has changed since its package was checkpointed."""
 
 
-PCDMFile = namedtuple('PCDMFile', ['uri', 'mimetype'])
 PCDM = rdflib.namespace.Namespace('http://pcdm.org/models#')
 EBU = rdflib.namespace.Namespace(
         'http://www.ebu.ch/metadata/ontologies/ebucore/ebucore#')
 
 
-def document_set(url, session=None, fedora=None):
+def document_set(url, session=None, fedora=None, workers=1, cache=None,
+                 backend=None, members=None):
+    """Generate a :class:`Document` for each member of a docset.
+
+    Member metadata is fetched by ``backend``, which defaults to a
+    :class:`FedoraMetadata` for ``fedora`` with the given ``workers`` and
+    ``cache``. Documents are always yielded in member order. ``members``
+    may be given to use member refs already fetched with
+    :func:`docset_members` instead of fetching the docset again.
+    Otherwise members are streamed with :func:`iter_members`, so the
+    first documents are yielded while later pages of the docset are
+    still being fetched.
+    """
     session = session or requests.Session()
-    r = session.get(url)
-    r.raise_for_status()
-    for m in r.json().get('members'):
-        doc = get_item_meta(fedora + m['ref'], session=session)
-        yield Document(m['ref'], doc)
+    if members is None:
+        members = registry.timed(iter_members(url, session), 'docset_fetch')
+    backend = backend or FedoraMetadata(fedora, workers, cache)
+    yield from registry.timed(backend.documents(members, session),
+                              'metadata')
+
+
+def docset_members(url, session=None):
+    """Return the list of member refs of a docset."""
+    session = session or requests.Session()
+    return list(registry.timed(iter_members(url, session), 'docset_fetch'))
+
+
+def iter_members(url, session=None, chunk_size=64 * 1024):
+    """Generate the member refs of a docset as its pages are read.
+
+    The ``members`` array of each page is parsed as it is downloaded,
+    so memory use does not grow with the size of the docset. A docset
+    split into pages gives the URL of the next page either in a ``Link``
+    header with ``rel="next"`` or as ``next`` in the page's JSON.
+    """
+    session = session or requests.Session()
+    while url:
+        r = session.get(url, stream=True)
+        r.raise_for_status()
+        fields = {}
+        with closing(r):
+            for member in iter_array(r.iter_content(chunk_size), 'members',
+                                     fields):
+                yield member['ref']
+        url = r.links.get('next', {}).get('url') or fields.get('next')
+        if url:
+            url = urljoin(r.url, url)
+
+
+class FedoraMetadata:
+    """Metadata backend that fetches each member's N3 from Fedora.
+
+    Items are fetched with :func:`get_item_meta` by up to ``workers``
+    threads at a time, all sharing the session and its connection pool.
+    See :func:`get_item_meta` for ``cache``.
+    """
+    def __init__(self, fedora, workers=1, cache=None):
+        self.fedora = fedora
+        self.workers = workers
+        self.cache = cache
+
+    def documents(self, refs, session):
+        """Generate a :class:`Document` for each ref, in order."""
+        fetch = partial(_fetch_document, session=session, fedora=self.fedora,
+                        cache=self.cache)
+        yield from ordered_map(fetch, refs, self.workers)
+
+
+class SparqlMetadata:
+    """Metadata backend that queries a triplestore in batches.
+
+    The files and mimetypes of up to ``batch_size`` members are fetched
+    with a single query to the SPARQL ``endpoint``, instead of one
+    request per member. Members are identified by ``fedora`` plus their
+    ref, as in Fedora. A batch whose query fails, and any member the
+    triplestore has no files for, is fetched from ``fallback`` instead,
+    which defaults to a :class:`FedoraMetadata` for ``fedora``.
+    """
+    QUERY = (
+        'PREFIX pcdm: <{}>\n'
+        'PREFIX ebucore: <{}>\n'
+        'SELECT ?item ?file ?mimetype WHERE {{\n'
+        '  VALUES ?item {{ {} }}\n'
+        '  ?item pcdm:hasFile ?file .\n'
+        '  OPTIONAL {{ ?file ebucore:hasMimeType ?mimetype }}\n'
+        '}}'
+    )
+
+    def __init__(self, endpoint, fedora, batch_size=100, fallback=None):
+        self.endpoint = endpoint
+        self.fedora = fedora
+        self.batch_size = batch_size
+        self.fallback = fallback or FedoraMetadata(fedora)
+
+    def documents(self, refs, session):
+        """Generate a :class:`Document` for each ref, in order."""
+        logger = logging.getLogger(__name__)
+        refs = iter(refs)
+        while True:
+            batch = list(islice(refs, self.batch_size))
+            if not batch:
+                return
+            try:
+                files = self.query([self.fedora + ref for ref in batch],
+                                   session)
+            except Exception as e:
+                logger.warning('Falling back to Fedora for {} members after '
+                               'SPARQL error: {}'.format(len(batch), e))
+                files = {}
+            missing = [ref for ref in batch if self.fedora + ref not in files]
+            fetched = self.fallback.documents(missing, session)
+            for ref in batch:
+                if self.fedora + ref in files:
+                    yield Document.from_files(ref, files[self.fedora + ref])
+                else:
+                    yield next(fetched)
+
+    def query(self, uris, session):
+        """Return a dict of item URI to a list of :class:`PCDMFile`.
+
+        Items without files are left out.
+        """
+        values = ' '.join('<{}>'.format(uri) for uri in uris)
+        query = self.QUERY.format(PCDM, EBU, values)
+        r = session.post(self.endpoint, data={'query': query},
+                         headers={'Accept': 'application/sparql-results+json'})
+        r.raise_for_status()
+        files = {}
+        for row in r.json()['results']['bindings']:
+            mimetype = row.get('mimetype', {}).get('value')
+            files.setdefault(row['item']['value'], []).append(
+                PCDMFile(row['file']['value'], str(mimetype)))
+        return files
+
+
+def _fetch_document(ref, session, fedora, cache):
+    doc = get_item_meta(fedora + ref, session=session, cache=cache)
+    return Document(ref, doc)
 
 
 class Document:
+    """A docset member and its N3 metadata.
+
+    The PCDM files are read with :func:`minecart.pcdm.extract_files`,
+    falling back to a full ``rdflib`` parse for N3 it does not handle.
+    The full graph is only built if ``g`` is used.
+    """
+    __slots__ = ('name', 'data', '_g', '_files')
+
     def __init__(self, name, graph):
-        self.g = rdflib.Graph()
-        self.g.parse(data=graph, format='n3')
         self.name = name
+        self.data = graph
+        self._g = None
+        try:
+            self._files = extract_files(graph)
+        except ValueError:
+            self._files = None
+
+    @classmethod
+    def from_files(cls, name, files):
+        """Create a document from a list of :class:`PCDMFile` alone."""
+        doc = cls.__new__(cls)
+        doc.name = name
+        doc.data = None
+        doc._g = None
+        doc._files = list(files)
+        return doc
+
+    @property
+    def g(self):
+        if self._g is None:
+            g = rdflib.Graph()
+            if self.data is not None:
+                g.parse(data=self.data, format='n3')
+            self._g = g
+        return self._g
 
     @property
     def files(self):
+        if self._files is not None:
+            yield from self._files
+            return
         for o in self.g.objects(subject=None, predicate=PCDM.hasFile):
             mimetype = self.g.value(subject=o, predicate=EBU.hasMimeType,
                                     object=None, any=False)
             yield PCDMFile(uri=str(o), mimetype=str(mimetype))
 
 
-def get_item_meta(url, session=None):
+def get_item_meta(url, session=None, cache=None):
+    """Return the N3 representation of a Fedora item.
+
+    If a :class:`~minecart.cache.MetadataCache` is given, a cached copy
+    is revalidated with a conditional request, and is returned without
+    transferring the item again if Fedora reports it unchanged.
+    """
     session = session or requests.Session()
+    cached = cache.get(url) if cache is not None else None
+    r = session.get(url, headers=item_headers(cached))
+    if r.status_code == 304 and cached is not None:
+        return cached[2]
+    r.raise_for_status()
+    etag = r.headers.get('ETag')
+    modified = r.headers.get('Last-Modified')
+    if cache is not None and (etag or modified):
+        cache.put(url, etag, modified, r.text)
+    return r.text
+
+
+def item_headers(cached=None):
+    """Return the headers for requesting an item's N3 from Fedora.
+
+    ``cached`` is an ``(etag, last_modified, body)`` tuple from a
+    :class:`~minecart.cache.MetadataCache`, to make the request
+    conditional on the item having changed.
+    """
     headers = {
         'Accept': 'text/n3',
         'Prefer': 'return=representation; '
                   'include="http://fedora.info/definitions/v4/repository'
                   '#EmbedResources"',
     }
-    r = session.get(url, headers=headers)
-    r.raise_for_status()
-    return r.text
+    if cached is not None:
+        etag, modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if modified:
+            headers['If-Modified-Since'] = modified
+    return headers
 
 
-def create_package(url, session=None, fedora=None):
+def create_package(url, session=None, fedora=None, workers=1,
+                   chunk_size=CHUNK_SIZE, compress_workers=1, docs=None,
+                   filename=None, progress=None, engine=None):
+    """Build a zip of every PDF in a docset and return its filename.
+
+    Members are compressed by ``compress_workers`` threads. ``docs`` may
+    be given to use documents already fetched from the docset instead.
+    The zip is written to ``filename``, or to a new file in the temp
+    directory. Metadata and PDFs are fetched on ``engine``, an
+    :class:`~minecart.aio.AsyncEngine`, if one is given. See
+    :func:`write_package` for the other arguments.
+    """
     session = session or requests.Session()
-    tmp = tempfile.gettempdir()
-    archive_name = os.path.join(tmp, uuid.uuid4().hex) + '.zip'
-    with archive(archive_name) as arxv:
-        for doc in document_set(url, session, fedora):
-            for f in doc.files:
-                if f.mimetype == 'application/pdf':
-                    r = session.get(f.uri, stream=True)
-                    r.raise_for_status()
-                    with tempfile.NamedTemporaryFile() as f:
-                        for chunk in r.iter_content(chunk_size=1024):
-                            f.write(chunk)
-                        arxv.write(f.name, doc.name + '.pdf')
+    if docs is None:
+        backend = engine.metadata(fedora) if engine is not None else None
+        docs = document_set(url, session, fedora, workers, backend=backend)
+    archive_name = filename or \
+        os.path.join(tempfile.gettempdir(), uuid.uuid4().hex) + '.zip'
+    with archive(archive_name, workers=compress_workers) as arxv, \
+            registry.timer('package'):
+        write_package(arxv, docs, session, workers, chunk_size, progress,
+                      engine=engine)
     return archive_name
 
 
+def write_package(arxv, docs, session=None, workers=1,
+                  chunk_size=CHUNK_SIZE, progress=None, previous=None,
+                  read=None, done=(), checkpoint=None, engine=None,
+                  heads=None):
+    """Write the PDFs of ``docs`` to the :class:`~minecart.archive.Zip`.
+
+    PDF response bodies are streamed straight into the archive in reads
+    of ``chunk_size`` bytes. A pool of ``workers`` threads opens the
+    requests for upcoming PDFs while the calling thread writes the
+    current one, so request latency overlaps with archiving. Members
+    are always written in docset order. If any request fails the others
+    are abandoned and the error is raised.
+
+    Downloaded bytes are reported to ``progress``, a
+    :class:`~minecart.metrics.Progress`, if one is given.
+
+    A :class:`~minecart.manifest.Manifest` of the members written is
+    returned. If the manifest of an earlier package of the docset is
+    given as ``previous``, PDFs whose ETag and Last-Modified are the same
+    as when it was built are copied from it byte for byte rather than
+    downloaded and compressed again. ``read`` is called with the first
+    and last offsets of a range of the earlier package, and returns a
+    response streaming those bytes. Whether a PDF is unchanged is found
+    with a HEAD request, unless its :class:`PDFHead` is in ``heads``,
+    from :func:`head_pdfs`.
+
+    To continue a package that was cut short, reopen it and pass the
+    records of the members already in it, from its last checkpoint, as
+    ``done``. Those PDFs are skipped, and :class:`CheckpointMismatch` is
+    raised if they are no longer the first PDFs of ``docs``.
+    ``checkpoint`` is called with the records written so far after each
+    member.
+
+    PDFs are downloaded on an :class:`~minecart.aio.AsyncEngine` instead
+    of by threads if one is given as ``engine``.
+    """
+    session = session or requests.Session()
+    cancelled = threading.Event()
+    fetch = partial(_open_pdf, session=session, cancelled=cancelled)
+    pdfs = ((doc.name, f, None)
+            for doc in docs
+            for f in doc.files if f.mimetype == 'application/pdf')
+    if done:
+        pdfs = _skip_done(pdfs, done)
+    if previous is not None:
+        known = {(head.name, head.uri): head for head in heads or ()}
+        pdfs = ordered_map(partial(_reusable, session=session,
+                                   previous=previous, heads=known),
+                           ((name, f) for name, f, _ in pdfs), workers)
+    if engine is None:
+        responses = ordered_map(fetch, pdfs, workers, _close_response)
+    else:
+        responses = engine.open_pdfs(pdfs)
+    records = list(done)
+    copies = []
+    try:
+        for name, f, r in responses:
+            if isinstance(r, dict):
+                copies.append(r)
+                continue
+            if r is None:
+                continue
+            with closing(r):
+                if copies:
+                    _copy_members(arxv, copies, read, chunk_size, progress,
+                                  records, checkpoint)
+                    copies = []
+                chunks = registry.timed(r.iter_content(chunk_size),
+                                        'download', 'download_bytes')
+                if progress is not None:
+                    chunks = _reported(chunks, progress)
+                zinfo = arxv.write_stream(chunks, name + '.pdf',
+                                          _content_length(r), f.mimetype)
+            records.append({'name': name, 'uri': f.uri,
+                            'etag': r.headers.get('ETag'),
+                            'last_modified': r.headers.get('Last-Modified'),
+                            'entry': entry(zinfo)})
+            if checkpoint is not None:
+                checkpoint(records)
+        if copies:
+            _copy_members(arxv, copies, read, chunk_size, progress, records,
+                          checkpoint)
+    except BaseException:
+        cancelled.set()
+        raise
+    finally:
+        responses.close()
+    return Manifest.build(records, arxv.archive.start_dir)
+
+
+def _copy_members(arxv, members, read, chunk_size, progress, records,
+                  checkpoint=None):
+    """Copy members of an earlier package into ``arxv``.
+
+    Each run of members that lie back to back in the earlier package is
+    copied with a single ranged read. Their records are added to
+    ``records``.
+    """
+    for run in runs(members):
+        start = run[0]['entry']['header_offset']
+        end = run[-1]['entry']['header_offset'] + run[-1]['length']
+        r = read(start, end - 1)
+        chunks = registry.timed(r.iter_content(chunk_size), 'copy',
+                                'copy_bytes')
+        if progress is not None:
+            chunks = _reported(chunks, progress)
+        with closing(r):
+            infos = arxv.write_raw([m['entry'] for m in run], chunks)
+        for m, zinfo in zip(run, infos):
+            record = dict(m, entry=entry(zinfo))
+            del record['length']
+            records.append(record)
+        registry.count('members_copied', len(run))
+        if checkpoint is not None:
+            checkpoint(records)
+
+
+def _reported(chunks, progress):
+    for chunk in chunks:
+        progress.update(len(chunk))
+        yield chunk
+
+
+def head_pdfs(docs, session=None, workers=1):
+    """Return a :class:`PDFHead` for each PDF of ``docs``, in order.
+
+    Each PDF gets one HEAD request, made by up to ``workers`` threads.
+    The result can be given to :func:`package_digest`,
+    :func:`estimate_size` and :func:`write_package` so that none of
+    them make requests of their own.
+    """
+    session = session or requests.Session()
+    pdfs = [(doc.name, f.uri) for doc in docs for f in doc.files
+            if f.mimetype == 'application/pdf']
+    return list(ordered_map(partial(_head, session=session), pdfs,
+                            workers))
+
+
+def package_digest(docs, session=None, workers=1, heads=None):
+    """Return a digest identifying the package ``docs`` would build.
+
+    The digest covers each member ref along with the URI, ETag and
+    Last-Modified of each of its PDFs. These are taken from ``heads``,
+    or found with :func:`head_pdfs`. ``None`` is returned if any PDF has
+    neither header, as changes to it could not be detected.
+    """
+    if heads is None:
+        heads = head_pdfs(docs, session, workers)
+    digest = hashlib.sha256()
+    for head in heads:
+        if head.etag is None and head.last_modified is None:
+            return None
+        digest.update('{}\t{}\t{}\t{}\n'.format(
+            head.name, head.uri, head.etag, head.last_modified)
+            .encode('utf-8'))
+    return digest.hexdigest()
+
+
+def estimate_size(docs, session=None, workers=1, heads=None):
+    """Return an upper bound on the size of the package ``docs`` builds.
+
+    The size of each PDF is its Content-Length, taken from ``heads`` or
+    found with :func:`head_pdfs`, and allowance is made for zip headers
+    and for deflate expanding incompressible data. ``None`` is returned
+    if any PDF's size is unknown.
+    """
+    if heads is None:
+        heads = head_pdfs(docs, session, workers)
+    total = ZIP_END_SIZE
+    for head in heads:
+        if head.length is None:
+            return None
+        total += head.length + head.length // 1000 + ZIP_MEMBER_SIZE + \
+            2 * len(head.name + '.pdf')
+    return total
+
+
+def _head(pdf, session):
+    name, uri = pdf
+    r = session.head(uri, allow_redirects=True)
+    r.raise_for_status()
+    return PDFHead(name, uri, _content_length(r), r.headers.get('ETag'),
+                   r.headers.get('Last-Modified'))
+
+
+def _skip_done(pdfs, done):
+    """Yield the PDFs after those in ``done``, checking they match."""
+    pdfs = iter(pdfs)
+    for record in done:
+        name, f, _ = next(pdfs, (None, None, None))
+        if f is None or (record['name'], record['uri']) != (name, f.uri):
+            raise CheckpointMismatch('Docset has changed since it was '
+                                     'checkpointed')
+    yield from pdfs
+
+
+def _reusable(pdf, session, previous, heads):
+    """Return a PDF's name and file, and its member in ``previous`` if
+    it is unchanged and can be copied from there.
+
+    The PDF's validators are looked up in ``heads``, a dict of
+    :class:`PDFHead` by name and URI, or found with a HEAD request.
+    """
+    name, f = pdf
+    head = heads.get((name, f.uri)) or _head((name, f.uri), session)
+    return name, f, previous.reusable(name, head.uri, head.etag,
+                                      head.last_modified)
+
+
+def _open_pdf(pdf, session, cancelled):
+    """Start streaming a PDF, returning its name, file and the response.
+
+    The response is ``None`` if the job has been cancelled. A failed
+    request sets ``cancelled`` itself. If the PDF comes with a member to
+    copy from an earlier package, that is returned in place of the
+    response and no request is made.
+    """
+    name, f, member = pdf
+    if member is not None:
+        return name, f, member
+    if cancelled.is_set():
+        return name, f, None
+    r = None
+    try:
+        r = session.get(f.uri, stream=True)
+        r.raise_for_status()
+    except BaseException:
+        cancelled.set()
+        if r is not None:
+            r.close()
+        raise
+    return name, f, r
+
+
+def _close_response(pdf):
+    _, _, r = pdf
+    if r is not None and not isinstance(r, dict):
+        r.close()
+
+
+def _content_length(r):
+    length = r.headers.get('Content-Length')
+    if length is None or 'Content-Encoding' in r.headers:
+        return None
+    return int(length)
+
+
 class ApiListener(stomp.ConnectionListener):
-    def __init__(self, fedora, bucket, conn):
+    """Build and upload a package for each docset URL received.
+
+    With ``stream`` set, packages are zipped straight into a resumable
+    upload session instead of being built on local disk first.
+
+    Jobs run on the receiving thread unless ``workers`` is greater than
+    1, in which case up to ``workers`` jobs run at once in a thread pool.
+    Each job fetches item metadata with ``meta_workers`` threads,
+    downloads PDFs with ``download_workers`` threads and compresses
+    members on ``compress_workers`` threads. With ``ack`` set, each
+    message is acknowledged only when its job has finished, for use with
+    ``client-individual`` subscriptions and a broker prefetch limit.
+    Requests for a docset that is already being built join the running
+    job, and are each answered and acknowledged when it finishes.
+
+    Optional collaborators:
+
+    * ``cache``, a :class:`~minecart.cache.PackageCache`, answers a
+      request for an unchanged docset with the package built before.
+    * ``meta_cache``, a :class:`~minecart.cache.MetadataCache`, lets
+      item metadata be revalidated rather than fetched again.
+    * ``backend``, such as :class:`SparqlMetadata`, fetches metadata in
+      place of Fedora; given an :class:`~minecart.aio.AsyncEngine` as
+      ``engine``, metadata and PDFs are fetched on its event loop.
+    * ``scratch``, a :class:`~minecart.scratch.ScratchSpace`, holds
+      packages built on local disk, reserving each job's estimated size
+      before it starts. Jobs that cannot get space are dropped.
+    * ``scheduler``, a :class:`~minecart.scheduler.Scheduler`, orders
+      jobs by member count and by the user in the ``user_header``
+      message header.
+    * ``shards``, a :class:`~minecart.shard.ShardCoordinator`, builds
+      large docsets from shards built by any listener.
+    * ``manifests``, a :class:`~minecart.cache.ManifestStore`, keeps
+      the manifest of each docset's last package so that the next one
+      copies unchanged PDFs from it rather than downloading them.
+    * ``checkpoints``, a :class:`~minecart.cache.CheckpointStore`, saves
+      a build's progress every ``checkpoint_interval`` seconds and its
+      upload session, so a redelivered request carries on from there.
+
+    With ``progress_interval`` set, ``Progress:`` messages are sent to
+    the package queue at most that often, in seconds. Every job makes
+    its requests through ``session``, which should be mounted on
+    :class:`~minecart.connections.ConnectionPools` sized for the jobs
+    that may run at once.
+    """
+    def __init__(self, fedora, bucket, conn, stream=False, workers=1,
+                 ack=False, cache=None, meta_cache=None, backend=None,
+                 scratch=None, progress_interval=None, scheduler=None,
+                 user_header='user', shards=None, manifests=None,
+                 session=None,
+                 checkpoints=None, checkpoint_interval=30, engine=None,
+                 download_workers=1, meta_workers=1, compress_workers=1):
         self.fedora = fedora
         self.bucket = bucket
         self.conn = conn
+        self.stream = stream
+        self.ack = ack
+        self.cache = cache
+        self.meta_cache = meta_cache
+        self.backend = backend
+        self.scratch = scratch
+        self.progress_interval = progress_interval
+        self.scheduler = scheduler
+        self.user_header = user_header
+        self.pool = None
+        if workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        if shards is not None and shards.count > 1 and \
+                self.pool is None and scheduler is None:
+            raise ValueError('Sharded builds need more than one worker or '
+                             'a scheduler')
+        self.shards = shards
+        self.manifests = manifests
+        self.session = session or requests.Session()
+        self.checkpoints = checkpoints
+        self.checkpoint_interval = checkpoint_interval
+        self.engine = engine
+        self.download_workers = download_workers
+        self.meta_workers = meta_workers
+        self.compress_workers = compress_workers
+        if engine is not None and backend is None:
+            self.backend = engine.metadata(fedora, meta_cache)
+        self._jobs = {}
+        self._lock = threading.Lock()
 
     def on_message(self, headers, message):
-        logger = logging.getLogger(__name__)
+        if self.shards is not None and \
+                self.shards.on_message(self, headers, message):
+            return
         docset = message.strip()
         docset_id = docset.split('/')[-1].split('?')[0]
         queue = '/queue/package/' + docset_id
         self.conn.send(queue, 'Accepted.')
+        with self._lock:
+            if docset_id in self._jobs:
+                self._jobs[docset_id].append(headers)
+                return
+            self._jobs[docset_id] = [headers]
+        if self.scheduler is not None:
+            self._schedule(docset_id, docset, queue, headers)
+        elif self.pool is None:
+            self._run(docset_id, docset, queue)
+        else:
+            self.pool.submit(self._run, docset_id, docset, queue)
+
+    def close(self):
+        """Wait for running jobs to finish."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        if self.shards is not None:
+            self.shards.close()
+        if self.scheduler is not None:
+            self.scheduler.close()
+
+    def _schedule(self, docset_id, docset, queue, headers):
+        """Queue a job with the scheduler, costed by its member count.
+
+        If the docset cannot be fetched the job is finished at once.
+        """
         try:
-            arxv = create_package(docset, fedora=self.fedora)
+            members = docset_members(docset, self.session)
+        except Exception as e:
+            logging.getLogger(__name__).error(
+                'Error creating package for docset {}: {}'
+                .format(docset, e))
+            self._finish(docset_id, queue, None)
+            return
+        user = (headers or {}).get(self.user_header)
+        self.scheduler.submit(partial(self._run, docset_id, docset, queue,
+                                      members), len(members), user)
+
+    def _run(self, docset_id, docset, queue, members=None):
+        result = None
+        registry.count('jobs_started')
+        try:
+            with registry.timer('job'):
+                result = self._package(docset, queue, members)
+        finally:
+            self._finish(docset_id, queue, result)
+
+    def _finish(self, docset_id, queue, result):
+        registry.count('jobs_completed' if result is not None
+                       else 'jobs_failed')
+        with self._lock:
+            joined = self._jobs.pop(docset_id)
+        for headers in joined:
+            if result is not None:
+                self.conn.send(queue,
+                               'Complete: {}\nSize: {}'.format(*result))
+            if self.ack:
+                self.conn.ack(headers['message-id'], headers['subscription'])
+
+    def _package(self, docset, queue, members=None):
+        """Build and upload a package, returning its URL and size.
+
+        Errors are logged, and ``None`` is returned.
+        """
+        logger = logging.getLogger(__name__)
+        session = self.session
+        if self.shards is not None and self.shards.count > 1:
+            try:
+                if members is None:
+                    members = docset_members(docset, session)
+            except Exception as e:
+                logger.error('Error creating package for docset {}: {}'
+                             .format(docset, e))
+                return
+            if self.shards.splits(members):
+                return self.shards.build(self, docset, members)
+        docs = self._documents(docset, session, members)
+        digest = size = progress = heads = None
+        try:
+            if self.cache is not None:
+                docs = list(docs)
+                heads = head_pdfs(docs, session, self.download_workers)
+                digest = package_digest(docs, heads=heads)
+            hit = self.cache.get(digest) if digest else None
+            if hit is not None:
+                registry.count('cache_hits')
+                return hit
+            if self.progress_interval is not None or \
+                    (self.scratch is not None and not self.stream):
+                docs = list(docs)
+                if heads is None:
+                    heads = head_pdfs(docs, session, self.download_workers)
+                size = estimate_size(docs, heads=heads)
         except Exception as e:
             logger.error('Error creating package for docset {}: {}'
                          .format(docset, e))
             return
+        if self.progress_interval is not None:
+            progress = Progress(partial(self.conn.send, queue), size,
+                                self.progress_interval)
+        if self.stream:
+            result = self._stream_package(docset, session, docs, progress,
+                                          heads)
+        else:
+            result = self._upload_package(docset, session, docs, size,
+                                          progress, heads)
+        if result is None and self.manifests is not None:
+            self.manifests.delete(docset)
+        if result is not None and digest:
+            self.cache.put(digest, *result)
+        return result
+
+    def _upload_package(self, docset, session, docs, size=None,
+                        progress=None, heads=None):
+        logger = logging.getLogger(__name__)
+        state = self._resume(docset)
+        if self.scratch is None:
+            return self._build_and_upload(docset, session, docs,
+                                          progress=progress, state=state,
+                                          heads=heads)
+        try:
+            reservation = self.scratch.reserve(size)
+        except InsufficientSpace as e:
+            logger.error('Not enough space for docset {}: {}'
+                         .format(docset, e))
+            return
+        if state is not None:
+            reservation.path = state['filename']
+        with reservation:
+            try:
+                return self._build_and_upload(docset, session, docs,
+                                              reservation.path, progress,
+                                              state, heads)
+            finally:
+                # Leave the package for a later job to carry on from, if
+                # a checkpoint refers to it.
+                reservation.keep = self.checkpoints is not None and \
+                    self.checkpoints.get(docset) is not None
+
+    def _build_and_upload(self, docset, session, docs, filename=None,
+                          progress=None, state=None, heads=None):
+        """Build a package on disk and upload it, returning its URL and
+        size.
+
+        If ``state`` is a checkpoint from :meth:`_resume` the job is
+        continued from there. With checkpoints the package is left on
+        disk after an error, so the job can be continued later. If the
+        docset has changed since it was checkpointed, or storage has
+        dropped the upload session, the checkpoint is discarded and the
+        package built or uploaded afresh.
+        """
+        logger = logging.getLogger(__name__)
+        if state is not None:
+            filename = state['filename']
+        arxv = filename or \
+            os.path.join(tempfile.gettempdir(), uuid.uuid4().hex) + '.zip'
+        if state is None or state['stage'] == 'build':
+            try:
+                try:
+                    manifest = self._build(docset, arxv, session, docs,
+                                           progress, state, heads)
+                except CheckpointMismatch as e:
+                    logger.warning('Rebuilding package for docset {}: {}'
+                                   .format(docset, e))
+                    self._discard(docset, arxv)
+                    if not isinstance(docs, list):
+                        docs = self._documents(docset, session)
+                    manifest = self._build(docset, arxv, session, docs,
+                                           progress, heads=heads)
+            except Exception as e:
+                logger.error('Error creating package for docset {}: {}'
+                             .format(docset, e))
+                return
+            state = None
+        else:
+            manifest = Manifest(members=state['members'])
+        done = False
         try:
             size = os.stat(arxv).st_size
             blob = self.bucket.create(os.path.basename(arxv))
-            blob.upload(arxv)
-            self.conn.send(queue,
-                           'Complete: {}\nSize: {}'.format(blob.url, size))
+            location = None
+            if self.checkpoints is not None:
+                location = state and state.get('upload')
+                if location is None:
+                    location = self._upload_session(docset, blob, arxv, size,
+                                                    manifest)
+            try:
+                blob.upload(arxv, location=location)
+            except requests.HTTPError as e:
+                if state is None or e.response is None or \
+                        e.response.status_code not in (404, 410):
+                    raise
+                logger.warning('Upload session for docset {} has expired, '
+                               'starting a new one'.format(docset))
+                blob.upload(arxv, location=self._upload_session(
+                    docset, blob, arxv, size, manifest))
+            self._remember(docset, blob, manifest)
+            done = True
+            return blob.url, size
         except Exception as e:
             logger.error('Error uploading package for docset {}: {}'
                          .format(docset, e))
         finally:
-            os.remove(arxv)
+            if done or self.checkpoints is None:
+                os.remove(arxv)
+            if done and self.checkpoints is not None:
+                self.checkpoints.delete(docset)
+
+    def _build(self, docset, filename, session, docs, progress=None,
+               state=None, heads=None):
+        """Build a package at ``filename``, returning its manifest.
+
+        The package is built from scratch, or continued from the build
+        checkpoint ``state``.
+        """
+        if state is None:
+            arxv = Zip(filename, workers=self.compress_workers)
+            done = ()
+        else:
+            done = state['members']
+            arxv = Zip.reopen(filename, [r['entry'] for r in done],
+                              state['offset'], workers=self.compress_workers)
+            registry.count('jobs_resumed')
+        checkpoint = None
+        if self.checkpoints is not None:
+            checkpoint = _BuildCheckpoint(self.checkpoints, docset, filename,
+                                          arxv, self.checkpoint_interval)
+        try:
+            with registry.timer('package'):
+                manifest = write_package(arxv, docs, session,
+                                         self.download_workers,
+                                         progress=progress, done=done,
+                                         checkpoint=checkpoint,
+                                         engine=self.engine,
+                                         **self._previous(docset, heads))
+        except BaseException:
+            arxv.close()
+            if self.checkpoints is None:
+                os.remove(filename)
+            raise
+        arxv.close()
+        return manifest
+
+    def _upload_session(self, docset, blob, filename, size, manifest):
+        """Start an upload session for a package and checkpoint it."""
+        location = blob.resumable_session(size)
+        self.checkpoints.put(docset, {
+            'stage': 'upload', 'filename': filename, 'offset': size,
+            'members': manifest.members, 'upload': location})
+        return location
+
+    def _discard(self, docset, filename):
+        """Drop a docset's checkpoint and its partial package."""
+        self.checkpoints.delete(docset)
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def write_members(self, arxv, docset, members):
+        """Write ``members`` of a docset to ``arxv``, as for a shard."""
+        session = self.session
+        write_package(arxv, self._documents(docset, session, members),
+                      session, self.download_workers, engine=self.engine)
+
+    def _documents(self, docset, session, members=None):
+        return document_set(docset, session, self.fedora, self.meta_workers,
+                            cache=self.meta_cache, backend=self.backend,
+                            members=members)
+
+    def _resume(self, docset):
+        """Return the docset's checkpoint, if its job can be continued.
+
+        A checkpoint whose package is missing or shorter than it should
+        be is dropped.
+        """
+        if self.checkpoints is None:
+            return None
+        state = self.checkpoints.get(docset)
+        if state is None:
+            return None
+        try:
+            size = os.path.getsize(state['filename'])
+        except OSError:
+            size = -1
+        if size < state['offset']:
+            logging.getLogger(__name__).warning(
+                'Discarding checkpoint for docset {} as its package is '
+                'incomplete'.format(docset))
+            self.checkpoints.delete(docset)
+            return None
+        return state
+
+    def _stream_package(self, docset, session, docs, progress=None,
+                        heads=None):
+        logger = logging.getLogger(__name__)
+        blob = self.bucket.create(uuid.uuid4().hex + '.zip')
+        try:
+            with blob.open() as sink:
+                with closing(Zip(sink,
+                                 workers=self.compress_workers)) as arxv:
+                    manifest = write_package(arxv, docs, session,
+                                             self.download_workers,
+                                             progress=progress,
+                                             engine=self.engine,
+                                             **self._previous(docset, heads))
+            self._remember(docset, blob, manifest)
+            return blob.url, sink.size
+        except Exception as e:
+            logger.error('Error streaming package for docset {}: {}'
+                         .format(docset, e))
+
+    def _previous(self, docset, heads=None):
+        """Return the arguments for building on the docset's last package.
+
+        ``heads`` are the docset's :class:`PDFHead`, if already fetched.
+        If the last package is no longer in the bucket its manifest is
+        dropped, and the package is built afresh.
+        """
+        previous = None
+        if self.manifests is not None:
+            previous = self.manifests.get(docset)
+        if previous is None:
+            return {}
+        blob = self.bucket.create(previous.name)
+        if not blob.exists():
+            logging.getLogger(__name__).warning(
+                'Last package {} of docset {} is gone; building afresh'
+                .format(previous.name, docset))
+            self.manifests.delete(docset)
+            return {}
+        return {'previous': previous, 'read': blob.download, 'heads': heads}
+
+    def _remember(self, docset, blob, manifest):
+        if self.manifests is not None:
+            manifest.name = blob.name
+            self.manifests.put(docset, manifest)
+
+
+class _BuildCheckpoint:
+    """Saves a build's progress at most once every ``interval`` seconds.
+
+    Called with the records of the members written so far, it syncs the
+    package to disk and stores its offset and records in ``store``.
+    """
+    __slots__ = ('store', 'docset', 'filename', 'arxv', 'interval', 'saved')
+
+    def __init__(self, store, docset, filename, arxv, interval):
+        self.store = store
+        self.docset = docset
+        self.filename = filename
+        self.arxv = arxv
+        self.interval = interval
+        self.saved = time.monotonic()
+
+    def __call__(self, records):
+        now = time.monotonic()
+        if now - self.saved < self.interval:
+            return
+        self.arxv.sync()
+        self.store.put(self.docset, {
+            'stage': 'build', 'filename': self.filename,
+            'offset': self.arxv.archive.start_dir, 'members': records})
+        self.saved = now
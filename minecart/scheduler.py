@@ -0,0 +1,106 @@
+import itertools
+import logging
+import threading
+import time
+
+
+class Scheduler:
+    """Runs jobs in a fast lane and a bulk lane by their estimated cost.
+
+    Jobs costing at most ``threshold`` go to the fast lane, run by
+    ``fast_workers`` threads, and the rest to the bulk lane, run by
+    ``bulk_workers`` threads, so small jobs are not held up behind large
+    ones. Within a lane the cheapest job runs first, except that a job
+    which has waited ``max_wait`` seconds runs before any that have not,
+    so large jobs are not starved by a stream of smaller ones.
+
+    With ``fair`` set, jobs from the user with the fewest jobs running
+    are preferred, so one user submitting many jobs cannot hold up the
+    others.
+    """
+    def __init__(self, threshold, fast_workers=1, bulk_workers=1,
+                 max_wait=3600, fair=False):
+        self.threshold = threshold
+        self.max_wait = max_wait
+        self.fair = fair
+        self._cond = threading.Condition()
+        self._queues = {'fast': [], 'bulk': []}
+        self._running = {}
+        self._seq = itertools.count()
+        self._closed = False
+        self._threads = []
+        for lane, workers in (('fast', fast_workers),
+                              ('bulk', bulk_workers)):
+            for i in range(workers):
+                t = threading.Thread(target=self._work, args=(lane,),
+                                     name='{}-{}'.format(lane, i),
+                                     daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, func, cost, user=None):
+        """Queue ``func`` to be called with no arguments.
+
+        Returns the name of the lane the job was queued in.
+        """
+        lane = 'fast' if cost <= self.threshold else 'bulk'
+        job = _Job(func, cost, user, time.monotonic(), next(self._seq))
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Scheduler is closed')
+            self._queues[lane].append(job)
+            self._cond.notify_all()
+        return lane
+
+    def pending(self, lane):
+        """Return the number of jobs waiting in ``lane``."""
+        with self._cond:
+            return len(self._queues[lane])
+
+    def close(self):
+        """Run the jobs already queued, then stop the workers."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+    def _work(self, lane):
+        while True:
+            with self._cond:
+                while not self._queues[lane] and not self._closed:
+                    self._cond.wait()
+                if not self._queues[lane]:
+                    return
+                job = self._next(lane)
+                self._running[job.user] = self._running.get(job.user, 0) + 1
+            try:
+                job.func()
+            except Exception as e:
+                logging.getLogger(__name__).error(
+                    'Error running scheduled job: {}'.format(e))
+            finally:
+                with self._cond:
+                    self._running[job.user] -= 1
+
+    def _next(self, lane):
+        queue = self._queues[lane]
+        now = time.monotonic()
+        job = min(queue, key=lambda j: (
+            now - j.submitted < self.max_wait,
+            self._running.get(j.user, 0) if self.fair else 0,
+            j.seq if now - j.submitted >= self.max_wait else j.cost,
+            j.seq))
+        queue.remove(job)
+        return job
+
+
+class _Job:
+    __slots__ = ('func', 'cost', 'user', 'submitted', 'seq')
+
+    def __init__(self, func, cost, user, submitted, seq):
+        self.func = func
+        self.cost = cost
+        self.user = user
+        self.submitted = submitted
+        self.seq = seq
@@ -0,0 +1,153 @@
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+
+
+#: Names of the packages built in scratch directories.
+PACKAGE_NAME = re.compile(r'^[0-9a-f]{32}\.zip$')
+
+
+class InsufficientSpace(Exception):
+    """Raised when a package will not fit in any scratch directory."""
+
+
+class ScratchSpace:
+    """Admission control for packages built on local disk.
+
+    Packages are built in one of ``dirs``, such as a tmpfs and then a
+    disk, each of which keeps ``headroom`` bytes free. A job reserves
+    space for its estimated size with :meth:`reserve` before it starts,
+    and is given the first directory the package fits in. Jobs that do
+    not fit anywhere right now wait for others to finish, for up to
+    ``timeout`` seconds, while jobs that could not fit even with every
+    other job finished are rejected at once.
+
+    Packages orphaned by a previous run are removed from every directory
+    when the space is created, unless ``cleanup`` is false. Only files
+    named like the packages this program builds are removed, and none
+    whose path is in ``keep``, such as packages a checkpoint refers to.
+    """
+    #: Seconds between checks of free space while waiting.
+    poll_interval = 1.0
+
+    def __init__(self, dirs, headroom=0, timeout=None, cleanup=True,
+                 keep=()):
+        self.dirs = list(dirs)
+        self.headroom = headroom
+        self.timeout = timeout
+        self._reservations = []
+        self._cond = threading.Condition()
+        if cleanup:
+            for d in self.dirs:
+                self.cleanup(d, keep)
+
+    def cleanup(self, dirname, keep=()):
+        """Remove orphaned packages from ``dirname``, except ``keep``."""
+        logger = logging.getLogger(__name__)
+        keep = {os.path.realpath(path) for path in keep}
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            if PACKAGE_NAME.match(name) and os.path.isfile(path) and \
+                    os.path.realpath(path) not in keep:
+                logger.info('Removing orphaned package {}'.format(path))
+                os.remove(path)
+
+    def reserve(self, size):
+        """Reserve ``size`` bytes, returning a :class:`Reservation`.
+
+        A ``size`` of ``None`` means the size is unknown, and only picks
+        the directory with the most space available. Blocks until the
+        space is free, and raises :class:`InsufficientSpace` if it never
+        will be or if ``timeout`` passes first.
+        """
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                dirname = self._fit(size)
+                if dirname is not None:
+                    reservation = Reservation(self, dirname, size or 0)
+                    self._reservations.append(reservation)
+                    return reservation
+                if not any(self._capacity(d) >= size for d in self.dirs):
+                    raise InsufficientSpace(
+                        'No scratch directory has room for {} bytes'
+                        .format(size))
+                wait = self.poll_interval
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        raise InsufficientSpace(
+                            'Timed out waiting for {} bytes of scratch '
+                            'space'.format(size))
+                self._cond.wait(wait)
+
+    def available(self, dirname):
+        """Bytes in ``dirname`` not yet written or reserved."""
+        with self._cond:
+            return self._available(dirname)
+
+    def _fit(self, size):
+        if size is None:
+            return max(self.dirs, key=self._available)
+        for d in self.dirs:
+            if self._available(d) >= size:
+                return d
+
+    def _available(self, dirname):
+        """Free space less headroom and the unwritten part of reservations.
+
+        Reservations already partly written are counted by what is left,
+        since what was written is no longer free.
+        """
+        outstanding = sum(r.size - min(r.written(), r.size)
+                          for r in self._reservations if r.dir == dirname)
+        return shutil.disk_usage(dirname).free - self.headroom - outstanding
+
+    def _capacity(self, dirname):
+        """Space ``dirname`` would have with no other jobs running."""
+        written = sum(r.written() for r in self._reservations
+                      if r.dir == dirname)
+        return shutil.disk_usage(dirname).free + written - self.headroom
+
+    def _release(self, reservation):
+        with self._cond:
+            self._reservations.remove(reservation)
+            self._cond.notify_all()
+
+
+class Reservation:
+    """Space reserved for one package in a scratch directory.
+
+    Build the package at :attr:`path`, and release the space by leaving
+    the ``with`` block, which also removes the package if it still
+    exists, unless :attr:`keep` is set.
+    """
+    def __init__(self, space, dirname, size):
+        self.space = space
+        self.dir = dirname
+        self.size = size
+        self.path = os.path.join(dirname, uuid.uuid4().hex) + '.zip'
+        self.keep = False
+
+    def written(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def release(self):
+        if not self.keep and os.path.isfile(self.path):
+            os.remove(self.path)
+        self.space._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
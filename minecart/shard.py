@@ -0,0 +1,269 @@
+"""Building one package from shards built by several workers.
+
+A coordinator splits a docset's members into shards with :func:`split`
+and publishes each as a sub-job. A worker builds the members of its
+shard into a zip with :func:`build_shard` and uploads only the local
+file records, leaving off the central directory, as a part object. It
+reports the part's size and its :func:`entries`.
+
+Once every part is uploaded, the coordinator writes a central directory
+for all of the entries with :func:`central_directory`, offsetting each
+by the size of the parts before it, and composes the parts and the
+directory into the final zip in storage. :class:`ShardCoordinator` does
+both jobs for an :class:`~minecart.packager.ApiListener`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+import logging
+import os.path
+import tempfile
+import threading
+import uuid
+import zipfile
+
+from minecart.archive import archive, entry, zipinfo
+from minecart.upload import MAX_COMPOSE_SOURCES
+
+
+class ShardCoordinator:
+    """Splits a listener's large docsets into shards built by any listener.
+
+    Docsets of at least ``threshold`` members are split into ``count``
+    shards, which are sent as sub-jobs to ``queue``. Each is built into
+    a part object by whichever listener receives it, which replies to
+    this coordinator's ``result_queue``; that queue must be subscribed
+    to along with the request queue. When every part is in, the parts
+    are composed into the package along with a central directory
+    covering all of them. If they are not all in after ``timeout``
+    seconds the build fails. Either way the parts are deleted, as are
+    any that arrive late.
+
+    Sub-jobs received are built by ``workers`` threads, or on the
+    receiving thread if ``workers`` is less than 2. Sharded builds do
+    not use the package cache, scratch space or progress messages.
+    """
+    def __init__(self, count=1, threshold=0, queue='/queue/shards',
+                 workers=0, timeout=3600):
+        if count >= MAX_COMPOSE_SOURCES:
+            raise ValueError('At most {} shards can be composed'
+                             .format(MAX_COMPOSE_SOURCES - 1))
+        self.count = count
+        self.threshold = threshold
+        self.queue = queue
+        self.timeout = timeout
+        self.result_queue = '/queue/shard-results/' + uuid.uuid4().hex
+        self.pool = None
+        if workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def splits(self, members):
+        """Return whether a docset of ``members`` is built in shards."""
+        return self.count > 1 and len(members) >= self.threshold
+
+    def on_message(self, listener, headers, message):
+        """Handle a sub-job or result, returning whether it was one."""
+        destination = (headers or {}).get('destination')
+        if destination == self.queue:
+            job = json.loads(message)
+            if self.pool is None:
+                self._build_part(listener, headers, job)
+            else:
+                self.pool.submit(self._build_part, listener, headers, job)
+            return True
+        if destination == self.result_queue:
+            self._on_result(listener, json.loads(message))
+            return True
+        return False
+
+    def build(self, listener, docset, members):
+        """Build a package from shards, returning its URL and size.
+
+        Errors are logged, and ``None`` is returned.
+        """
+        logger = logging.getLogger(__name__)
+        job_id = uuid.uuid4().hex
+        shards = split(members, self.count)
+        job = _SplitJob(len(shards))
+        parts = [listener.bucket.create('{}.shard{}'.format(job_id, i))
+                 for i in range(len(shards))]
+        with self._lock:
+            self._jobs[job_id] = job
+        uploaded = []
+        try:
+            for i, refs in enumerate(shards):
+                listener.conn.send(self.queue, json.dumps({
+                    'job': job_id, 'shard': i, 'docset': docset,
+                    'members': refs, 'part': parts[i].name,
+                    'reply': self.result_queue}))
+            if not job.done.wait(self.timeout):
+                raise Exception('Timed out waiting for shards')
+            results = [job.results[i] for i in range(len(shards))]
+            errors = [r['error'] for r in results if 'error' in r]
+            if errors:
+                raise Exception(errors[0])
+            directory = central_directory([(r['size'], r['entries'])
+                                           for r in results])
+            cd = listener.bucket.create(job_id + '.cd')
+            with cd.open() as sink:
+                sink.write(directory)
+            uploaded.append(cd)
+            blob = listener.bucket.create(job_id + '.zip')
+            blob.compose([part for part, r in zip(parts, results)
+                          if r['size']] + [cd])
+            return blob.url, sum(r['size'] for r in results) + \
+                len(directory)
+        except Exception as e:
+            logger.error('Error building sharded package for docset {}: {}'
+                         .format(docset, e))
+        finally:
+            # Parts that arrive after this are deleted by _on_result.
+            with self._lock:
+                del self._jobs[job_id]
+                uploaded.extend(part for i, part in enumerate(parts)
+                                if job.results.get(i, {}).get('size'))
+            for part in uploaded:
+                _delete(part)
+
+    def close(self):
+        """Wait for sub-jobs being built to finish."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+
+    def _build_part(self, listener, headers, job):
+        """Build one shard into a part object and reply with its entries."""
+        logger = logging.getLogger(__name__)
+        reply = {'job': job['job'], 'shard': job['shard'],
+                 'part': job['part']}
+        try:
+            filename, size, entries = build_shard(
+                partial(listener.write_members, docset=job['docset'],
+                        members=job['members']),
+                workers=listener.compress_workers)
+            try:
+                if size:
+                    listener.bucket.create(job['part']).upload(filename,
+                                                               length=size)
+            finally:
+                os.remove(filename)
+            reply.update(size=size, entries=entries)
+        except Exception as e:
+            logger.error('Error building shard {} of docset {}: {}'
+                         .format(job['shard'], job['docset'], e))
+            reply['error'] = str(e)
+        listener.conn.send(job['reply'], json.dumps(reply))
+        if listener.ack:
+            listener.conn.ack(headers['message-id'], headers['subscription'])
+
+    def _on_result(self, listener, result):
+        with self._lock:
+            job = self._jobs.get(result['job'])
+            if job is not None:
+                job.results[result['shard']] = result
+                if len(job.results) == job.count:
+                    job.done.set()
+                return
+        if result.get('size') and 'part' in result:
+            _delete(listener.bucket.create(result['part']))
+
+
+class _SplitJob:
+    __slots__ = ('count', 'results', 'done')
+
+    def __init__(self, count):
+        self.count = count
+        self.results = {}
+        self.done = threading.Event()
+
+
+def _delete(part):
+    try:
+        part.delete()
+    except Exception as e:
+        logging.getLogger(__name__).warning(
+            'Could not delete part {}: {}'.format(part.name, e))
+
+
+def split(members, count):
+    """Split ``members`` into at most ``count`` contiguous shards.
+
+    Shards differ in size by at most one member, and none are empty.
+    """
+    size, extra = divmod(len(members), count)
+    shards = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        if end > start:
+            shards.append(members[start:end])
+        start = end
+    return shards
+
+
+def build_shard(write, **kwargs):
+    """Build a shard, returning its filename, size and entries.
+
+    ``write`` is called with a :class:`~minecart.archive.Zip` to add the
+    members to, and other keyword arguments are passed to the zip. The
+    size returned is that of the local file records alone, which is all
+    of the file that belongs in the part.
+    """
+    filename = os.path.join(tempfile.gettempdir(), uuid.uuid4().hex) + '.zip'
+    with archive(filename, **kwargs) as arxv:
+        write(arxv)
+        zf = arxv.archive
+    return filename, zf.start_dir, entries(zf.filelist)
+
+
+def entries(filelist):
+    """Return members' directory entries as JSON serializable dicts."""
+    return [entry(zinfo) for zinfo in filelist]
+
+
+def central_directory(parts):
+    """Return the central directory for a zip composed of ``parts``.
+
+    ``parts`` is a list of ``(size, entries)`` pairs, in the order the
+    parts are composed. ZIP64 records are written if they are needed.
+    """
+    filelist = []
+    offset = 0
+    for size, part_entries in parts:
+        for part_entry in part_entries:
+            zinfo = zipinfo(part_entry)
+            zinfo.header_offset += offset
+            filelist.append(zinfo)
+        offset += size
+    out = _OffsetWriter(offset)
+    zf = zipfile.ZipFile(out, mode='w')
+    zf.filelist = filelist
+    zf.close()
+    return bytes(out.data)
+
+
+class _OffsetWriter:
+    """A file that collects what is written to it from ``offset`` on.
+
+    This lets :class:`zipfile.ZipFile` write a central directory as if
+    the parts before it were in the same file.
+    """
+    def __init__(self, offset):
+        self.offset = offset
+        self.data = bytearray()
+
+    def tell(self):
+        return self.offset + len(self.data)
+
+    def seek(self, pos, whence=0):
+        if whence != 0 or pos != self.tell():
+            raise OSError('Cannot seek in a central directory')
+        return pos
+
+    def write(self, data):
+        self.data.extend(data)
+        return len(data)
+
+    def flush(self):
+        pass
@@ -1,15 +1,40 @@
+from functools import partial
+import logging
 import os.path
+import random
+import time
 
 import requests
 
+from minecart.concurrency import ordered_map
+from minecart.metrics import registry
+
+
+#: Resumable upload chunks must be a multiple of this size.
+CHUNK_MULTIPLE = 256 * 1024
+UPLOAD_CHUNK_SIZE = 32 * CHUNK_MULTIPLE
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+#: The most source objects a single compose request accepts.
+MAX_COMPOSE_SOURCES = 32
+
+
+class TransientUploadError(Exception):
+    pass
+
 
 class Client:
     def __init__(self, session=None,
                  url='https://www.googleapis.com/storage/v1',
-                 upload_url='https://www.googleapis.com/upload/storage/v1'):
+                 upload_url='https://www.googleapis.com/upload/storage/v1',
+                 retries=5, backoff=1.0, composite_threshold=None,
+                 composite_parts=8):
         self.session = session or requests.Session()
         self.url = url
         self.upload_url = upload_url
+        self.retries = retries
+        self.backoff = backoff
+        self.composite_threshold = composite_threshold
+        self.composite_parts = min(composite_parts, MAX_COMPOSE_SOURCES)
 
     def get(self, bucket):
         return Bucket(bucket, client=self)
@@ -49,25 +74,141 @@ class BucketObject:
     def url(self):
         return self.bucket.url + '/o/' + self.name
 
-    def upload(self, file_obj):
-        if isinstance(file_obj, str):
-            with open(file_obj, 'rb') as f:
-                self._upload_bytes(f)
-        else:
-            self._upload_bytes(file_obj)
+    def upload(self, file_obj, chunk_size=UPLOAD_CHUNK_SIZE, length=None,
+               location=None):
+        """Upload a file, given its name or a file object.
 
-    def _upload_bytes(self, fp):
-        size = os.fstat(fp.fileno()).st_size
-        location = self._resumable_session(size)
-        resp = self.client.request('PUT', location, data=fp)
+        Only the first ``length`` bytes of the file are uploaded if
+        ``length`` is given.
+
+        If the URI of a session from :meth:`resumable_session` is given
+        as ``location``, the file is sent to that session, starting after
+        the bytes it has already committed.
+
+        The file is sent in chunks of ``chunk_size`` bytes through a
+        :class:`ResumableUpload`, so transient failures only cost the
+        chunk in flight.
+
+        Files of at least the client's ``composite_threshold`` bytes are
+        split into ``composite_parts`` ranges that are uploaded in
+        parallel as temporary objects, which are then composed into this
+        object and deleted.
+        """
+        with registry.timer('upload'):
+            if isinstance(file_obj, str):
+                with open(file_obj, 'rb') as f:
+                    self._upload_bytes(f, chunk_size, length, location)
+            else:
+                self._upload_bytes(file_obj, chunk_size, length, location)
+
+    def open(self, chunk_size=UPLOAD_CHUNK_SIZE):
+        """Return a writable stream that uploads to this object.
+
+        See :class:`UploadStream`.
+        """
+        upload = ResumableUpload(self.client, self.resumable_session())
+        return UploadStream(upload, chunk_size)
+
+    def download(self, start=None, end=None):
+        """Return a streaming response for the object's content.
+
+        If ``start`` is given only bytes ``start`` to ``end``, inclusive,
+        are requested.
+        """
+        headers = {}
+        if start is not None:
+            headers['Range'] = 'bytes={}-{}'.format(
+                start, '' if end is None else end)
+        resp = self.client.request('GET', self.url, params={'alt': 'media'},
+                                   headers=headers, stream=True)
+        resp.raise_for_status()
+        return resp
+
+    def exists(self):
+        """Return whether the object is in the bucket."""
+        resp = self.client.request('GET', self.url)
+        if resp.status_code == 404:
+            return False
         resp.raise_for_status()
+        return True
 
-    def _resumable_session(self, filesize):
+    def delete(self):
+        resp = self.client.request('DELETE', self.url)
+        resp.raise_for_status()
+
+    def compose(self, sources):
+        """Replace this object with the concatenation of ``sources``.
+
+        ``sources`` is a list of :class:`BucketObject` in the same bucket.
+        """
+        body = {
+            'sourceObjects': [{'name': src.name} for src in sources],
+            'destination': {'contentType': 'application/zip'},
+        }
+        resp = self.client.request('POST', self.url + '/compose', json=body)
+        resp.raise_for_status()
+
+    def _upload_bytes(self, fp, chunk_size, length=None, location=None):
+        _check_chunk_size(chunk_size)
+        size = os.fstat(fp.fileno()).st_size
+        if length is not None:
+            size = min(size, length)
+        threshold = self.client.composite_threshold
+        if location is None and threshold is not None and \
+                size >= threshold and self.client.composite_parts > 1:
+            self._upload_composite(fp.fileno(), size, chunk_size)
+        else:
+            self._upload_range(fp.fileno(), 0, size, chunk_size, location)
+
+    def _upload_range(self, fd, start, size, chunk_size, location=None):
+        offset = 0
+        if location is None:
+            upload = ResumableUpload(self.client,
+                                     self.resumable_session(size))
+        else:
+            upload = ResumableUpload(self.client, location)
+            offset = upload.status(size)
+            if offset >= size:
+                return
+        while True:
+            data = os.pread(fd, min(chunk_size, size - offset),
+                            start + offset)
+            upload.put(data, offset, size)
+            offset += len(data)
+            if offset >= size:
+                break
+
+    def _upload_composite(self, fd, size, chunk_size):
+        count = self.client.composite_parts
+        part_size = -(-size // count)
+        parts = [(self.bucket.create('{}.part{}'.format(self.name, i)),
+                  i * part_size, min(part_size, size - i * part_size))
+                 for i in range(count) if i * part_size < size]
+        send = partial(_upload_part, fd=fd, chunk_size=chunk_size)
+        try:
+            for _ in ordered_map(send, parts, len(parts)):
+                pass
+            self.compose([part for part, _, _ in parts])
+        finally:
+            for part, _, _ in parts:
+                try:
+                    part.delete()
+                except Exception as e:
+                    logging.getLogger(__name__).warning(
+                        'Could not delete part {}: {}'.format(part.name, e))
+
+    def resumable_session(self, filesize=None):
+        """Start a resumable upload session, returning its URI.
+
+        The URI may be passed to :meth:`upload` to continue the upload
+        later, even from another process.
+        """
         headers = {
             'X-Upload-Content-Type': 'application/zip',
-            'X-Upload-Content-Length': str(filesize),
             'Content-Length': '0',
         }
+        if filesize is not None:
+            headers['X-Upload-Content-Length'] = str(filesize)
         params = {
             'uploadType': 'resumable',
             'name': self.name,
@@ -77,3 +218,174 @@ class BucketObject:
         if resp.status_code != 200:
             raise Exception('Error creating resumable session')
         return resp.headers['Location']
+
+
+def _upload_part(part, fd, chunk_size):
+    obj, start, size = part
+    obj._upload_range(fd, start, size, chunk_size)
+
+
+def _check_chunk_size(chunk_size):
+    if chunk_size <= 0 or chunk_size % CHUNK_MULTIPLE:
+        raise ValueError('chunk_size must be a positive multiple of '
+                         '{} bytes'.format(CHUNK_MULTIPLE))
+
+
+class ResumableUpload:
+    """Sends chunks of data to a resumable upload session.
+
+    A chunk that fails with a connection error or a retryable status is
+    retried with exponential backoff, up to the client's ``retries``.
+    Before each retry the session is asked how much it has already
+    committed, and only the remainder of the chunk is sent again.
+    """
+    def __init__(self, client, location):
+        self.client = client
+        self.location = location
+
+    def put(self, data, offset, total=None):
+        """Send ``data`` as the bytes starting at ``offset``.
+
+        ``total`` is the size of the whole upload, and must be given
+        with the final chunk.
+        """
+        logger = logging.getLogger(__name__)
+        end = offset + len(data)
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                committed = self._put(data, offset, total)
+            except (requests.ConnectionError, requests.Timeout,
+                    TransientUploadError) as e:
+                attempt += 1
+                if attempt > self.client.retries:
+                    raise
+                registry.count('upload_retries')
+                logger.warning('Retrying upload chunk at byte {} after '
+                               'error: {}'.format(offset, e))
+                time.sleep(self._delay(attempt))
+                try:
+                    committed = self.status(total)
+                except (requests.ConnectionError, requests.Timeout,
+                        TransientUploadError):
+                    continue
+            else:
+                elapsed = time.perf_counter() - start
+                registry.observe('upload_chunk', elapsed)
+                registry.count('upload_bytes', committed - offset)
+                logger.debug('Uploaded bytes {}-{} at {:.2f} MB/s'.format(
+                    offset, committed, (committed - offset) /
+                    max(elapsed, 1e-6) / 1e6))
+            if committed >= end:
+                return committed
+            if committed < offset:
+                raise Exception('Upload session lost committed data')
+            data = data[committed - offset:]
+            offset = committed
+
+    def status(self, total=None):
+        """Return the number of bytes the session has committed."""
+        return self._put(b'', None, total)
+
+    def abort(self):
+        """Cancel the upload session."""
+        self.client.request('DELETE', self.location)
+
+    def _put(self, data, offset, total):
+        if data:
+            crange = 'bytes {}-{}/{}'.format(offset, offset + len(data) - 1,
+                                             '*' if total is None else total)
+        else:
+            crange = 'bytes */{}'.format('*' if total is None else total)
+        resp = self.client.request('PUT', self.location, data=data,
+                                   headers={'Content-Range': crange})
+        if resp.status_code in (200, 201):
+            return total
+        if resp.status_code == 308:
+            committed = resp.headers.get('Range')
+            if committed is None:
+                return 0
+            return int(committed.split('-')[-1]) + 1
+        if resp.status_code in RETRY_STATUSES:
+            raise TransientUploadError('Upload chunk failed with status {}'
+                                       .format(resp.status_code))
+        resp.raise_for_status()
+        raise Exception('Unexpected response to upload chunk: {}'
+                        .format(resp.status_code))
+
+    def _delay(self, attempt):
+        return self.client.backoff * (2 ** (attempt - 1) + random.random())
+
+
+class UploadStream:
+    """Write-only file object backed by a resumable upload session.
+
+    Written bytes are buffered and sent to the session in chunks of
+    ``chunk_size`` bytes as soon as each chunk fills, so at most one
+    chunk is held in memory. The total size is not known in advance; it
+    is sent with the final chunk when the stream is closed. If the
+    stream is used as a context manager and an exception is raised, the
+    upload session is cancelled instead.
+
+    The stream is not seekable, which ``zipfile.ZipFile`` supports by
+    writing data descriptors after each member.
+    """
+    def __init__(self, upload, chunk_size=UPLOAD_CHUNK_SIZE):
+        _check_chunk_size(chunk_size)
+        self.upload = upload
+        self.chunk_size = chunk_size
+        self.closed = False
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def size(self):
+        """Number of bytes written to the stream so far."""
+        return self._offset + len(self._buffer)
+
+    def tell(self):
+        return self.size
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed upload stream')
+        self._buffer.extend(data)
+        while len(self._buffer) >= self.chunk_size:
+            self._send(self.chunk_size)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Send any buffered data along with the total size."""
+        if self.closed:
+            return
+        self._send(len(self._buffer), total=self.size)
+        self.closed = True
+
+    def abort(self):
+        """Cancel the upload session, discarding anything sent."""
+        if self.closed:
+            return
+        self.closed = True
+        self._buffer = bytearray()
+        self.upload.abort()
+
+    def _send(self, length, total=None):
+        self.upload.put(bytes(self._buffer[:length]), self._offset, total)
+        del self._buffer[:length]
+        self._offset += length
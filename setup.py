@@ -21,6 +21,9 @@ setup(
     author_email='mgraves@mit.edu',
     packages=find_packages(exclude=['tests']),
     install_requires=install_requires,
+    extras_require={
+        'async': ['aiohttp'],
+    },
     entry_points={
         'console_scripts': [
             'minecart = minecart.cli:main',
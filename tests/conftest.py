@@ -5,6 +5,8 @@ import tempfile
 
 import pytest
 
+from tests.standins import GCS
+
 
 @pytest.yield_fixture(scope="session", autouse=True)
 def temp_dir():
@@ -27,3 +29,15 @@ def clean_temp(temp_dir):
 
         except:
             pass
+
+
+@pytest.yield_fixture
+def gcs():
+    with GCS() as standin:
+        yield standin
+
+
+@pytest.yield_fixture
+def cache_db():
+    with tempfile.NamedTemporaryFile() as fp:
+        yield fp.name
@@ -0,0 +1,575 @@
+"""Local stand-ins for the services minecart talks to.
+
+These are small threaded HTTP and STOMP servers bound to an ephemeral
+port on localhost. They are used by tests that need real sockets (connection
+pooling, concurrency) and by the scripts in ``benchmarks/``.
+"""
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import itertools
+import json
+import random
+import re
+from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from minecart.pcdm import extract_files
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Accept bursts of connections from many concurrent clients.
+    request_queue_size = 1024
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.standin.handle(self)
+
+    do_HEAD = do_POST = do_PUT = do_DELETE = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+class StandIn:
+    """Base class for a local HTTP stand-in.
+
+    Subclasses implement :meth:`respond`, returning a tuple of
+    ``(status, headers, body)``. Every request is delayed by ``latency``
+    seconds before it is answered, and with ``bandwidth`` set, request
+    and response bodies are limited to that many bytes per second. A
+    fraction ``error_rate`` of requests, chosen at random from ``seed``,
+    fail with a 503 instead of being answered.
+    """
+    #: Size of the pieces response bodies are written in.
+    write_size = 64 * 1024
+
+    def __init__(self, latency=0, bandwidth=None, error_rate=0, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.errors = 0
+        self._random = random.Random(seed)
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, handler):
+        length = int(handler.headers.get('Content-Length') or 0)
+        handler.body = handler.rfile.read(length)
+        with self._lock:
+            self.requests.append((handler.command, handler.path))
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        self._throttle(length)
+        if fail:
+            status, headers, body = 503, {}, b''
+        else:
+            status, headers, body = self.respond(handler)
+        handler.send_response(status)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            view = memoryview(body)
+            for i in range(0, len(body), self.write_size):
+                piece = view[i:i + self.write_size]
+                self._throttle(len(piece))
+                handler.wfile.write(piece)
+
+    def _throttle(self, nbytes):
+        if self.bandwidth and nbytes:
+            time.sleep(nbytes / self.bandwidth)
+
+    def respond(self, handler):
+        raise NotImplementedError
+
+
+class Fedora(StandIn):
+    """Stand-in for the docset API, Fedora and bitstream hosting.
+
+    ``docsets`` maps a docset id to a list of member refs, ``items`` maps
+    a ref to its N3 representation and ``files`` maps a file name to its
+    bytes. They are served at ``/docset/<id>``, ``/fedora/<ref>`` and
+    ``/files/<name>`` respectively, files with an ETag of their MD5.
+    With ``page_size`` set, docsets are served in pages of that many
+    members, each linking to the next.
+    """
+    def __init__(self, docsets=None, items=None, files=None, page_size=None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.page_size = page_size
+        self.docsets = docsets or {}
+        self.items = items or {}
+        self.files = files or {}
+
+    @property
+    def fedora(self):
+        return self.url + '/fedora/'
+
+    def docset_url(self, docset_id):
+        return '{}/docset/{}'.format(self.url, docset_id)
+
+    def file_url(self, name):
+        return '{}/files/{}'.format(self.url, name)
+
+    def respond(self, handler):
+        parts = urlsplit(handler.path)
+        _, kind, name = (parts.path + '/').split('/', 2)
+        name = name.rstrip('/')
+        if kind == 'docset' and name in self.docsets:
+            refs = self.docsets[name]
+            doc = {}
+            if self.page_size:
+                page = int(parse_qs(parts.query).get('page', ['0'])[0])
+                start = page * self.page_size
+                if start + self.page_size < len(refs):
+                    doc['next'] = '?page={}'.format(page + 1)
+                refs = refs[start:start + self.page_size]
+            doc['members'] = [{'ref': ref} for ref in refs]
+            body = json.dumps(doc).encode('utf-8')
+            return 200, {'Content-Type': 'application/json'}, body
+        if kind == 'fedora' and name in self.items:
+            return 200, {'Content-Type': 'text/n3'}, \
+                self.items[name].encode('utf-8')
+        if kind == 'files' and name in self.files:
+            data = self.files[name]
+            return 200, {'Content-Type': 'application/pdf',
+                         'ETag': '"{}"'.format(hashlib.md5(data).hexdigest())
+                         }, data
+        return 404, {}, b''
+
+
+class GCS(StandIn):
+    """Stand-in for the Google Cloud Storage resumable upload protocol.
+
+    Use the stand-in's ``url`` as both the ``url`` and ``upload_url`` of a
+    :class:`minecart.upload.Client`. Completed uploads are kept in
+    ``objects``, keyed by bucket and object name, and can be downloaded
+    whole or by range.
+
+    Status codes appended to ``failures`` are returned, in order, for the
+    next upload chunks. A failed chunk still commits the first half of
+    its data, rounded down to a multiple of 256 KiB, as GCS may.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.objects = {}
+        self.sessions = {}
+        self.chunks = []
+        self.failures = []
+        self._ids = itertools.count()
+
+    def respond(self, handler):
+        parts = urlsplit(handler.path)
+        if handler.command == 'POST' and parts.path.endswith('/o'):
+            return self._create_session(handler, parts)
+        if handler.command == 'POST' and parts.path.endswith('/compose'):
+            return self._compose(handler, parts)
+        if handler.command == 'GET' and '/o/' in parts.path:
+            return self._download(handler, parts)
+        if handler.command == 'DELETE' and '/o/' in parts.path:
+            _, _, bucket, _, name = parts.path.split('/', 4)
+            if self.objects.pop((bucket, unquote(name)), None) is None:
+                return 404, {}, b''
+            return 204, {}, b''
+        if parts.path.startswith('/session/'):
+            upload_id = parts.path.split('/')[-1]
+            if upload_id not in self.sessions:
+                return 404, {}, b''
+            if handler.command == 'DELETE':
+                del self.sessions[upload_id]
+                return 499, {}, b''
+            return self._put(handler, upload_id)
+        return 404, {}, b''
+
+    def _download(self, handler, parts):
+        _, _, bucket, _, name = parts.path.split('/', 4)
+        data = self.objects.get((bucket, unquote(name)))
+        if data is None:
+            return 404, {}, b''
+        m = re.match(r'bytes=(\d+)-(\d*)$', handler.headers.get('Range', ''))
+        if m is None:
+            return 200, {}, data
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else len(data) - 1
+        if start >= len(data):
+            return 416, {}, b''
+        end = min(end, len(data) - 1)
+        return 206, {'Content-Range': 'bytes {}-{}/{}'.format(
+            start, end, len(data))}, data[start:end + 1]
+
+    def _create_session(self, handler, parts):
+        bucket = parts.path.split('/')[2]
+        name = parse_qs(parts.query)['name'][0]
+        upload_id = str(next(self._ids))
+        size = handler.headers.get('X-Upload-Content-Length')
+        self.sessions[upload_id] = {
+            'bucket': bucket,
+            'name': name,
+            'size': int(size) if size else None,
+            'data': bytearray(),
+        }
+        location = '{}/session/{}'.format(self.url, upload_id)
+        return 200, {'Location': location}, b''
+
+    def _compose(self, handler, parts):
+        _, _, bucket, _, name = parts.path[:-len('/compose')].split('/', 4)
+        sources = json.loads(handler.body.decode('utf-8'))['sourceObjects']
+        try:
+            data = b''.join(self.objects[(bucket, src['name'])]
+                            for src in sources)
+        except KeyError:
+            return 404, {}, b''
+        self.objects[(bucket, unquote(name))] = data
+        body = json.dumps({'name': unquote(name),
+                           'size': str(len(data))}).encode('utf-8')
+        return 200, {'Content-Type': 'application/json'}, body
+
+    def _put(self, handler, upload_id):
+        session = self.sessions[upload_id]
+        crange = handler.headers.get('Content-Range', '')
+        m = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)$', crange)
+        if m is None:
+            start, total = 0, len(handler.body)
+        else:
+            start = int(m.group(2)) if m.group(2) else None
+            total = None if m.group(4) == '*' else int(m.group(4))
+        data = session['data']
+        if start is not None:
+            if start > len(data):
+                return 400, {}, b''
+            del data[start:]
+            if self.failures:
+                half = len(handler.body) // 2
+                data.extend(handler.body[:half - half % (256 * 1024)])
+                return self.failures.pop(0), {}, b''
+            data.extend(handler.body)
+            self.chunks.append(len(handler.body))
+        if total is not None and len(data) == total:
+            key = (session['bucket'], session['name'])
+            self.objects[key] = bytes(data)
+            del self.sessions[upload_id]
+            body = json.dumps({'name': session['name'],
+                               'size': str(total)}).encode('utf-8')
+            return 200, {'Content-Type': 'application/json'}, body
+        headers = {}
+        if data:
+            headers['Range'] = 'bytes=0-{}'.format(len(data) - 1)
+        return 308, headers, b''
+
+
+class Sparql(StandIn):
+    """Stand-in for a triplestore SPARQL endpoint.
+
+    Answers the queries made by :class:`minecart.packager.SparqlMetadata`
+    from ``files``, a dict of item URI to a list of ``(uri, mimetype)``
+    pairs, by reading the item URIs out of the query's ``VALUES`` clause.
+    The number of queries answered is kept in ``queries``.
+    """
+    def __init__(self, files=None, **kwargs):
+        super().__init__(**kwargs)
+        self.files = files or {}
+        self.queries = 0
+
+    @classmethod
+    def mirror(cls, fedora, **kwargs):
+        """Build a stand-in holding the items of a :class:`Fedora`."""
+        files = {fedora.fedora + ref: extract_files(data)
+                 for ref, data in fedora.items.items()}
+        return cls(files, **kwargs)
+
+    def respond(self, handler):
+        if handler.command != 'POST':
+            return 405, {}, b''
+        self.queries += 1
+        query = parse_qs(handler.body.decode('utf-8'))['query'][0]
+        values = re.search(r'VALUES \?item \{([^}]*)\}', query).group(1)
+        bindings = []
+        for item in re.findall(r'<([^>]*)>', values):
+            for uri, mimetype in self.files.get(item, []):
+                bindings.append({
+                    'item': {'type': 'uri', 'value': item},
+                    'file': {'type': 'uri', 'value': uri},
+                    'mimetype': {'type': 'literal', 'value': mimetype},
+                })
+        body = json.dumps({'head': {'vars': ['item', 'file', 'mimetype']},
+                           'results': {'bindings': bindings}})
+        return 200, {'Content-Type': 'application/sparql-results+json'}, \
+            body.encode('utf-8')
+
+
+def thesis_n3(uri, files):
+    """Return an N3 item in the shape Fedora returns for a thesis.
+
+    ``files`` is a list of ``(uri, mimetype)`` pairs.
+    """
+    subject = '<{}>'.format(uri)
+    lines = [
+        '@prefix pcdm: <http://pcdm.org/models#> .',
+        '@prefix dcterms: <http://purl.org/dc/terms/> .',
+        '@prefix ebu: <http://www.ebu.ch/metadata/ontologies/ebucore/'
+        'ebucore#> .',
+        '{} dcterms:title "Thesis" ;'.format(subject),
+        '    pcdm:hasFile {} .'.format(
+            ', '.join('<{}>'.format(uri) for uri, _ in files)),
+    ]
+    for uri, mimetype in files:
+        lines.append('<{}> a pcdm:File ; ebu:hasMimeType "{}" .'
+                     .format(uri, mimetype))
+    return '\n'.join(lines) + '\n'
+
+
+def synthetic_fedora(members, pdf=b'%PDF-1.4\n', **kwargs):
+    """Build a :class:`Fedora` stand-in with one docset of ``members``.
+
+    The docset has id ``1`` and each member has a text file and a PDF
+    served by the stand-in itself. The stand-in is returned unstarted,
+    and is created with any other keyword arguments given.
+    """
+    standin = Fedora(**kwargs)
+    refs = ['item{}'.format(i) for i in range(members)]
+    standin.docsets['1'] = refs
+    for ref in refs:
+        standin.files[ref + '.pdf'] = pdf
+        standin.items[ref] = thesis_n3(standin.fedora + ref, [
+            (standin.file_url(ref + '.txt'), 'text/plain'),
+            (standin.file_url(ref + '.pdf'), 'application/pdf'),
+        ])
+    return standin
+
+
+class _BrokerServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _BrokerHandler(StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        broker = self.server.broker
+        self.write_lock = threading.Lock()
+        try:
+            for command, headers, body in _read_frames(self.rfile):
+                if not broker.receive(self, command, headers, body):
+                    break
+        finally:
+            broker.disconnect(self)
+
+    def send_frame(self, command, headers, body=b''):
+        lines = [command]
+        lines.extend('{}:{}'.format(k, _escape_header(str(v)))
+                     for k, v in headers.items())
+        frame = ('\n'.join(lines) + '\n\n').encode('utf-8') + body + b'\0'
+        with self.write_lock:
+            self.wfile.write(frame)
+            self.wfile.flush()
+
+
+class Broker:
+    """Stand-in for a STOMP message broker with queue semantics.
+
+    Each message sent to a destination is delivered to one of its
+    subscribers, in turn, or held until there is one. Subscriptions with
+    ``client`` or ``client-individual`` acknowledgement are sent no more
+    than their ``activemq.prefetchSize`` unacknowledged messages at once.
+    Every message sent is also recorded in ``sent`` as a ``(destination,
+    body)`` pair.
+    """
+    def __init__(self):
+        self.sent = []
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._subscriptions = {}
+        self._unacked = {}
+        self._ids = itertools.count()
+        self._server = _BrokerServer(('127.0.0.1', 0), _BrokerHandler)
+        self._server.broker = self
+        self._thread = None
+
+    @property
+    def host_and_port(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def messages(self, destination):
+        """Return the bodies of messages sent to ``destination``."""
+        with self._lock:
+            return [body.decode('utf-8') for dest, body in self.sent
+                    if dest == destination]
+
+    def receive(self, client, command, headers, body):
+        if command in ('CONNECT', 'STOMP'):
+            client.send_frame('CONNECTED', {'version': '1.1'})
+        elif command == 'SUBSCRIBE':
+            sub = _Subscription(client, headers)
+            with self._lock:
+                self._subscriptions.setdefault(sub.destination, []) \
+                    .append(sub)
+                self._dispatch(sub.destination)
+        elif command == 'UNSUBSCRIBE':
+            with self._lock:
+                for subs in self._subscriptions.values():
+                    subs[:] = [s for s in subs if not (
+                        s.client is client and s.id == headers.get('id'))]
+        elif command == 'SEND':
+            destination = headers['destination']
+            extra = {k: v for k, v in headers.items()
+                     if k not in ('destination', 'content-length',
+                                  'receipt')}
+            with self._lock:
+                self.sent.append((destination, body))
+                self._pending.setdefault(destination, []) \
+                    .append((extra, body))
+                self._dispatch(destination)
+        elif command in ('ACK', 'NACK'):
+            with self._lock:
+                sub = self._unacked.pop(headers.get('message-id'), None)
+                if sub is not None:
+                    sub.unacked -= 1
+                    self._dispatch(sub.destination)
+        if 'receipt' in headers:
+            client.send_frame('RECEIPT', {'receipt-id': headers['receipt']})
+        return command != 'DISCONNECT'
+
+    def disconnect(self, client):
+        with self._lock:
+            for subs in self._subscriptions.values():
+                subs[:] = [s for s in subs if s.client is not client]
+
+    def _dispatch(self, destination):
+        pending = self._pending.get(destination, [])
+        subs = self._subscriptions.get(destination, [])
+        while pending:
+            ready = [s for s in subs if s.has_room()]
+            if not ready:
+                return
+            sub = min(ready, key=lambda s: s.delivered)
+            extra, body = pending.pop(0)
+            message_id = str(next(self._ids))
+            headers = dict(extra)
+            headers.update({'destination': destination,
+                            'message-id': message_id,
+                            'subscription': sub.id,
+                            'content-length': len(body)})
+            sub.delivered += 1
+            if sub.ack != 'auto':
+                sub.unacked += 1
+                self._unacked[message_id] = sub
+            try:
+                sub.client.send_frame('MESSAGE', headers, body)
+            except OSError:
+                pass
+
+
+class _Subscription:
+    def __init__(self, client, headers):
+        self.client = client
+        self.id = headers.get('id')
+        self.destination = headers['destination']
+        self.ack = headers.get('ack', 'auto')
+        prefetch = headers.get('activemq.prefetchSize')
+        self.prefetch = int(prefetch) if prefetch else None
+        self.unacked = 0
+        self.delivered = 0
+
+    def has_room(self):
+        return self.ack == 'auto' or self.prefetch is None or \
+            self.unacked < self.prefetch
+
+
+def _read_frames(rfile):
+    """Generate ``(command, headers, body)`` for each STOMP frame read."""
+    while True:
+        line = rfile.readline()
+        if not line:
+            return
+        if not line.strip():
+            continue
+        command = line.decode('utf-8').strip()
+        headers = {}
+        while True:
+            line = rfile.readline().decode('utf-8').rstrip('\r\n')
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers.setdefault(_unescape_header(key),
+                               _unescape_header(value))
+        if 'content-length' in headers:
+            body = rfile.read(int(headers['content-length']))
+            rfile.read(1)
+        else:
+            body = bytearray()
+            while True:
+                c = rfile.read(1)
+                if not c or c == b'\0':
+                    break
+                body.extend(c)
+            body = bytes(body)
+        yield command, headers, body
+
+
+_HEADER_ESCAPES = [('\\', '\\\\'), ('\n', '\\n'), (':', '\\c'),
+                   ('\r', '\\r')]
+_HEADER_UNESCAPES = {escaped[1]: raw for raw, escaped in _HEADER_ESCAPES}
+
+
+def _escape_header(value):
+    for raw, escaped in _HEADER_ESCAPES:
+        value = value.replace(raw, escaped)
+    return value
+
+
+def _unescape_header(value):
+    return re.sub(r'\\(.)',
+                  lambda m: _HEADER_UNESCAPES.get(m.group(1), m.group(1)),
+                  value)
@@ -0,0 +1,137 @@
+import asyncio
+import io
+import threading
+import time
+from unittest import mock
+import zipfile
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from minecart.aio import AsyncEngine, _Response  # noqa: E402
+from minecart.packager import ApiListener, create_package  # noqa: E402
+from minecart.pcdm import PCDMFile  # noqa: E402
+from minecart.upload import Client  # noqa: E402
+from tests.standins import synthetic_fedora  # noqa: E402
+
+
+@pytest.yield_fixture
+def engine():
+    e = AsyncEngine(concurrency=10, downloads=3)
+    yield e
+    e.close()
+
+
+def test_engine_map_yields_results_in_order(engine):
+    async def slow(i):
+        await asyncio.sleep((10 - i) * 0.001)
+        return i
+
+    assert list(engine.map(slow, range(10), 5)) == list(range(10))
+
+
+def test_engine_map_cancels_calls_when_closed(engine):
+    started = []
+
+    async def call(i):
+        started.append(i)
+        await asyncio.sleep(0 if i == 0 else 10)
+        return i
+
+    results = engine.map(call, range(100), 5)
+    assert next(results) == 0
+    results.close()
+    assert len(started) <= 6
+
+
+def test_async_metadata_generates_documents_in_order(engine):
+    with synthetic_fedora(30) as fedora:
+        docs = list(engine.metadata(fedora.fedora).documents(
+            fedora.docsets['1'], None))
+    assert [d.name for d in docs] == fedora.docsets['1']
+    assert [f.mimetype for f in docs[0].files] == ['text/plain',
+                                                   'application/pdf']
+
+
+def test_async_metadata_reads_cache_off_the_loop(engine):
+    threads = []
+    cache = mock.Mock()
+    cache.get.side_effect = lambda url: threads.append(
+        threading.current_thread())
+    with synthetic_fedora(3) as fedora:
+        docs = list(engine.metadata(fedora.fedora, cache).documents(
+            fedora.docsets['1'], None))
+    assert len(docs) == 3
+    assert len(threads) == 3
+    assert engine._thread not in threads
+
+
+def test_engine_pdfs_do_not_time_out_waiting_in_window():
+    engine = AsyncEngine(downloads=3, read_timeout=0.1)
+    data = b'%PDF-1.4\n' + bytes(range(256)) * 4096
+    try:
+        with synthetic_fedora(3, data) as fedora:
+            pdfs = engine.open_pdfs(
+                (ref, PCDMFile(fedora.file_url(ref + '.pdf'),
+                               'application/pdf'), None)
+                for ref in fedora.docsets['1'])
+            bodies = []
+            for name, f, r in pdfs:
+                time.sleep(0.3)
+                bodies.append(b''.join(r.iter_content(64 * 1024)))
+                r.close()
+    finally:
+        engine.close()
+    assert bodies == [data] * 3
+
+
+def test_engine_releases_opened_pdfs_when_closed(engine):
+    with synthetic_fedora(3) as fedora:
+        pdfs = engine.open_pdfs(
+            (ref, PCDMFile(fedora.file_url(ref + '.pdf'), 'application/pdf'),
+             None) for ref in fedora.docsets['1'])
+        with mock.patch.object(_Response, 'close', autospec=True) as close:
+            _, _, first = next(pdfs)
+            time.sleep(0.2)
+            pdfs.close()
+    first.close()
+    assert close.call_count == 2
+    assert first not in [c[0][0] for c in close.call_args_list]
+
+
+def test_create_package_with_engine_matches_threads(engine):
+    with synthetic_fedora(12, b'%PDF-1.4\n' + bytes(range(256)) * 100) \
+            as fedora:
+        threaded = create_package(fedora.docset_url(1),
+                                  fedora=fedora.fedora, workers=4)
+        async_ = create_package(fedora.docset_url(1), fedora=fedora.fedora,
+                                engine=engine)
+    with zipfile.ZipFile(threaded) as a, zipfile.ZipFile(async_) as b:
+        assert b.testzip() is None
+        assert a.namelist() == b.namelist()
+        assert all(a.read(n) == b.read(n) for n in a.namelist())
+
+
+def test_on_message_with_engine_uploads_package(engine, gcs):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    with synthetic_fedora(5) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), engine=engine)
+        listener.on_message(None, fedora.docset_url(1))
+    (_, name), data = gcs.objects.popitem()
+    assert listener.conn.send.call_args[0][1] == \
+        'Complete: {}/b/foo/o/{}\nSize: {}'.format(gcs.url, name, len(data))
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['item{}.pdf'.format(i) for i in range(5)]
+
+
+def test_on_message_with_engine_fails_on_missing_pdf(engine, gcs):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    with synthetic_fedora(5) as fedora:
+        del fedora.files['item3.pdf']
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), engine=engine)
+        listener.on_message(None, fedora.docset_url(1))
+    assert not gcs.objects
+    assert listener.conn.send.call_count == 1
@@ -1,10 +1,12 @@
+import io
 import os
 import tempfile
+from unittest import mock
 import zipfile
 
 import pytest
 
-from minecart.archive import archive, Zip
+from minecart.archive import archive, CompressionPolicy, entry, Zip
 
 
 @pytest.yield_fixture
@@ -24,6 +26,25 @@ def test_zip_writes_file_to_archive(thesis):
             assert b'foobar' == zf.read('test.txt')
 
 
+def test_zip_writes_stream_to_archive():
+    with tempfile.TemporaryFile() as fp:
+        arx = Zip(fp)
+        arx.write_stream(iter([b'foo', b'bar']), 'test.txt')
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert b'foobar' == zf.read('test.txt')
+
+
+def test_zip_writes_file_object_to_archive(thesis):
+    with tempfile.TemporaryFile() as fp:
+        arx = Zip(fp)
+        with open(thesis, 'rb') as f:
+            arx.write_stream(f, 'test.txt', size=6)
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert b'foobar' == zf.read('test.txt')
+
+
 def test_archive_returns_writeable_archive(thesis):
     with tempfile.NamedTemporaryFile() as fp:
         with archive(fp.name) as arx:
@@ -38,3 +59,118 @@ def test_archive_deletes_archive_on_error():
         with archive(fp.name):
             raise Exception
     assert not os.path.isfile(fp.name)
+
+
+def test_policy_stores_compressed_mimetypes():
+    policy = CompressionPolicy()
+    assert policy.choose('image/jpeg', b'a' * 1000) == \
+        (zipfile.ZIP_STORED, None)
+
+
+def test_policy_stores_incompressible_data():
+    policy = CompressionPolicy()
+    assert policy.choose('application/pdf', os.urandom(1000)) == \
+        (zipfile.ZIP_STORED, None)
+
+
+def test_policy_deflates_compressible_data():
+    policy = CompressionPolicy(level=9)
+    assert policy.choose('application/pdf', b'a' * 1000) == \
+        (zipfile.ZIP_DEFLATED, 9)
+
+
+def test_zip_applies_compression_policy():
+    with tempfile.TemporaryFile() as fp:
+        arx = Zip(fp)
+        arx.write_stream([os.urandom(1000)], 'random.pdf',
+                         mimetype='application/pdf')
+        arx.write_stream([b'a' * 1000], 'text.pdf',
+                         mimetype='application/pdf')
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert zf.getinfo('random.pdf').compress_type == \
+                zipfile.ZIP_STORED
+            assert zf.getinfo('text.pdf').compress_type == \
+                zipfile.ZIP_DEFLATED
+
+
+def test_zip_without_policy_uses_archive_compression():
+    with tempfile.TemporaryFile() as fp:
+        arx = Zip(fp, policy=None)
+        arx.write_stream([os.urandom(1000)], 'random.pdf',
+                         mimetype='application/pdf')
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert zf.getinfo('random.pdf').compress_type == \
+                zipfile.ZIP_DEFLATED
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'foobar',
+    b'The quick brown fox. ' * 1000,
+    os.urandom(5000) * 3,
+])
+def test_zip_compresses_blocks_in_parallel(data):
+    with mock.patch('minecart.archive.BLOCK_SIZE', 1024), \
+            tempfile.TemporaryFile() as fp:
+        always = CompressionPolicy(min_saving=float('-inf'))
+        arx = Zip(fp, policy=always, workers=4)
+        arx.write_stream(iter([data[:100], data[100:]]), 'test.txt')
+        arx.write_stream([b'foobar'], 'test2.txt')
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert zf.testzip() is None
+            assert zf.getinfo('test.txt').compress_type == \
+                zipfile.ZIP_DEFLATED
+            assert zf.read('test.txt') == data
+            assert zf.read('test2.txt') == b'foobar'
+
+
+def test_zip_compresses_in_parallel_to_unseekable_file():
+    class Unseekable(io.RawIOBase):
+        def __init__(self):
+            self.buf = io.BytesIO()
+
+        def writable(self):
+            return True
+
+        def write(self, b):
+            return self.buf.write(b)
+
+    out = Unseekable()
+    data = b'The quick brown fox. ' * 1000
+    arx = Zip(out, workers=2)
+    arx.write_stream([data], 'test.txt')
+    arx.close()
+    with zipfile.ZipFile(io.BytesIO(out.buf.getvalue())) as zf:
+        assert zf.read('test.txt') == data
+
+
+def test_zip_uses_zip64_for_large_parallel_members():
+    data = b'The quick brown fox. ' * 1000
+    with mock.patch('zipfile.ZIP64_LIMIT', 1000), \
+            tempfile.TemporaryFile() as fp:
+        arx = Zip(fp, workers=2)
+        arx.write_stream([data], 'test.txt', size=len(data))
+        arx.close()
+        with zipfile.ZipFile(fp) as zf:
+            assert zf.read('test.txt') == data
+            assert zf.getinfo('test.txt').extract_version >= 45
+
+
+def test_zip_reopen_continues_partial_archive():
+    with tempfile.NamedTemporaryFile() as t:
+        arx = Zip(t.name)
+        arx.write_stream([b'foo'], 'foo.txt')
+        entries = [entry(z) for z in arx.archive.filelist]
+        offset = arx.archive.start_dir
+        arx.write_stream([b'cut short'], 'bar.txt')
+        arx.close()
+        arx = Zip.reopen(t.name, entries, offset)
+        arx.write_stream([b'baz'], 'baz.txt')
+        arx.close()
+        with zipfile.ZipFile(t.name) as zf:
+            assert zf.testzip() is None
+            assert zf.namelist() == ['foo.txt', 'baz.txt']
+            assert zf.read('foo.txt') == b'foo'
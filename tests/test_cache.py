@@ -0,0 +1,92 @@
+import time
+
+import pytest
+
+from minecart.cache import ManifestStore, MetadataCache, PackageCache
+from minecart.manifest import Manifest
+
+
+@pytest.yield_fixture
+def cache(cache_db):
+    c = PackageCache(cache_db)
+    yield c
+    c.close()
+
+
+def test_cache_returns_stored_package(cache):
+    cache.put('abc', 'mock://example.com/foo.zip', 10)
+    assert cache.get('abc') == ('mock://example.com/foo.zip', 10)
+
+
+def test_cache_misses_unknown_digest(cache):
+    assert cache.get('abc') is None
+
+
+def test_cache_persists_index(cache_db):
+    PackageCache(cache_db).put('abc', 'mock://example.com/foo.zip', 10)
+    assert PackageCache(cache_db).get('abc') == \
+        ('mock://example.com/foo.zip', 10)
+
+
+def test_cache_expires_old_entries(cache):
+    cache.ttl = 60
+    cache.put('abc', 'mock://example.com/foo.zip', 10)
+    cache._db.execute('UPDATE packages SET created = ?',
+                      (time.time() - 61,))
+    assert cache.get('abc') is None
+
+
+def test_cache_evicts_least_recently_used(cache):
+    cache.max_size = 25
+    cache.put('a', 'mock://example.com/a.zip', 10)
+    cache.put('b', 'mock://example.com/b.zip', 10)
+    cache._db.execute("UPDATE packages SET accessed = 0 WHERE digest = 'b'")
+    cache.put('c', 'mock://example.com/c.zip', 10)
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+
+
+@pytest.yield_fixture
+def meta_cache(cache_db):
+    c = MetadataCache(cache_db)
+    yield c
+    c.close()
+
+
+def test_metadata_cache_returns_stored_item(meta_cache):
+    meta_cache.put('mock://example.com/1', '"a"', None, 'foo')
+    assert meta_cache.get('mock://example.com/1') == ('"a"', None, 'foo')
+
+
+def test_metadata_cache_evicts_least_recently_used(meta_cache):
+    meta_cache.max_size = 5
+    meta_cache.put('mock://example.com/1', '"a"', None, 'foo')
+    meta_cache._db.execute('UPDATE items SET accessed = 0')
+    meta_cache.put('mock://example.com/2', '"b"', None, 'bar')
+    assert meta_cache.get('mock://example.com/1') is None
+    assert meta_cache.get('mock://example.com/2') is not None
+
+
+@pytest.yield_fixture
+def manifests(cache_db):
+    m = ManifestStore(cache_db)
+    yield m
+    m.close()
+
+
+def test_manifest_store_returns_stored_manifest(manifests):
+    member = {'name': 'foo', 'uri': 'mock://example.com/foo',
+              'etag': '"a"', 'last_modified': None,
+              'entry': {'header_offset': 0}, 'length': 10}
+    manifests.put('mock://example.com/docset/1', Manifest('a.zip', [member]))
+    manifest = manifests.get('mock://example.com/docset/1')
+    assert manifest.name == 'a.zip'
+    assert manifest.reusable('foo', 'mock://example.com/foo', '"a"',
+                             None) == member
+
+
+def test_manifest_store_deletes_manifest(manifests):
+    manifests.put('mock://example.com/docset/1', Manifest('a.zip'))
+    manifests.delete('mock://example.com/docset/1')
+    assert manifests.get('mock://example.com/docset/1') is None
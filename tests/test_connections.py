@@ -0,0 +1,28 @@
+import requests
+
+from minecart.connections import ConnectionPools
+from minecart.metrics import registry
+from tests.standins import synthetic_fedora
+
+
+def test_connection_pools_reuse_connections():
+    pools = ConnectionPools()
+    before = registry.snapshot()
+    with synthetic_fedora(1) as fedora:
+        for _ in range(3):
+            pools.session.get(fedora.docset_url(1)).raise_for_status()
+        stats = pools.stats()
+    after = registry.snapshot()
+    assert stats == {fedora.url: {'connections': 1, 'requests': 3}}
+    assert after['minecart_http_connections_total'] - \
+        before.get('minecart_http_connections_total', 0) == 1
+    assert after['minecart_http_requests_total'] - \
+        before.get('minecart_http_requests_total', 0) == 3
+
+
+def test_connection_pools_size_pools_by_host():
+    pools = ConnectionPools(2, {'http://fedora/': 8})
+    session = pools.mount(requests.Session())
+    assert session.get_adapter('http://fedora/foo')._pool_maxsize == 8
+    assert session.get_adapter('http://example.com/')._pool_maxsize == 2
+    assert pools.session is pools.session
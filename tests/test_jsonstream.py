@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from minecart.jsonstream import iter_array
+
+
+def pieces(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 3, 1024])
+def test_iter_array_yields_elements_across_chunks(size):
+    doc = {'id': 12, 'members': [{'ref': 'a'}, 123456, 'café', [1.5]],
+           'next': '/docset/1?page=2'}
+    data = json.dumps(doc).encode('utf-8')
+    fields = {}
+    items = list(iter_array(pieces(data, size), 'members', fields))
+    assert items == doc['members']
+    assert fields == {'id': 12, 'next': '/docset/1?page=2'}
+
+
+def test_iter_array_yields_nothing_for_empty_array():
+    assert list(iter_array([b'{"members": [ ]}'], 'members')) == []
+
+
+def test_iter_array_yields_nothing_without_key():
+    assert list(iter_array([b'{"foo": [1]}'], 'members')) == []
+
+
+def test_iter_array_reads_lazily():
+    chunks = iter([b'{"members": [1,', b' 2]}', b''])
+    items = iter_array(chunks, 'members')
+    assert next(items) == 1
+    assert next(chunks) == b' 2]}'
+
+
+def test_iter_array_raises_on_truncated_document():
+    with pytest.raises(ValueError):
+        list(iter_array([b'{"members": [1, 2'], 'members'))
+
+
+def test_iter_array_raises_on_malformed_document():
+    with pytest.raises(ValueError):
+        list(iter_array([b'{"members": [1; 2]}'], 'members'))
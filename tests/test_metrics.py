@@ -0,0 +1,87 @@
+from unittest import mock
+
+import requests
+
+from minecart.metrics import Metrics, Progress, serve
+
+
+def test_metrics_renders_counters_and_timings():
+    m = Metrics()
+    m.count('download_bytes', 10)
+    m.count('download_bytes', 5)
+    m.observe('upload', 1.5)
+    m.observe('upload', 0.5)
+    assert m.render() == (
+        '# TYPE minecart_download_bytes_total counter\n'
+        'minecart_download_bytes_total 15\n'
+        '# TYPE minecart_upload_seconds summary\n'
+        'minecart_upload_seconds_sum 2.000000\n'
+        'minecart_upload_seconds_count 2\n')
+
+
+def test_metrics_snapshot_includes_timer():
+    m = Metrics()
+    with m.timer('job'):
+        pass
+    assert m.snapshot()['minecart_job_seconds_count'] == 1
+
+
+def test_timed_counts_bytes_and_observes_once():
+    m = Metrics()
+    assert list(m.timed([b'ab', b'cde'], 'download', 'bytes')) == \
+        [b'ab', b'cde']
+    stats = m.snapshot()
+    assert stats['minecart_bytes_total'] == 5
+    assert stats['minecart_download_seconds_count'] == 1
+
+
+def test_timed_closes_iterable_when_closed():
+    closed = []
+
+    def gen():
+        try:
+            yield b'a'
+            yield b'b'
+        finally:
+            closed.append(True)
+
+    it = Metrics().timed(gen(), 'download')
+    next(it)
+    it.close()
+    assert closed == [True]
+
+
+def test_progress_reports_percent_and_eta():
+    send = mock.Mock()
+    progress = Progress(send, total=100, interval=0)
+    with mock.patch('minecart.metrics.time.monotonic',
+                    return_value=progress._start + 2):
+        progress.update(50)
+    send.assert_called_once_with(
+        'Progress: 50%\nBytes: 50\nRate: 25 B/s\nETA: 2s')
+
+
+def test_progress_throttles_messages():
+    send = mock.Mock()
+    progress = Progress(send, interval=60)
+    progress.update(10)
+    progress.update(10)
+    assert not send.called
+    assert progress.done == 20
+
+
+def test_progress_without_total():
+    assert Progress(None).message(1).startswith('Progress: ?\nBytes: 0\n')
+
+
+def test_serve_exposes_metrics():
+    m = Metrics()
+    m.count('jobs_started')
+    server = serve(m, port=0, host='127.0.0.1')
+    try:
+        r = requests.get('http://127.0.0.1:{}/metrics'.format(
+            server.server_port))
+        assert 'minecart_jobs_started_total 1' in r.text
+    finally:
+        server.shutdown()
+        server.server_close()
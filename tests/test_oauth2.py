@@ -1,3 +1,5 @@
+import threading
+import time
 from unittest import mock
 
 import jwt
@@ -92,3 +94,57 @@ def test_oauth2_session_skips_auth_when_session_valid(google, auth):
     s.get('mock://example.com/bucket/1')
     assert google.call_count == 1
 
+
+def test_jwtauth_refreshes_token_before_it_expires(google, auth):
+    google.post('mock://example.com',
+                json={'access_token': 'good job!', 'expires_in': 3600})
+    auth(mock.MagicMock())
+    auth._expires = time.time() + auth.margin - 1
+    auth(mock.MagicMock())
+    assert google.call_count == 2
+
+
+def test_jwtauth_reuses_signed_assertion(google, auth):
+    auth.authorize()
+    auth.authorize()
+    first, second = google.request_history
+    assert first.text == second.text
+
+
+def test_jwtauth_resigns_assertion_near_expiry(google, auth):
+    auth.authorize()
+    later = auth._assertion_expires - auth.margin
+    with mock.patch('minecart.oauth2.time.time', return_value=later):
+        auth.authorize()
+    first, second = google.request_history
+    assert first.text != second.text
+
+
+def test_jwtauth_refreshes_once_for_concurrent_requests(google, auth):
+    threads = [threading.Thread(target=auth, args=(mock.MagicMock(),))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert google.call_count == 1
+
+
+def test_jwtauth_skips_refresh_if_rejected_token_replaced(google, auth):
+    auth._token = 'new token'
+    auth.authorize('old token')
+    assert not google.called
+
+
+def test_jwtauth_refreshes_in_background(google, auth):
+    google.post('mock://example.com',
+                json={'access_token': 'good job!', 'expires_in': 3600})
+    auth.background = True
+    with mock.patch('minecart.oauth2.threading.Timer') as timer:
+        auth.authorize()
+        delay, refresh = timer.call_args[0]
+        assert delay == 3600 - auth.margin
+        timer.return_value.start.assert_called_once_with()
+        refresh()
+    assert google.call_count == 2
+    assert timer.call_count == 2
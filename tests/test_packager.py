@@ -1,16 +1,29 @@
+import io
 import os
 import re
+import threading
 import tempfile
 from unittest import mock
 import zipfile
 
 import pytest
+import requests
 import requests_mock
 from rdflib import URIRef, namespace
 
+from minecart.archive import Zip
+from minecart.cache import (CheckpointStore, ManifestStore, MetadataCache,
+                            PackageCache)
+from minecart.connections import ConnectionPools
+from minecart.metrics import registry
+from minecart import packager
 from minecart.packager import (document_set, get_item_meta, Document,
-                               create_package, ApiListener)
-from minecart.upload import Client
+                               create_package, ApiListener, package_digest,
+                               SparqlMetadata, estimate_size, iter_members)
+from minecart.scheduler import Scheduler
+from minecart.scratch import ScratchSpace
+from minecart.upload import Client, ResumableUpload
+from tests.standins import Sparql, synthetic_fedora
 
 
 BIBO = namespace.Namespace('http://purl.org/ontology/bibo/')
@@ -59,7 +72,8 @@ def webmock(thesis_1, thesis_2, thesis_1_pdf, thesis_2_pdf):
 @pytest.fixture
 def listener():
     bucket = Client(url='mock://example.com/google',
-                    upload_url='mock://example.com/google').get('foo')
+                    upload_url='mock://example.com/google',
+                    backoff=0).get('foo')
     return ApiListener(fedora='mock://example.com/fedora/thesis/',
                        bucket=bucket,
                        conn=mock.MagicMock())
@@ -76,11 +90,132 @@ def test_document_set_generates_documents(webmock):
                       predicate=BIBO.handle) == URIRef('http://handle.org/2')
 
 
+def test_iter_members_follows_next_links(webmock):
+    webmock.get('mock://example.com/docset/2',
+                json={'members': [{'ref': '1'}]},
+                headers={'Link': '<mock://example.com/docset/2?page=2>; '
+                                 'rel="next"'})
+    webmock.get('mock://example.com/docset/2?page=2',
+                json={'members': [{'ref': '2'}],
+                      'next': 'mock://example.com/docset/2?page=3'})
+    webmock.get('mock://example.com/docset/2?page=3',
+                json={'members': [{'ref': '3'}]})
+    assert list(iter_members('mock://example.com/docset/2')) == \
+        ['1', '2', '3']
+
+
+def test_iter_members_reads_pages_from_relative_links():
+    with synthetic_fedora(7, page_size=3) as fedora:
+        refs = list(iter_members(fedora.docset_url(1)))
+        pages = [path for _, path in fedora.requests]
+    assert refs == ['item{}'.format(i) for i in range(7)]
+    assert pages == ['/docset/1', '/docset/1?page=1', '/docset/1?page=2']
+
+
+def test_document_set_starts_before_later_pages_are_fetched(webmock):
+    webmock.get('mock://example.com/docset/2',
+                json={'members': [{'ref': '123'}],
+                      'next': 'mock://example.com/docset/2?page=2'})
+    webmock.get('mock://example.com/docset/2?page=2',
+                json={'members': [{'ref': '456'}]})
+    dset = document_set('mock://example.com/docset/2',
+                        fedora='mock://example.com/fedora/thesis/')
+    assert next(dset).name == '123'
+    assert 'page=2' not in webmock.request_history[-1].url
+    assert next(dset).name == '456'
+
+
+def test_document_set_preserves_member_order_with_workers():
+    with synthetic_fedora(20) as fedora:
+        dset = document_set(fedora.docset_url(1), fedora=fedora.fedora,
+                            workers=4)
+        names = [d.name for d in dset]
+    assert names == ['item{}'.format(i) for i in range(20)]
+
+
+def test_document_set_stops_fetching_when_closed():
+    with synthetic_fedora(20) as fedora:
+        dset = document_set(fedora.docset_url(1), fedora=fedora.fedora,
+                            workers=2)
+        next(dset)
+        dset.close()
+        fetched = [p for _, p in fedora.requests if p.startswith('/fedora')]
+    assert len(fetched) < 20
+
+
+def test_sparql_metadata_fetches_members_in_batches():
+    with synthetic_fedora(25) as fedora, Sparql.mirror(fedora) as sparql:
+        backend = SparqlMetadata(sparql.url, fedora.fedora, batch_size=10)
+        docs = list(document_set(fedora.docset_url(1), fedora=fedora.fedora,
+                                 backend=backend))
+        fetched = [p for _, p in fedora.requests if p.startswith('/fedora')]
+    assert [d.name for d in docs] == ['item{}'.format(i) for i in range(25)]
+    assert list(docs[3].files) == [
+        (fedora.file_url('item3.txt'), 'text/plain'),
+        (fedora.file_url('item3.pdf'), 'application/pdf'),
+    ]
+    assert sparql.queries == 3
+    assert not fetched
+
+
+def test_sparql_metadata_falls_back_for_missing_members():
+    with synthetic_fedora(5) as fedora, Sparql.mirror(fedora) as sparql:
+        del sparql.files[fedora.fedora + 'item2']
+        backend = SparqlMetadata(sparql.url, fedora.fedora)
+        docs = list(document_set(fedora.docset_url(1), fedora=fedora.fedora,
+                                 backend=backend))
+        fetched = [p for _, p in fedora.requests if p.startswith('/fedora')]
+    assert [d.name for d in docs] == ['item{}'.format(i) for i in range(5)]
+    assert fetched == ['/fedora/item2']
+    assert len(list(docs[2].files)) == 2
+
+
+def test_sparql_metadata_falls_back_when_query_fails():
+    with synthetic_fedora(3) as fedora:
+        backend = SparqlMetadata(fedora.url + '/sparql', fedora.fedora)
+        docs = list(document_set(fedora.docset_url(1), fedora=fedora.fedora,
+                                 backend=backend))
+        fetched = [p for _, p in fedora.requests if p.startswith('/fedora')]
+    assert [d.name for d in docs] == ['item0', 'item1', 'item2']
+    assert len(fetched) == 3
+
+
 def test_get_item_meta_returns_rdf_metadata(webmock, thesis_1):
     rdf = get_item_meta('mock://example.com/fedora/thesis/123')
     assert rdf == thesis_1
 
 
+def test_get_item_meta_revalidates_cached_metadata(webmock, thesis_1,
+                                                   cache_db):
+    def item(request, context):
+        if request.headers.get('If-None-Match') == '"1"':
+            context.status_code = 304
+            return ''
+        context.headers['ETag'] = '"1"'
+        return thesis_1
+
+    webmock.get('mock://example.com/fedora/thesis/123', text=item)
+    cache = MetadataCache(cache_db)
+    get_item_meta('mock://example.com/fedora/thesis/123', cache=cache)
+    rdf = get_item_meta('mock://example.com/fedora/thesis/123', cache=cache)
+    assert rdf == thesis_1
+    assert webmock.last_request.headers['If-None-Match'] == '"1"'
+
+
+def test_get_item_meta_refetches_changed_metadata(webmock, thesis_1,
+                                                  thesis_2, cache_db):
+    webmock.get('mock://example.com/fedora/thesis/123', text=thesis_2,
+                headers={'Last-Modified': 'Wed, 01 Mar 2017 00:00:00 GMT'})
+    cache = MetadataCache(cache_db)
+    cache.put('mock://example.com/fedora/thesis/123', None,
+              'Tue, 28 Feb 2017 00:00:00 GMT', thesis_1)
+    rdf = get_item_meta('mock://example.com/fedora/thesis/123', cache=cache)
+    assert rdf == thesis_2
+    assert webmock.last_request.headers['If-Modified-Since'] == \
+        'Tue, 28 Feb 2017 00:00:00 GMT'
+    assert cache.get('mock://example.com/fedora/thesis/123')[2] == thesis_2
+
+
 def test_document_generates_file_objects(thesis_1):
     doc = Document('foobar', thesis_1)
     files = list(doc.files)
@@ -96,6 +231,54 @@ def test_create_package_returns_archive(webmock):
     assert all([f in members for f in ('123.pdf', '456.pdf')])
 
 
+def test_create_package_writes_members_in_order_with_workers():
+    with synthetic_fedora(10) as fedora:
+        pkg = create_package(fedora.docset_url(1), fedora=fedora.fedora,
+                             workers=4)
+    with zipfile.ZipFile(pkg) as zf:
+        members = zf.namelist()
+    assert members == ['item{}.pdf'.format(i) for i in range(10)]
+
+
+def test_create_package_fails_when_a_download_fails(clean_temp):
+    with synthetic_fedora(10) as fedora:
+        del fedora.files['item3.pdf']
+        with pytest.raises(Exception):
+            create_package(fedora.docset_url(1), fedora=fedora.fedora,
+                           workers=4)
+    assert not os.listdir(tempfile.tempdir)
+
+
+@pytest.mark.parametrize('failure', ['download', 'archive'])
+def test_create_package_closes_responses_when_it_fails(clean_temp, failure):
+    opened = []
+    get = requests.Session.get
+    write_stream = Zip.write_stream
+
+    def recording_get(self, url, **kwargs):
+        r = get(self, url, **kwargs)
+        if '/files/' in url:
+            opened.append(r)
+        return r
+
+    def failing_write_stream(self, *args):
+        if len(self.archive.filelist) == 2:
+            raise Exception('Disk full')
+        return write_stream(self, *args)
+
+    with synthetic_fedora(10) as fedora, \
+            mock.patch.object(requests.Session, 'get', recording_get), \
+            mock.patch.object(Zip, 'write_stream', failing_write_stream
+                              if failure == 'archive' else write_stream):
+        if failure == 'download':
+            del fedora.files['item3.pdf']
+        with pytest.raises(Exception):
+            create_package(fedora.docset_url(1), fedora=fedora.fedora,
+                           workers=4)
+    assert len(opened) > 3
+    assert all(r.raw.closed for r in opened)
+
+
 def test_on_message_uploads_package(webmock, listener):
     listener.on_message(None, 'mock://example.com/docset/1')
     assert webmock.request_history[-1].method == 'PUT'
@@ -132,3 +315,442 @@ def test_on_message_notifies_queue_with_url_and_size(webmock, listener):
     assert args[0] == '/queue/package/1'
     assert re.match(r'Complete: mock://example.com/google/b/foo/o/'
                     r'\w+.zip\nSize: \d+', args[1])
+
+
+def test_on_message_streams_package(gcs):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    with synthetic_fedora(3) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), stream=True)
+        listener.on_message(None, fedora.docset_url(1))
+    (_, name), data = gcs.objects.popitem()
+    args = listener.conn.send.call_args[0]
+    assert args[1] == 'Complete: {}/b/foo/o/{}\nSize: {}'.format(
+        gcs.url, name, len(data))
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['item0.pdf', 'item1.pdf', 'item2.pdf']
+
+
+def test_on_message_reuses_connections_across_jobs(gcs):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    pools = ConnectionPools()
+    with synthetic_fedora(3) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), session=pools.session)
+        listener.on_message(None, fedora.docset_url(1))
+        opened = pools.stats()[fedora.url]['connections']
+        listener.on_message(None, fedora.docset_url(1))
+        stats = pools.stats()[fedora.url]
+    assert stats['connections'] == opened
+    assert stats['requests'] == len(fedora.requests)
+
+
+def test_on_message_runs_jobs_in_worker_pool(webmock):
+    bucket = Client(url='mock://example.com/google',
+                    upload_url='mock://example.com/google').get('foo')
+    listener = ApiListener(fedora='mock://example.com/fedora/thesis/',
+                           bucket=bucket, conn=mock.MagicMock(), workers=2,
+                           ack=True)
+    for i in range(3):
+        listener.on_message({'message-id': str(i), 'subscription': '1'},
+                            'mock://example.com/docset/1')
+    listener.close()
+    acks = sorted(c[0] for c in listener.conn.ack.call_args_list)
+    assert acks == [('0', '1'), ('1', '1'), ('2', '1')]
+    sent = [c[0][1] for c in listener.conn.send.call_args_list]
+    assert len([m for m in sent if m.startswith('Complete:')]) == 3
+
+
+def test_on_message_uses_download_and_metadata_workers(webmock, listener):
+    listener.download_workers = 2
+    listener.meta_workers = 3
+    with mock.patch('minecart.packager.ordered_map',
+                    wraps=packager.ordered_map) as ordered_map:
+        listener.on_message(None, 'mock://example.com/docset/1')
+    calls = {c[0][0].func: c[0][2] for c in ordered_map.call_args_list}
+    assert calls[packager._fetch_document] == 3
+    assert calls[packager._open_pdf] == 2
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+
+
+def test_on_message_compresses_with_compress_workers(webmock, listener):
+    listener.compress_workers = 2
+    with mock.patch('minecart.packager.Zip', wraps=Zip) as zip_:
+        listener.on_message(None, 'mock://example.com/docset/1')
+    assert zip_.call_args[1]['workers'] == 2
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+
+
+def test_on_message_acks_failed_jobs(webmock, listener):
+    webmock.get('mock://example.com/docset/1', status_code=500)
+    listener.ack = True
+    listener.on_message({'message-id': '1', 'subscription': '1'},
+                        'mock://example.com/docset/1')
+    listener.conn.ack.assert_called_once_with('1', '1')
+
+
+def test_package_digest_changes_with_etag(webmock, thesis_1):
+    webmock.head('mock://example.com/baz', headers={'ETag': '"1"'})
+    docs = [Document('123', thesis_1)]
+    first = package_digest(docs)
+    webmock.head('mock://example.com/baz', headers={'ETag': '"2"'})
+    assert package_digest(docs) != first
+
+
+def test_package_digest_is_none_without_validators(webmock, thesis_1):
+    webmock.head('mock://example.com/baz')
+    assert package_digest([Document('123', thesis_1)]) is None
+
+
+def test_on_message_reuses_cached_package(webmock, listener, cache_db):
+    webmock.head('mock://example.com/baz', headers={'ETag': '"1"'})
+    webmock.head('mock://example.com/quux',
+                 headers={'Last-Modified': 'Wed, 01 Mar 2017 00:00:00 GMT'})
+    listener.cache = PackageCache(cache_db)
+    listener.on_message(None, 'mock://example.com/docset/1')
+    first = listener.conn.send.call_args[0][1]
+    listener.on_message(None, 'mock://example.com/docset/1')
+    assert listener.conn.send.call_args[0][1] == first
+    assert len([r for r in webmock.request_history if r.method == 'PUT']) \
+        == 1
+
+
+def test_on_message_coalesces_requests_for_running_docset(webmock):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_docset(request, context):
+        started.set()
+        release.wait(5)
+        return {'members': [{'ref': '123'}, {'ref': '456'}]}
+
+    webmock.get('mock://example.com/docset/1', json=slow_docset)
+    bucket = Client(url='mock://example.com/google',
+                    upload_url='mock://example.com/google').get('foo')
+    listener = ApiListener(fedora='mock://example.com/fedora/thesis/',
+                           bucket=bucket, conn=mock.MagicMock(), workers=2,
+                           ack=True)
+    listener.on_message({'message-id': '0', 'subscription': '1'},
+                        'mock://example.com/docset/1')
+    started.wait(5)
+    for i in range(1, 3):
+        listener.on_message({'message-id': str(i), 'subscription': '1'},
+                            'mock://example.com/docset/1')
+    release.set()
+    listener.close()
+    assert len([r for r in webmock.request_history if r.method == 'PUT']) \
+        == 1
+    sent = [c[0][1] for c in listener.conn.send.call_args_list]
+    complete = [m for m in sent if m.startswith('Complete:')]
+    assert len(complete) == 3 and len(set(complete)) == 1
+    assert listener.conn.ack.call_count == 3
+
+
+def test_estimate_size_bounds_package_size(webmock, thesis_1_pdf,
+                                           thesis_2_pdf):
+    webmock.head('mock://example.com/baz',
+                 headers={'Content-Length': str(len(thesis_1_pdf))})
+    webmock.head('mock://example.com/quux',
+                 headers={'Content-Length': str(len(thesis_2_pdf))})
+    docs = list(document_set('mock://example.com/docset/1',
+                             fedora='mock://example.com/fedora/thesis/'))
+    arxv = create_package(None, docs=docs)
+    assert os.path.getsize(arxv) <= estimate_size(docs)
+    os.remove(arxv)
+
+
+def test_estimate_size_is_none_without_content_length(webmock, thesis_1):
+    webmock.head('mock://example.com/baz')
+    assert estimate_size([Document('123', thesis_1)]) is None
+
+
+def test_on_message_builds_package_in_scratch_space(webmock, listener):
+    webmock.head('mock://example.com/baz', headers={'Content-Length': '10'})
+    webmock.head('mock://example.com/quux', headers={'Content-Length': '10'})
+    with tempfile.TemporaryDirectory() as d:
+        listener.scratch = ScratchSpace([d])
+        with mock.patch('minecart.packager.Zip', wraps=Zip) as create:
+            listener.on_message(None, 'mock://example.com/docset/1')
+        assert create.call_args[0][0].startswith(d)
+        assert not os.listdir(d)
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+
+
+def test_on_message_rejects_package_too_large_for_scratch(webmock,
+                                                          listener):
+    webmock.head('mock://example.com/baz',
+                 headers={'Content-Length': str(2 ** 60)})
+    webmock.head('mock://example.com/quux', headers={'Content-Length': '10'})
+    with tempfile.TemporaryDirectory() as d:
+        listener.scratch = ScratchSpace([d])
+        listener.on_message(None, 'mock://example.com/docset/1')
+    assert not [r for r in webmock.request_history if r.method == 'GET' and
+                r.url == 'mock://example.com/baz']
+    assert listener.conn.send.call_count == 1
+
+
+def test_on_message_sends_progress(webmock, listener):
+    webmock.head('mock://example.com/baz', headers={'Content-Length': '10'})
+    webmock.head('mock://example.com/quux', headers={'Content-Length': '10'})
+    listener.progress_interval = 0
+    listener.on_message(None, 'mock://example.com/docset/1')
+    sent = [c[0][1] for c in listener.conn.send.call_args_list]
+    assert sent[0] == 'Accepted.'
+    assert sent[1].startswith('Progress: ')
+    assert sent[-1].startswith('Complete: ')
+
+
+def test_on_message_records_stage_metrics(webmock, listener, thesis_1_pdf,
+                                          thesis_2_pdf):
+    before = registry.snapshot()
+    listener.on_message(None, 'mock://example.com/docset/1')
+    after = registry.snapshot()
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+
+    assert delta('minecart_jobs_completed_total') == 1
+    assert delta('minecart_download_bytes_total') == \
+        len(thesis_1_pdf) + len(thesis_2_pdf)
+    for stage in ('docset_fetch', 'metadata', 'download', 'archive',
+                  'upload'):
+        assert delta('minecart_{}_seconds_count'.format(stage)) > 0
+
+
+def test_on_message_schedules_jobs_by_member_count(webmock, listener):
+    listener.scheduler = Scheduler(threshold=1)
+    with mock.patch.object(listener.scheduler, 'submit',
+                           wraps=listener.scheduler.submit) as submit:
+        listener.on_message({'user': 'alice'}, 'mock://example.com/docset/1')
+    listener.close()
+    assert submit.call_args[0][1:] == (2, 'alice')
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+    docset_gets = [r for r in webmock.request_history
+                   if r.url == 'mock://example.com/docset/1']
+    assert len(docset_gets) == 1
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_on_message_copies_unchanged_pdfs_from_last_package(gcs, cache_db,
+                                                            stream):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    manifests = ManifestStore(cache_db)
+    with synthetic_fedora(4) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), stream=stream,
+                               manifests=manifests)
+        listener.on_message(None, fedora.docset_url(1))
+        fedora.files['item2.pdf'] = b'%PDF-1.4\nchanged'
+        del fedora.requests[:]
+        listener.on_message(None, fedora.docset_url(1))
+    gets = [path for method, path in fedora.requests
+            if method == 'GET' and path.startswith('/files/')]
+    assert gets == ['/files/item2.pdf']
+    name = manifests.get(fedora.docset_url(1)).name
+    with zipfile.ZipFile(io.BytesIO(gcs.objects['foo', name])) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['item0.pdf', 'item1.pdf', 'item2.pdf',
+                                 'item3.pdf']
+        assert zf.read('item1.pdf') == b'%PDF-1.4\n'
+        assert zf.read('item2.pdf') == b'%PDF-1.4\nchanged'
+    assert listener.conn.send.call_args[0][1] == \
+        'Complete: {}/b/foo/o/{}\nSize: {}'.format(
+            gcs.url, name, len(gcs.objects['foo', name]))
+    manifests.close()
+
+
+def test_on_message_heads_each_pdf_once(gcs, cache_db):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    manifests = ManifestStore(cache_db)
+    cache = PackageCache(cache_db)
+    with synthetic_fedora(4) as fedora, tempfile.TemporaryDirectory() as d:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), cache=cache,
+                               scratch=ScratchSpace([d]),
+                               manifests=manifests)
+        listener.on_message(None, fedora.docset_url(1))
+        fedora.files['item2.pdf'] = b'%PDF-1.4\nchanged'
+        del fedora.requests[:]
+        listener.on_message(None, fedora.docset_url(1))
+    heads = [path for method, path in fedora.requests if method == 'HEAD']
+    assert sorted(heads) == ['/files/item{}.pdf'.format(i)
+                             for i in range(4)]
+    gets = [path for method, path in fedora.requests
+            if method == 'GET' and path.startswith('/files/')]
+    assert gets == ['/files/item2.pdf']
+    manifests.close()
+    cache.close()
+
+
+def test_on_message_builds_afresh_when_last_package_is_gone(gcs, cache_db):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    manifests = ManifestStore(cache_db)
+    with synthetic_fedora(2) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), manifests=manifests)
+        listener.on_message(None, fedora.docset_url(1))
+        gcs.objects.clear()
+        del fedora.requests[:]
+        listener.on_message(None, fedora.docset_url(1))
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+    gets = [path for method, path in fedora.requests
+            if method == 'GET' and path.startswith('/files/')]
+    assert gets == ['/files/item0.pdf', '/files/item1.pdf']
+    name = manifests.get(fedora.docset_url(1)).name
+    with zipfile.ZipFile(io.BytesIO(gcs.objects['foo', name])) as zf:
+        assert zf.namelist() == ['item0.pdf', 'item1.pdf']
+    assert len(gcs.objects) == 1
+    manifests.close()
+
+
+class Killed(BaseException):
+    """Stands in for the process being killed partway through a job."""
+
+
+def kill_on_call(func, call):
+    calls = []
+
+    def killer(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == call:
+            raise Killed()
+        return func(*args, **kwargs)
+    return killer
+
+
+def test_on_message_resumes_build_from_checkpoint(gcs, cache_db,
+                                                  clean_temp):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    checkpoints = CheckpointStore(cache_db)
+    with synthetic_fedora(4) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(),
+                               checkpoints=checkpoints,
+                               checkpoint_interval=0)
+        with mock.patch('minecart.packager._open_pdf',
+                        kill_on_call(packager._open_pdf, 3)):
+            with pytest.raises(Killed):
+                listener.on_message(None, fedora.docset_url(1))
+        assert len(checkpoints.get(fedora.docset_url(1))['members']) == 2
+        del fedora.requests[:]
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(),
+                               checkpoints=checkpoints)
+        listener.on_message(None, fedora.docset_url(1))
+    gets = [path for method, path in fedora.requests
+            if method == 'GET' and path.endswith('.pdf')]
+    assert gets == ['/files/item2.pdf', '/files/item3.pdf']
+    (_, name), data = gcs.objects.popitem()
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['item0.pdf', 'item1.pdf', 'item2.pdf',
+                                 'item3.pdf']
+    assert checkpoints.get(fedora.docset_url(1)) is None
+    assert not os.path.exists(os.path.join(tempfile.gettempdir(), name))
+    checkpoints.close()
+
+
+def test_on_message_resumes_build_in_scratch_space(gcs, cache_db):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    checkpoints = CheckpointStore(cache_db)
+    with synthetic_fedora(4) as fedora, \
+            tempfile.TemporaryDirectory() as scratch_dir:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(),
+                               scratch=ScratchSpace([scratch_dir]),
+                               checkpoints=checkpoints,
+                               checkpoint_interval=0)
+        with mock.patch('minecart.packager._open_pdf',
+                        kill_on_call(packager._open_pdf, 3)):
+            with pytest.raises(Killed):
+                listener.on_message(None, fedora.docset_url(1))
+        partial = checkpoints.get(fedora.docset_url(1))['filename']
+        orphan = os.path.join(scratch_dir, 'a' * 32 + '.zip')
+        open(orphan, 'w').close()
+        scratch = ScratchSpace([scratch_dir], keep=checkpoints.filenames())
+        assert os.listdir(scratch_dir) == [os.path.basename(partial)]
+        del fedora.requests[:]
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(), scratch=scratch,
+                               checkpoints=checkpoints)
+        listener.on_message(None, fedora.docset_url(1))
+        assert not os.listdir(scratch_dir)
+    gets = [path for method, path in fedora.requests
+            if method == 'GET' and path.endswith('.pdf')]
+    assert gets == ['/files/item2.pdf', '/files/item3.pdf']
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+    assert checkpoints.get(fedora.docset_url(1)) is None
+    checkpoints.close()
+
+
+def test_on_message_rebuilds_when_docset_changes_after_checkpoint(
+        gcs, cache_db, clean_temp):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    checkpoints = CheckpointStore(cache_db)
+    with synthetic_fedora(4) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(),
+                               checkpoints=checkpoints,
+                               checkpoint_interval=0)
+        with mock.patch('minecart.packager._open_pdf',
+                        kill_on_call(packager._open_pdf, 3)):
+            with pytest.raises(Killed):
+                listener.on_message(None, fedora.docset_url(1))
+        partial = checkpoints.get(fedora.docset_url(1))['filename']
+        fedora.docsets['1'].remove('item0')
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(),
+                               checkpoints=checkpoints)
+        listener.on_message(None, fedora.docset_url(1))
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+    (_, name), data = gcs.objects.popitem()
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ['item1.pdf', 'item2.pdf', 'item3.pdf']
+    assert checkpoints.get(fedora.docset_url(1)) is None
+    assert not os.path.exists(partial)
+    checkpoints.close()
+
+
+def test_on_message_resumes_upload_from_checkpoint(gcs, cache_db,
+                                                   clean_temp):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    checkpoints = CheckpointStore(cache_db)
+    with synthetic_fedora(2) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(),
+                               checkpoints=checkpoints)
+        with mock.patch.object(ResumableUpload, 'put',
+                               kill_on_call(ResumableUpload.put, 1)):
+            with pytest.raises(Killed):
+                listener.on_message(None, fedora.docset_url(1))
+        assert checkpoints.get(fedora.docset_url(1))['stage'] == 'upload'
+        del fedora.requests[:]
+        listener.on_message(None, fedora.docset_url(1))
+    assert not [r for r in fedora.requests if r[0] == 'GET']
+    assert len(gcs.objects) == 1
+    assert [r for r in gcs.requests if r[0] == 'POST'] == \
+        [('POST', '/b/foo/o?uploadType=resumable&name={}'.format(
+            next(iter(gcs.objects))[1]))]
+    checkpoints.close()
+
+
+def test_on_message_restarts_upload_when_session_has_expired(gcs, cache_db,
+                                                             clean_temp):
+    bucket = Client(url=gcs.url, upload_url=gcs.url).get('foo')
+    checkpoints = CheckpointStore(cache_db)
+    with synthetic_fedora(2) as fedora:
+        listener = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=mock.MagicMock(),
+                               checkpoints=checkpoints)
+        with mock.patch.object(ResumableUpload, 'put',
+                               kill_on_call(ResumableUpload.put, 1)):
+            with pytest.raises(Killed):
+                listener.on_message(None, fedora.docset_url(1))
+        gcs.sessions.clear()
+        del fedora.requests[:]
+        listener.on_message(None, fedora.docset_url(1))
+    assert not [r for r in fedora.requests if r[0] == 'GET']
+    assert listener.conn.send.call_args[0][1].startswith('Complete:')
+    assert len(gcs.objects) == 1
+    assert checkpoints.get(fedora.docset_url(1)) is None
+    checkpoints.close()
@@ -0,0 +1,82 @@
+import pytest
+import rdflib
+
+from minecart.packager import Document, EBU, PCDM
+from minecart.pcdm import extract_files, PCDMFile
+
+
+def rdflib_files(data):
+    g = rdflib.Graph()
+    g.parse(data=data, format='n3')
+    return {(str(o), str(g.value(o, EBU.hasMimeType)))
+            for o in g.objects(None, PCDM.hasFile)}
+
+
+TRICKY = '''
+@prefix pcdm: <http://pcdm.org/models#> .
+@prefix ebu: <http://www.ebu.ch/metadata/ontologies/ebucore/ebucore#> .
+@prefix dc: <http://purl.org/dc/terms/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+@base <http://example.com/fedora/> .
+# A comment with "quotes" and <brackets>
+<item> dc:title """A long
+title with "quotes" ; and . punctuation""" ;
+       dc:description "tagged"@en , "escaped \\" \\u00e9" ;
+       dc:created "2017-01-01T00:00:00Z"^^xsd:dateTime ;
+       dc:extent 12.5 ;
+       dc:contributor [ dc:name "Someone" ; a dc:Agent ] ;
+       dc:subject ( "a" "b" ) ;
+       pcdm:hasFile <item/files/1> , <http://example.com/other.pdf> ;
+       pcdm:hasFile <item/files/2> .
+<item/files/1> a pcdm:File ; ebu:hasMimeType "application/pdf"^^xsd:string .
+<http://example.com/other.pdf> ebu:hasMimeType "text/plain" ; .
+'''
+
+
+@pytest.mark.parametrize('fixture', ['thesis_1.n3', 'thesis_2.n3'])
+def test_extract_files_matches_rdflib_on_fixtures(fixture):
+    with open('tests/fixtures/' + fixture) as f:
+        data = f.read()
+    assert set(extract_files(data)) == rdflib_files(data)
+
+
+def test_extract_files_matches_rdflib_on_tricky_n3():
+    assert set(extract_files(TRICKY)) == rdflib_files(TRICKY)
+
+
+def test_extract_files_resolves_only_relative_iris_against_base():
+    data = '''
+@base <http://example.com/fedora/> .
+@prefix pcdm: <http://pcdm.org/models#> .
+@prefix local: <#> .
+<1> pcdm:hasFile <1/f> ; local:note "x" .
+<1/f> <http://www.ebu.ch/metadata/ontologies/ebucore/ebucore#hasMimeType>
+    "application/pdf" .
+'''
+    assert extract_files(data) == [
+        PCDMFile('http://example.com/fedora/1/f', 'application/pdf')]
+    assert set(extract_files(data)) == rdflib_files(data)
+
+
+def test_extract_files_keeps_document_order():
+    assert extract_files(TRICKY) == [
+        PCDMFile('http://example.com/fedora/item/files/1', 'application/pdf'),
+        PCDMFile('http://example.com/other.pdf', 'text/plain'),
+        PCDMFile('http://example.com/fedora/item/files/2', 'None'),
+    ]
+
+
+def test_extract_files_rejects_unsupported_n3():
+    with pytest.raises(ValueError):
+        extract_files('{ <a> <b> <c> } => { <a> <b> <d> } .')
+
+
+def test_document_falls_back_to_rdflib():
+    data = '''
+@prefix pcdm: <http://pcdm.org/models#> .
+@keywords a .
+<http://example.com/1> pcdm:hasFile <http://example.com/2> .
+'''
+    doc = Document('foo', data)
+    assert doc._files is None
+    assert list(doc.files) == [('http://example.com/2', 'None')]
@@ -0,0 +1,80 @@
+import threading
+import time
+
+from minecart.scheduler import Scheduler
+
+
+def blocked(scheduler, lane):
+    """Occupy the only worker of ``lane`` until the returned event is set."""
+    started, release = threading.Event(), threading.Event()
+
+    def job():
+        started.set()
+        release.wait(5)
+
+    scheduler.submit(job, 0 if lane == 'fast' else scheduler.threshold + 1)
+    started.wait(5)
+    return release
+
+
+def test_scheduler_routes_jobs_by_cost():
+    s = Scheduler(threshold=10)
+    ran = []
+    assert s.submit(lambda: ran.append('small'), 10) == 'fast'
+    assert s.submit(lambda: ran.append('large'), 11) == 'bulk'
+    s.close()
+    assert sorted(ran) == ['large', 'small']
+
+
+def test_small_jobs_do_not_wait_behind_large_ones():
+    s = Scheduler(threshold=10)
+    release = blocked(s, 'bulk')
+    done = threading.Event()
+    s.submit(done.set, 1)
+    assert done.wait(5)
+    release.set()
+    s.close()
+
+
+def test_cheapest_job_runs_first_in_lane():
+    s = Scheduler(threshold=10)
+    release = blocked(s, 'fast')
+    ran = []
+    for cost in (5, 1, 3):
+        s.submit(lambda cost=cost: ran.append(cost), cost)
+    release.set()
+    s.close()
+    assert ran == [1, 3, 5]
+
+
+def test_waiting_jobs_are_not_starved():
+    s = Scheduler(threshold=10, max_wait=0.05)
+    release = blocked(s, 'fast')
+    ran = []
+    s.submit(lambda: ran.append('old'), 9)
+    time.sleep(0.1)
+    s.submit(lambda: ran.append('new'), 1)
+    release.set()
+    s.close()
+    assert ran == ['old', 'new']
+
+
+def test_fair_scheduling_prefers_idle_users():
+    s = Scheduler(threshold=10, fast_workers=2, fair=True)
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def long_job():
+        started.release()
+        release.wait(5)
+
+    for _ in range(2):
+        s.submit(long_job, 0, user='alice')
+    for _ in range(2):
+        started.acquire(timeout=5)
+    ran = []
+    s.submit(lambda: ran.append('alice'), 1, user='alice')
+    s.submit(lambda: ran.append('bob'), 2, user='bob')
+    release.set()
+    s.close()
+    assert ran[0] == 'bob'
@@ -0,0 +1,107 @@
+from collections import namedtuple
+import os
+import tempfile
+import threading
+from unittest import mock
+
+import pytest
+
+from minecart.scratch import InsufficientSpace, ScratchSpace
+
+
+Usage = namedtuple('Usage', ['total', 'used', 'free'])
+
+
+@pytest.yield_fixture
+def dirs():
+    with tempfile.TemporaryDirectory() as a, \
+            tempfile.TemporaryDirectory() as b:
+        yield a, b
+
+
+@pytest.yield_fixture
+def free():
+    space = {}
+    with mock.patch('minecart.scratch.shutil.disk_usage',
+                    side_effect=lambda d: Usage(0, 0, space[d])):
+        yield space
+
+
+def test_scratch_space_removes_orphaned_packages(dirs):
+    orphan = os.path.join(dirs[0], 'a' * 32 + '.zip')
+    other = os.path.join(dirs[0], 'keep.zip')
+    for path in (orphan, other):
+        open(path, 'w').close()
+    ScratchSpace(dirs)
+    assert os.listdir(dirs[0]) == ['keep.zip']
+
+
+def test_scratch_space_keeps_packages_it_is_told_to(dirs):
+    kept = os.path.join(dirs[0], 'a' * 32 + '.zip')
+    orphan = os.path.join(dirs[0], 'b' * 32 + '.zip')
+    for path in (kept, orphan):
+        open(path, 'w').close()
+    ScratchSpace(dirs, keep=[kept])
+    assert os.listdir(dirs[0]) == [os.path.basename(kept)]
+
+
+def test_reserve_uses_first_directory_with_room(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 1000})
+    space = ScratchSpace(dirs)
+    assert space.reserve(50).dir == dirs[0]
+    assert space.reserve(60).dir == dirs[1]
+    assert space.available(dirs[1]) == 940
+
+
+def test_reserve_leaves_headroom(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 100})
+    with pytest.raises(InsufficientSpace):
+        ScratchSpace(dirs, headroom=10).reserve(95)
+
+
+def test_reserve_counts_written_part_of_reservation_once(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 0})
+    space = ScratchSpace(dirs)
+    reservation = space.reserve(60)
+    with open(reservation.path, 'wb') as fp:
+        fp.write(b'x' * 20)
+    free[dirs[0]] = 80
+    assert space.available(dirs[0]) == 40
+
+
+def test_reserve_waits_for_space_to_be_released(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 0})
+    space = ScratchSpace(dirs)
+    first = space.reserve(80)
+    timer = threading.Timer(0.1, first.release)
+    timer.start()
+    assert space.reserve(80).dir == dirs[0]
+    timer.join()
+
+
+def test_reserve_times_out(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 0})
+    space = ScratchSpace(dirs, timeout=0.1)
+    space.reserve(80)
+    with pytest.raises(InsufficientSpace):
+        space.reserve(80)
+
+
+def test_release_removes_package(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 0})
+    with ScratchSpace(dirs).reserve(10) as reservation:
+        open(reservation.path, 'w').close()
+    assert not os.listdir(dirs[0])
+
+
+def test_release_leaves_kept_package(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 0})
+    with ScratchSpace(dirs).reserve(10) as reservation:
+        open(reservation.path, 'w').close()
+        reservation.keep = True
+    assert os.listdir(dirs[0]) == [os.path.basename(reservation.path)]
+
+
+def test_reserve_unknown_size_uses_directory_with_most_space(dirs, free):
+    free.update({dirs[0]: 100, dirs[1]: 1000})
+    assert ScratchSpace(dirs).reserve(None).dir == dirs[1]
@@ -0,0 +1,152 @@
+import io
+import json
+import os
+import time
+from unittest import mock
+import zipfile
+
+import stomp
+
+from minecart.packager import ApiListener
+from minecart.shard import (build_shard, central_directory,
+                            ShardCoordinator, split)
+from minecart.upload import Client
+from tests.standins import Broker, synthetic_fedora
+
+
+def shard_of(names):
+    def write(arxv):
+        for name in names:
+            arxv.write_stream([name.encode('utf-8') * 100], name)
+    filename, size, entries = build_shard(write)
+    with open(filename, 'rb') as fp:
+        data = fp.read(size)
+    os.remove(filename)
+    return data, size, json.loads(json.dumps(entries))
+
+
+def test_split_balances_shards():
+    assert split(list(range(7)), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+
+
+def test_split_drops_empty_shards():
+    assert split([1, 2], 4) == [[1], [2]]
+
+
+def test_composed_shards_form_a_zip(clean_temp):
+    shards = [shard_of(['a', 'b']), shard_of(['c']), shard_of(['d', 'e'])]
+    directory = central_directory([(size, entries)
+                                   for _, size, entries in shards])
+    data = b''.join(d for d, _, _ in shards) + directory
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['a', 'b', 'c', 'd', 'e']
+        assert zf.testzip() is None
+        assert zf.read('d') == b'd' * 100
+
+
+def test_central_directory_uses_zip64_for_large_offsets(clean_temp):
+    _, size, entries = shard_of(['a'])
+    directory = central_directory([(5 * 2 ** 30, []), (size, entries)])
+    assert b'PK\x06\x06' in directory
+
+
+def connect(broker, listener, *subscriptions):
+    conn = stomp.Connection([broker.host_and_port])
+    listener.conn = conn
+    conn.set_listener('archiver', listener)
+    conn.start()
+    conn.connect(wait=True)
+    for i, (queue, ack) in enumerate(subscriptions):
+        conn.subscribe(queue, i, ack=ack)
+    return conn
+
+
+def test_listeners_build_sharded_package(gcs, clean_temp):
+    bucket = Client(url=gcs.url, upload_url=gcs.url, backoff=0).get('foo')
+    with synthetic_fedora(7) as fedora, Broker() as broker:
+        coordinator = ApiListener(fedora=fedora.fedora, bucket=bucket,
+                                  conn=None, workers=2,
+                                  shards=ShardCoordinator(3, timeout=10))
+        workers = [ApiListener(fedora=fedora.fedora, bucket=bucket,
+                               conn=None, ack=True,
+                               shards=ShardCoordinator())
+                   for _ in range(2)]
+        conns = [connect(broker, coordinator, ('/queue/api', 'auto'),
+                         (coordinator.shards.result_queue, 'auto'))]
+        for worker in workers:
+            conns.append(connect(broker, worker,
+                                 ('/queue/shards', 'client-individual')))
+        conns[0].send('/queue/api', fedora.docset_url(1))
+        deadline = time.time() + 10
+        while not broker.messages('/queue/package/1')[1:] and \
+                time.time() < deadline:
+            time.sleep(0.05)
+        for conn in conns:
+            conn.disconnect()
+        coordinator.close()
+    complete = broker.messages('/queue/package/1')[-1]
+    assert complete.startswith('Complete: ')
+    assert len(broker.messages('/queue/shards')) == 3
+    (_, name), data = gcs.objects.popitem()
+    assert not gcs.objects
+    assert complete.endswith('Size: {}'.format(len(data)))
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.namelist() == ['item{}.pdf'.format(i) for i in range(7)]
+        assert zf.testzip() is None
+
+
+def test_sharded_build_fails_when_a_shard_fails(gcs):
+    bucket = Client(url=gcs.url, upload_url=gcs.url, backoff=0).get('foo')
+    conn = mock.MagicMock()
+    shards = ShardCoordinator(2)
+    listener = ApiListener(fedora='http://example.com/', bucket=bucket,
+                           conn=conn, workers=2, shards=shards)
+
+    def reply(queue, body):
+        if queue == shards.queue:
+            job = json.loads(body)
+            listener.on_message(
+                {'destination': shards.result_queue},
+                json.dumps({'job': job['job'], 'shard': job['shard'],
+                            'error': 'Boom'}))
+
+    conn.send.side_effect = reply
+    assert shards.build(listener, 'http://example.com/docset/1',
+                        ['a', 'b']) is None
+    assert not gcs.objects
+
+
+def test_sharded_build_deletes_parts_when_it_times_out(gcs):
+    bucket = Client(url=gcs.url, upload_url=gcs.url, backoff=0).get('foo')
+    conn = mock.MagicMock()
+    shards = ShardCoordinator(3, timeout=0.1)
+    listener = ApiListener(fedora='http://example.com/', bucket=bucket,
+                           conn=conn, workers=2, shards=shards)
+    jobs = []
+
+    def reply(queue, body):
+        if queue == shards.queue:
+            job = json.loads(body)
+            jobs.append(job)
+            if job['shard'] == 2:
+                return
+            with bucket.create(job['part']).open() as part:
+                part.write(b'x' * 10)
+            listener.on_message(
+                {'destination': shards.result_queue},
+                json.dumps({'job': job['job'], 'shard': job['shard'],
+                            'part': job['part'], 'size': 10,
+                            'entries': []}))
+
+    conn.send.side_effect = reply
+    assert shards.build(listener, 'http://example.com/docset/1',
+                        ['a', 'b', 'c']) is None
+    assert not gcs.objects
+    job = jobs[2]
+    with bucket.create(job['part']).open() as part:
+        part.write(b'x' * 10)
+    listener.on_message(
+        {'destination': shards.result_queue},
+        json.dumps({'job': job['job'], 'shard': 2, 'part': job['part'],
+                    'size': 10, 'entries': []}))
+    assert not gcs.objects
@@ -1,9 +1,12 @@
+import io
 import os
+import zipfile
 
 import pytest
 import requests_mock
 
-from minecart.upload import Bucket, BucketObject, Client
+from minecart.upload import (Bucket, BucketObject, Client, ResumableUpload,
+                             UploadStream)
 
 
 @pytest.yield_fixture
@@ -57,3 +60,152 @@ def test_bucket_uploads_from_file_object(google, package):
     h = google.request_history
     assert h[1].method == 'PUT'
     assert h[1].qs['upload_id'] == ['1']
+
+
+def test_upload_stream_sends_fixed_size_chunks(gcs):
+    c = Client(url=gcs.url, upload_url=gcs.url)
+    obj = c.get('foo').create('bar')
+    data = os.urandom(3 * 256 * 1024 + 10)
+    with obj.open(chunk_size=256 * 1024) as sink:
+        sink.write(data[:1000])
+        sink.write(data[1000:])
+    assert gcs.objects[('foo', 'bar')] == data
+    assert gcs.chunks == [256 * 1024] * 3 + [10]
+
+
+def test_upload_stream_finalizes_on_chunk_boundary(gcs):
+    c = Client(url=gcs.url, upload_url=gcs.url)
+    obj = c.get('foo').create('bar')
+    data = os.urandom(256 * 1024)
+    with obj.open(chunk_size=256 * 1024) as sink:
+        sink.write(data)
+    assert gcs.objects[('foo', 'bar')] == data
+
+
+def test_upload_stream_accepts_zip_archive(gcs):
+    c = Client(url=gcs.url, upload_url=gcs.url)
+    obj = c.get('foo').create('bar')
+    with obj.open(chunk_size=256 * 1024) as sink:
+        with zipfile.ZipFile(sink, 'w') as zf:
+            zf.writestr('test.txt', b'foobar')
+    with zipfile.ZipFile(io.BytesIO(gcs.objects[('foo', 'bar')])) as zf:
+        assert zf.read('test.txt') == b'foobar'
+
+
+def test_upload_stream_cancels_session_on_error(gcs):
+    c = Client(url=gcs.url, upload_url=gcs.url)
+    obj = c.get('foo').create('bar')
+    with pytest.raises(ZeroDivisionError):
+        with obj.open(chunk_size=256 * 1024) as sink:
+            sink.write(b'foo')
+            1/0
+    assert gcs.requests[-1][0] == 'DELETE'
+    assert not gcs.sessions
+    assert not gcs.objects
+
+
+def test_upload_stream_requires_chunk_multiple():
+    with pytest.raises(ValueError):
+        UploadStream(ResumableUpload(Client(), 'mock://example.com'),
+                     chunk_size=1000)
+
+
+def test_bucket_uploads_in_chunks(gcs, tmpdir):
+    package = tmpdir.join('package.zip')
+    data = os.urandom(2 * 256 * 1024 + 10)
+    package.write_binary(data)
+    c = Client(url=gcs.url, upload_url=gcs.url)
+    c.get('foo').create('bar').upload(str(package), chunk_size=256 * 1024)
+    assert gcs.objects[('foo', 'bar')] == data
+    assert gcs.chunks == [256 * 1024, 256 * 1024, 10]
+
+
+def test_bucket_upload_resumes_after_transient_error(gcs, tmpdir):
+    package = tmpdir.join('package.zip')
+    data = os.urandom(4 * 256 * 1024)
+    package.write_binary(data)
+    gcs.failures.extend([503, 500])
+    c = Client(url=gcs.url, upload_url=gcs.url, backoff=0)
+    c.get('foo').create('bar').upload(str(package),
+                                      chunk_size=4 * 256 * 1024)
+    assert gcs.objects[('foo', 'bar')] == data
+    assert gcs.chunks == [256 * 1024]
+    assert ('PUT', '/session/0') in gcs.requests
+
+
+def test_bucket_upload_continues_session(gcs, tmpdir):
+    package = tmpdir.join('package.zip')
+    data = os.urandom(2 * 256 * 1024 + 10)
+    package.write_binary(data)
+    blob = Client(url=gcs.url, upload_url=gcs.url).get('foo').create('bar')
+    location = blob.resumable_session(len(data))
+    ResumableUpload(blob.client, location).put(data[:256 * 1024], 0)
+    blob.upload(str(package), chunk_size=256 * 1024, location=location)
+    assert gcs.objects[('foo', 'bar')] == data
+    assert gcs.chunks == [256 * 1024, 256 * 1024, 10]
+
+
+def test_bucket_upload_gives_up_after_retries(gcs, package):
+    gcs.failures.extend([503] * 3)
+    c = Client(url=gcs.url, upload_url=gcs.url, retries=2, backoff=0)
+    with pytest.raises(Exception):
+        c.get('foo').create('bar').upload(package)
+    assert not gcs.objects
+
+
+def test_upload_stream_resumes_after_transient_error(gcs):
+    c = Client(url=gcs.url, upload_url=gcs.url, backoff=0)
+    obj = c.get('foo').create('bar')
+    data = os.urandom(5 * 256 * 1024)
+    gcs.failures.append(502)
+    with obj.open(chunk_size=4 * 256 * 1024) as sink:
+        sink.write(data)
+    assert gcs.objects[('foo', 'bar')] == data
+
+
+def test_bucket_object_deletes_itself(google):
+    google.delete('mock://example.com/b/foo/o/bar')
+    c = Client(url='mock://example.com', upload_url='mock://example.com')
+    c.get('foo').create('bar').delete()
+    assert google.request_history[0].method == 'DELETE'
+
+
+def test_bucket_object_composes_sources(google):
+    google.post('mock://example.com/b/foo/o/bar/compose')
+    c = Client(url='mock://example.com', upload_url='mock://example.com')
+    bucket = c.get('foo')
+    bucket.create('bar').compose([bucket.create('baz'),
+                                  bucket.create('quux')])
+    assert google.request_history[0].json()['sourceObjects'] == \
+        [{'name': 'baz'}, {'name': 'quux'}]
+
+
+def test_bucket_uploads_large_files_in_parallel_parts(gcs, tmpdir):
+    package = tmpdir.join('package.zip')
+    data = os.urandom(1000003)
+    package.write_binary(data)
+    c = Client(url=gcs.url, upload_url=gcs.url, composite_threshold=1000,
+               composite_parts=4)
+    c.get('foo').create('bar').upload(str(package))
+    assert gcs.objects == {('foo', 'bar'): data}
+    posts = [p for m, p in gcs.requests if m == 'POST']
+    assert len(posts) == 5
+
+
+def test_bucket_uploads_small_files_without_parts(gcs, package):
+    c = Client(url=gcs.url, upload_url=gcs.url, composite_threshold=1000,
+               composite_parts=4)
+    c.get('foo').create('bar').upload(package)
+    assert list(gcs.objects) == [('foo', 'bar')]
+    assert not any(m == 'DELETE' for m, _ in gcs.requests)
+
+
+def test_bucket_deletes_parts_when_composite_upload_fails(gcs, tmpdir):
+    package = tmpdir.join('package.zip')
+    package.write_binary(os.urandom(1000003))
+    gcs.failures.append(403)
+    c = Client(url=gcs.url, upload_url=gcs.url, composite_threshold=1000,
+               composite_parts=4)
+    with pytest.raises(Exception):
+        c.get('foo').create('bar').upload(str(package))
+    assert not gcs.objects